@@ -19,14 +19,60 @@ along with exparser.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
 import sys
+import errno
+import json
+import re
 import time
+import thread
+import zlib
+import types
 import pickle
+import cPickle
+import hashlib
+from cStringIO import StringIO
 import numpy as np
 import shutil
 from exparser.DataMatrix import DataMatrix
+from exparser.MemoryCache import MemoryCache
+try:
+	import fcntl
+except ImportError:
+	# On Windows, lock files are locked with msvcrt instead (see _lockFile())
+	fcntl = None
+	import msvcrt
 
 skipCache = '--no-cache' in sys.argv
 cacheFolder = '.cache'
+# The maximum total size of the cache folder in bytes. When a new entry makes
+# the cache exceed this budget, the least recently accessed entries are
+# removed. The budget can be specified in megabytes with --cache-size=[MB].
+maxCacheSize = 4*1024**3
+for arg in sys.argv:
+	if arg.startswith('--cache-size='):
+		maxCacheSize = int(float(arg[13:])*1024**2)
+indexName = 'index.json'
+# Hits are appended to a hidden log, instead of being written to the index
+# one by one. The log is merged into the index whenever the index is saved,
+# and when the log exceeds hitLogMaxSize bytes.
+hitLogName = '.hits.log'
+hitLogMaxSize = 1024**2
+# Entries of at least compressMinSize bytes are compressed with zlib, unless
+# this is disabled with --no-compress-cache. A low compression level is
+# used, because decompression speed matters more than file size.
+compressCache = '--no-compress-cache' not in sys.argv
+compressMinSize = 1024**2
+compressLevel = 1
+# Cached values are also kept in memory, so that repeated calls in the same
+# process do not load them from disk. The budget can be specified in megabytes
+# with --cache-memory=[MB], or changed through memoryCache.maxBytes.
+memoryCache = MemoryCache(maxBytes=512*1024**2)
+for arg in sys.argv:
+	if arg.startswith('--cache-memory='):
+		memoryCache.maxBytes = int(float(arg[15:])*1024**2)
+# The locks that are held by the current process, indexed by the path of the
+# lock file, so that an entry that is locked again by the same thread raises
+# an Exception instead of waiting forever.
+heldLocks = {}
 if '--clear-cache' in sys.argv and os.path.exists(cacheFolder):
 	print 'Removing cache folder (%s)' % cacheFolder
 	shutil.rmtree(cacheFolder)
@@ -34,105 +80,1198 @@ if not os.path.exists(cacheFolder):
 	print 'Creating cache folder (%s)' % cacheFolder
 	os.mkdir(cacheFolder)
 
-def cachedArray(func):
+def getCachePath(func, args, kwargs, ext, ignore=[]):
 
 	"""
-	A decorator function that provides a cache for functions that return
-	numpy arrays.
+	Determines the cache path for a function call, based on the `cacheId`
+	keyword, which is removed from the keywords. If `cacheId` is 'auto', the
+	cache key is derived from the function and its arguments (see
+	cacheKey()), so that a cached result is only used for the same function
+	with the same arguments.
 
 	Arguments:
 	func		--	A function.
+	args		--	A list of arguments.
+	kwargs		--	A dictionary of keywords.
+	ext			--	The extension of the cache file.
+
+	Keywords:
+	ignore		--	A list of keywords that are not part of automatic cache
+					keys. (default=[])
+
+	Returns:
+	A path, or None if the function call should not be cached.
 	"""
 
-	def inner(*args, **kwargs):
+	cacheId = kwargs.pop('cacheId', None)
+	if cacheId == None:
+		return None
+	if cacheId == 'auto':
+		cacheId = '%s.%s' % (_funcName(func), cacheKey(func, args, kwargs,
+			ignore))
+	return os.path.join(cacheFolder, cacheId) + ext
 
-		isCached = True
-		if 'cacheId' in kwargs:
-			cachePath = os.path.join(cacheFolder, kwargs['cacheId']) + '.npy'
-			del kwargs['cacheId']
+def cacheKey(func, args, kwargs, ignore=[]):
+
+	"""
+	Derives a cache key from a function call. The key is a hash of the
+	qualified name, the bytecode, and the default arguments of the function,
+	and of the arguments of the call. DataMatrix arguments are hashed with
+	DataMatrix.fingerprint(), NumPy arrays by their contents, and other
+	objects by their value. Functions that are called by the function, files
+	that are referred to by the arguments, and ignored keywords are not part
+	of the key.
+
+	Arguments:
+	func		--	A function.
+	args		--	A list of arguments.
+	kwargs		--	A dictionary of keywords.
+
+	Keywords:
+	ignore		--	A list of keywords that do not affect the result of the
+					function, such as the number of parallel workers. These
+					are not part of the key, so that a cached result is also
+					used when they differ. (default=[])
+
+	Returns:
+	An md5 hex digest.
+	"""
+
+	md5 = hashlib.md5()
+	_fingerprint(func, md5)
+	_fingerprint(list(args), md5)
+	_fingerprint(dict((key, value) for key, value in kwargs.items() \
+		if key not in ignore), md5)
+	return md5.hexdigest()
+
+def _funcName(func):
+
+	"""
+	Arguments:
+	func		--	A function.
+
+	Returns:
+	The qualified name of the function, such as `exparser.TraceKit.splitTrace`.
+	"""
+
+	return '%s.%s' % (func.__module__, func.__name__)
+
+def _fingerprint(obj, md5):
+
+	"""
+	Adds an object to a hash.
+
+	Arguments:
+	obj			--	An object.
+	md5			--	A hashlib object.
+	"""
+
+	md5.update('\x00%s\x00' % type(obj).__name__)
+	if obj is None or isinstance(obj, (bool, int, long, float, complex, str,
+		unicode, np.generic)):
+		md5.update(repr(obj))
+	elif isinstance(obj, (list, tuple)):
+		md5.update(str(len(obj)))
+		for item in obj:
+			_fingerprint(item, md5)
+	elif isinstance(obj, dict):
+		# Items are sorted by the hash of their key, so that the order of the
+		# items doesn't matter.
+		l = []
+		for key, value in obj.items():
+			_md5 = hashlib.md5()
+			_fingerprint(key, _md5)
+			l.append( (_md5.hexdigest(), value) )
+		l.sort(key=lambda item: item[0])
+		md5.update(str(len(l)))
+		for key, value in l:
+			md5.update(key)
+			_fingerprint(value, md5)
+	elif isinstance(obj, (set, frozenset)):
+		l = []
+		for item in obj:
+			_md5 = hashlib.md5()
+			_fingerprint(item, _md5)
+			l.append(_md5.hexdigest())
+		md5.update(''.join(sorted(l)))
+	elif isinstance(obj, DataMatrix):
+		md5.update(obj.fingerprint())
+	elif isinstance(obj, np.ndarray):
+		md5.update('%s%s' % (obj.dtype.str, obj.shape))
+		if obj.dtype == object:
+			_fingerprint(obj.tolist(), md5)
 		else:
-			cachePath = None
-		if skipCache or cachePath == None or not os.path.exists(cachePath):
-			a = func(*args, **kwargs)
-			if not isinstance(a, np.ndarray):
-				raise Exception( \
-					'You can use the @cachedArray decorator only for functions that return a NumPy array.')
-			if cachePath != None:
-				print '@cachedArray: saving %s' % cachePath
-				np.save(cachePath, a)
+			md5.update(np.ascontiguousarray(obj))
+	elif isinstance(obj, types.FunctionType):
+		md5.update(_funcName(obj))
+		_codeFingerprint(obj.func_code, md5)
+		_fingerprint(obj.func_defaults, md5)
+	elif isinstance(obj, types.MethodType):
+		_fingerprint(obj.im_func, md5)
+		_fingerprint(obj.im_self, md5)
+	elif isinstance(obj, (types.BuiltinFunctionType, type)):
+		md5.update('%s.%s' % (obj.__module__, obj.__name__))
+	else:
+		# Protocol 0, because higher protocols silently pickle some objects
+		# without their state, such as open files.
+		try:
+			md5.update(pickle.dumps(obj, 0))
+		except Exception:
+			raise Exception('Cannot derive a cache key from %s' % repr(obj))
+
+def _codeFingerprint(code, md5):
+
+	"""
+	Adds a code object to a hash.
+
+	Arguments:
+	code		--	A code object.
+	md5			--	A hashlib object.
+	"""
+
+	md5.update(code.co_code)
+	md5.update(repr(code.co_names))
+	for const in code.co_consts:
+		if isinstance(const, types.CodeType):
+			_codeFingerprint(const, md5)
 		else:
-			cTime = time.ctime(os.path.getctime(cachePath))
-			print '@cachedArray: loading %s (created %s)' % (cachePath, cTime)
-			a = np.load(cachePath)
-		return a
+			md5.update(repr(const))
 
-	return inner
+def loadIndex(collectHits=False):
+
+	"""
+	Loads the index of the cache folder. The index keeps track of the size,
+	the creation and access times, the number of hits, and the compute and
+	load times of each entry, and of the total number of hits, misses, and
+	evictions. A missing or unreadable index results in an empty index. Hits
+	that are still in the hit log (see _recordHit()) are included.
 
-def cachedDataMatrix(func):
+	Keywords:
+	collectHits	--	Indicates whether the hit log should be emptied, because
+					the hits will be saved with the index. The index should
+					then be locked (see saveIndex()). (default=False)
 
+	Returns:
+	A dictionary.
 	"""
-	A decorator function that provides a cache for functions that return
-	DataMatrices.
+
+	index = {'hits' : 0, 'misses' : 0, 'evictions' : 0, 'entries' : {}}
+	path = os.path.join(cacheFolder, indexName)
+	if os.path.exists(path):
+		try:
+			with open(path) as fd:
+				index.update(json.load(fd))
+		except ValueError:
+			print 'Ignoring unreadable cache index (%s)' % path
+	logPath = os.path.join(cacheFolder, hitLogName)
+	if collectHits:
+		# Hits that are recorded in the meantime go into a new log
+		tmpPath = _tmpPath(logPath)
+		try:
+			os.rename(logPath, tmpPath)
+		except OSError:
+			return index
+		logPath = tmpPath
+	if os.path.exists(logPath):
+		with open(logPath) as fd:
+			for line in fd:
+				try:
+					name, t, loadTime = json.loads(line)
+				except ValueError:
+					# An incomplete line
+					continue
+				_applyHit(index, name, t, loadTime)
+	if collectHits:
+		_removeEntry(logPath)
+	return index
+
+def saveIndex(index):
+
+	"""
+	Saves the index of the cache folder. The index is written to a temporary
+	file and then renamed, so that an interrupted write does not leave a
+	partial index. To avoid losing updates from other processes, the index
+	should be locked (see _lock()) while it is loaded, updated, and saved.
+
+	Arguments:
+	index		--	A dictionary as returned by loadIndex().
+	"""
+
+	path = os.path.join(cacheFolder, indexName)
+	tmpPath = _tmpPath(path)
+	with open(tmpPath, 'w') as fd:
+		json.dump(index, fd, indent=1, sort_keys=True)
+	os.rename(tmpPath, path)
+
+def listEntries(index):
+
+	"""
+	Synchronizes the index with the cache folder, and returns all entries.
+	An entry is a file or, for DataMatrices, a folder. Hidden files, which are
+	used for temporary files and locks, are not entries. Entries that are not
+	in the index, such as entries that were cached by an older version of
+	exparser, are added with their modification time as access time. Entries
+	that no longer exist are removed from the index.
+
+	Arguments:
+	index		--	A dictionary as returned by loadIndex().
+
+	Returns:
+	A dictionary of entries, indexed by their name in the cache folder.
+	"""
+
+	entries = {}
+	for name in os.listdir(cacheFolder):
+		if name == indexName or name.startswith('.'):
+			continue
+		path = os.path.join(cacheFolder, name)
+		try:
+			entry = index['entries'].get(name)
+			if entry == None:
+				entry = _newEntry(path)
+			entry['size'] = _entrySize(path)
+		except OSError:
+			# The entry was removed by another process
+			continue
+		entries[name] = entry
+	index['entries'] = entries
+	return entries
+
+def prune(maxBytes=None):
+
+	"""
+	Removes the least recently accessed entries from the cache folder until
+	the total size of the cache fits in a budget. Temporary files that were
+	left behind by interrupted processes more than a day ago, and the lock
+	files of entries that no longer exist, are removed as well.
+
+	Keywords:
+	maxBytes	--	The budget in bytes, or None to use `maxCacheSize`.
+					(default=None)
+
+	Returns:
+	A list with the names of the removed entries.
+	"""
+
+	for name in os.listdir(cacheFolder):
+		path = os.path.join(cacheFolder, name)
+		if re.match(r'^\.\d+\.', name) is not None and \
+			not name.endswith('.lock') and \
+			os.path.getmtime(path) < time.time() - 24*3600:
+			_removeEntry(path)
+	lock = _lock(os.path.join(cacheFolder, indexName))
+	try:
+		index = loadIndex(collectHits=True)
+		removed = _prune(index, maxBytes)
+		saveIndex(index)
+	finally:
+		_unlock(lock)
+	# Remove the lock files of entries that no longer exist
+	for name in os.listdir(cacheFolder):
+		if name.startswith('.') and name.endswith('.lock') and \
+			not os.path.exists(os.path.join(cacheFolder, name[1:-5])) and \
+			not os.path.exists(os.path.join(cacheFolder, name[1:-5] + '.z')):
+			_removeLock(os.path.join(cacheFolder, name[1:-5]))
+	return removed
+
+def stats():
+
+	"""
+	Gives statistics about the cache folder.
+
+	Returns:
+	A dictionary with the number of entries, their total size on disk and
+	their total size before compression in bytes, the budget, the number of
+	hits, misses, and evictions, the hit rate, and the total compute time in
+	seconds that was saved by loading entries from the cache.
+	"""
+
+	index = loadIndex()
+	entries = listEntries(index).values()
+	n = index['hits'] + index['misses']
+	return {
+		'entries' : len(entries),
+		'size' : sum(entry['size'] for entry in entries),
+		'rawSize' : sum(entry['size'] if entry['rawSize'] == None \
+			else entry['rawSize'] for entry in entries),
+		'maxSize' : maxCacheSize,
+		'hits' : index['hits'],
+		'misses' : index['misses'],
+		'evictions' : index['evictions'],
+		'hitRate' : float(index['hits'])/n if n > 0 else 0.,
+		'savedTime' : sum(entry['savedTime'] for entry in entries)
+		}
+
+def _entrySize(path):
+
+	"""
+	Determines the size of an entry in the cache folder.
+
+	Arguments:
+	path		--	The path to a file or folder.
+
+	Returns:
+	The size in bytes.
+	"""
+
+	if not os.path.isdir(path):
+		return os.path.getsize(path)
+	size = 0
+	for dirPath, dirNames, fileNames in os.walk(path):
+		for fname in fileNames:
+			size += os.path.getsize(os.path.join(dirPath, fname))
+	return size
+
+def _removeEntry(path):
+
+	"""
+	Removes an entry from the cache folder, if it still exists.
+
+	Arguments:
+	path		--	The path to a file or folder.
+	"""
+
+	if os.path.isdir(path):
+		shutil.rmtree(path, ignore_errors=True)
+	elif os.path.exists(path):
+		try:
+			os.remove(path)
+		except OSError:
+			# The entry was removed by another process
+			pass
+
+def _tmpPath(path):
+
+	"""
+	Gives a temporary path for writing a file or folder, which is renamed to
+	the final path when it is complete. The temporary path is hidden, and
+	unique for the process, and it has the same extension as the final path.
+
+	Arguments:
+	path		--	The final path.
+
+	Returns:
+	A path.
+	"""
+
+	folder, name = os.path.split(path)
+	return os.path.join(folder, '.%d.%s' % (os.getpid(), name))
+
+def _lock(path):
+
+	"""
+	Acquires an exclusive lock on an entry in the cache folder, so that
+	processes that share the cache folder do not compute, write, or index the
+	same entry at the same time. This waits until the lock is available. The
+	lock is a hidden lock file next to the entry. An Exception is raised if
+	the entry has already been locked by the current thread, for example
+	because a cached function calls itself with the same arguments.
+
+	Arguments:
+	path		--	The path to the entry.
+
+	Returns:
+	The lock, which should be passed to _unlock().
+	"""
+
+	folder, name = os.path.split(path)
+	lockPath = os.path.join(folder, '.%s.lock' % name)
+	owner = os.getpid(), thread.get_ident()
+	if heldLocks.get(lockPath) == owner:
+		raise Exception( \
+			'%s is already locked by this process. Does a cached function ' \
+			'call itself with the same arguments?' % path)
+	while True:
+		lock = open(lockPath, 'a')
+		try:
+			_lockFile(lock, block=False)
+		except IOError:
+			print 'Waiting for %s, which is locked by another process' % path
+			_lockFile(lock)
+		# The lock file may have been removed while we were waiting (see
+		# _removeLock()), in which case the new lock file is locked.
+		try:
+			if os.fstat(lock.fileno()).st_ino == os.stat(lockPath).st_ino:
+				break
+		except OSError:
+			pass
+		lock.close()
+	heldLocks[lockPath] = owner
+	return lock
+
+def _unlock(lock):
+
+	"""
+	Releases a lock that was acquired with _lock().
+
+	Arguments:
+	lock		--	The lock.
+	"""
+
+	heldLocks.pop(lock.name, None)
+	if fcntl == None:
+		lock.seek(0)
+		msvcrt.locking(lock.fileno(), msvcrt.LK_UNLCK, 1)
+	lock.close()
+
+def _lockFile(lock, block=True):
+
+	"""
+	Locks an open lock file exclusively, with flock() on Unix and with
+	msvcrt.locking() on Windows. On Windows, the first byte of the file is
+	locked, which is also possible when the file is empty.
+
+	Arguments:
+	lock		--	The lock file.
+
+	Keywords:
+	block		--	Indicates whether to wait until the file can be locked.
+					If False, an IOError is raised if the file is locked by
+					another process. (default=True)
+	"""
+
+	if fcntl != None:
+		if block:
+			fcntl.flock(lock, fcntl.LOCK_EX)
+		else:
+			fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		return
+	lock.seek(0)
+	while True:
+		try:
+			msvcrt.locking(lock.fileno(), msvcrt.LK_NBLCK, 1)
+			return
+		except IOError:
+			if not block:
+				raise
+		time.sleep(.1)
+
+def _removeLock(path):
+
+	"""
+	Removes the lock file of an entry, unless the entry is locked.
+
+	Arguments:
+	path		--	The path to the entry.
+	"""
+
+	folder, name = os.path.split(path)
+	lockPath = os.path.join(folder, '.%s.lock' % name)
+	if lockPath in heldLocks or not os.path.exists(lockPath):
+		return
+	try:
+		lock = open(lockPath, 'a')
+	except IOError:
+		return
+	try:
+		_lockFile(lock, block=False)
+	except IOError:
+		# The entry is locked
+		lock.close()
+		return
+	try:
+		os.remove(lockPath)
+	except OSError:
+		# The lock file has been removed already, or it cannot be removed
+		# while it is open, which is the case on Windows
+		pass
+	_unlock(lock)
+
+def _newEntry(path, computeTime=None, rawSize=None):
+
+	"""
+	Creates an index entry for an entry in the cache folder.
+
+	Arguments:
+	path		--	The path to the entry.
+
+	Keywords:
+	computeTime	--	The time in seconds that it took to compute the cached
+					value, or None if unknown. (default=None)
+	rawSize		--	The size in bytes before compression, or None if
+					unknown. (default=None)
+
+	Returns:
+	A dictionary.
+	"""
+
+	if computeTime == None:
+		t = os.path.getmtime(path)
+	else:
+		t = time.time()
+	return {
+		'size' : _entrySize(path),
+		'rawSize' : rawSize,
+		'created' : t,
+		'accessed' : t,
+		'hits' : 0,
+		'computeTime' : computeTime,
+		'loadTime' : None,
+		'savedTime' : 0.
+		}
+
+def _recordHit(path, loadTime):
+
+	"""
+	Registers that an entry was loaded from the cache. The hit is appended
+	to the hit log, which does not need to be locked, and which is merged
+	into the index later (see loadIndex()).
+
+	Arguments:
+	path		--	The path to the entry.
+	loadTime	--	The time in seconds that it took to load the entry.
+	"""
+
+	name = os.path.relpath(path, cacheFolder)
+	logPath = os.path.join(cacheFolder, hitLogName)
+	with open(logPath, 'a') as fd:
+		fd.write(json.dumps([name, time.time(), loadTime]) + '\n')
+		size = fd.tell()
+	if size < hitLogMaxSize:
+		return
+	lock = _lock(os.path.join(cacheFolder, indexName))
+	try:
+		saveIndex(loadIndex(collectHits=True))
+	finally:
+		_unlock(lock)
+
+def _applyHit(index, name, t, loadTime):
+
+	"""
+	Registers a hit from the hit log in the index.
+
+	Arguments:
+	index		--	A dictionary as returned by loadIndex().
+	name		--	The name of the entry in the cache folder.
+	t			--	The time of the hit.
+	loadTime	--	The time in seconds that it took to load the entry.
+	"""
+
+	entry = index['entries'].get(name)
+	path = os.path.join(cacheFolder, name)
+	if entry == None and os.path.exists(path):
+		entry = _newEntry(path)
+		index['entries'][name] = entry
+	if entry != None:
+		entry['hits'] += 1
+		entry['accessed'] = max(entry['accessed'], t)
+		entry['loadTime'] = loadTime
+		if entry['computeTime'] != None:
+			entry['savedTime'] += max(0., entry['computeTime'] - loadTime)
+	index['hits'] += 1
+
+def _recordMiss(path, computeTime, rawSize):
+
+	"""
+	Registers in the index that an entry was computed and saved to the
+	cache, and prunes the cache if it exceeds `maxCacheSize`.
+
+	Arguments:
+	path		--	The path to the entry.
+	computeTime	--	The time in seconds that it took to compute the entry.
+	rawSize		--	The size of the entry in bytes before compression.
+	"""
+
+	lock = _lock(os.path.join(cacheFolder, indexName))
+	try:
+		index = loadIndex(collectHits=True)
+		name = os.path.relpath(path, cacheFolder)
+		# The entry may have been pruned by another process already
+		if os.path.exists(path):
+			index['entries'][name] = _newEntry(path, computeTime, rawSize)
+		index['misses'] += 1
+		removed = _prune(index, keep=name)
+		if len(removed) > 0:
+			print 'Removed %d entries from the cache' % len(removed)
+		saveIndex(index)
+	finally:
+		_unlock(lock)
+
+def _prune(index, maxBytes=None, keep=None):
+
+	"""
+	Removes the least recently accessed entries from the cache folder until
+	the total size of the cache fits in a budget. The index is updated, but
+	not saved.
+
+	Arguments:
+	index		--	A dictionary as returned by loadIndex().
+
+	Keywords:
+	maxBytes	--	The budget in bytes, or None to use `maxCacheSize`.
+					(default=None)
+	keep		--	The name of an entry that should not be removed, or None.
+					(default=None)
+
+	Returns:
+	A list with the names of the removed entries.
+	"""
+
+	if maxBytes == None:
+		maxBytes = maxCacheSize
+	entries = listEntries(index)
+	size = sum(entry['size'] for entry in entries.values())
+	removed = []
+	for name in sorted(entries, key=lambda name: entries[name]['accessed']):
+		if size <= maxBytes:
+			break
+		if name == keep:
+			continue
+		_removeEntry(os.path.join(cacheFolder, name))
+		if name.endswith('.z'):
+			_removeLock(os.path.join(cacheFolder, name[:-2]))
+		else:
+			_removeLock(os.path.join(cacheFolder, name))
+		size -= entries.pop(name)['size']
+		removed.append(name)
+	index['evictions'] += len(removed)
+	return removed
+
+def _formatSize(n):
+
+	"""
+	Formats a size in bytes for display.
+
+	Arguments:
+	n			--	A size in bytes.
+
+	Returns:
+	A string, such as '12.3 MB'.
+	"""
+
+	for unit in ('B', 'KB', 'MB', 'GB'):
+		if n < 1024:
+			break
+		n /= 1024.
+	else:
+		unit = 'TB'
+	if unit == 'B':
+		return '%d B' % n
+	return '%.1f %s' % (n, unit)
+
+def _formatTime(t):
+
+	"""
+	Formats a duration for display.
+
+	Arguments:
+	t			--	A duration in seconds, or None if unknown.
+
+	Returns:
+	A string, such as '1.23 s'.
+	"""
+
+	if t == None:
+		return '?'
+	return '%.2f s' % t
+
+def _compress(data):
+
+	"""
+	Compresses a serialized entry with zlib, if compression is enabled, the
+	entry is at least `compressMinSize` bytes, and compression reduces the
+	size by at least 20%. Small entries are not compressed, because they
+	load quickly anyway, and poorly compressible entries, such as arrays of
+	random floats, are not compressed, because they would only load more
+	slowly.
+
+	Arguments:
+	data		--	A string of bytes.
+
+	Returns:
+	A compressed string of bytes, or None if the entry should not be
+	compressed.
+	"""
+
+	if not compressCache or len(data) < compressMinSize:
+		return None
+	z = zlib.compress(data, compressLevel)
+	if len(z) > .8*len(data):
+		return None
+	return z
+
+def _writeFile(path, data):
+
+	"""
+	Writes a string of bytes to a file. The file is written to a temporary
+	path and then renamed, so that other processes never see a partial file.
+
+	Arguments:
+	path		--	The path to the file.
+	data		--	A string of bytes.
+	"""
+
+	tmpPath = _tmpPath(path)
+	with open(tmpPath, 'wb') as fd:
+		fd.write(data)
+	os.rename(tmpPath, path)
+
+def _readFile(path):
+
+	"""
+	Reads a file into a string of bytes, and decompresses it if the path
+	ends with `.z`.
+
+	Arguments:
+	path		--	The path to the file.
+
+	Returns:
+	A string of bytes.
+	"""
+
+	with open(path, 'rb') as fd:
+		data = fd.read()
+	if path.endswith('.z'):
+		data = zlib.decompress(data)
+	return data
+
+def _saveArray(cachePath, a):
+
+	"""
+	Saves an array as a `.npy` file, which is compressed (`.npy.z`) if this
+	makes the file considerably smaller.
+
+	Arguments:
+	cachePath	--	The path to the `.npy` file.
+	a			--	An array.
+
+	Returns:
+	A (path, size before compression) tuple.
+	"""
+
+	if compressCache and a.nbytes >= compressMinSize:
+		buf = StringIO()
+		np.save(buf, a)
+		data = buf.getvalue()
+		z = _compress(data)
+		if z != None:
+			_writeFile(cachePath + '.z', z)
+			return cachePath + '.z', len(data)
+	tmpPath = _tmpPath(cachePath)
+	with open(tmpPath, 'wb') as fd:
+		np.save(fd, a)
+	os.rename(tmpPath, cachePath)
+	return cachePath, _entrySize(cachePath)
+
+def _loadArray(path):
+
+	"""
+	Loads an array that was saved by _saveArray().
+
+	Arguments:
+	path		--	The path to the entry.
+
+	Returns:
+	An array.
+	"""
+
+	if path.endswith('.z'):
+		return np.load(StringIO(_readFile(path)))
+	return np.load(path)
+
+def _saveDataMatrix(cachePath, dm):
+
+	"""
+	Saves a DataMatrix in the columnar `.dm` format, which preserves the
+	column types and is memory-mapped when it is loaded. Large numeric
+	DataMatrices that compress well are instead pickled and compressed
+	(`.dm.z`). DataMatrices with string columns are always saved as `.dm`,
+	because unpickling string columns is much slower than decoding them from
+	the `.dm` format.
+
+	Arguments:
+	cachePath	--	The path to the `.dm` folder.
+	dm			--	A DataMatrix.
+
+	Returns:
+	A (path, size before compression) tuple.
+	"""
+
+	lCol = [dm[name] for name in dm.columns()]
+	if compressCache and object not in [col.dtype for col in lCol] and \
+		sum(col.nbytes for col in lCol) >= compressMinSize:
+		data = cPickle.dumps(dm, cPickle.HIGHEST_PROTOCOL)
+		z = _compress(data)
+		if z != None:
+			_writeFile(cachePath + '.z', z)
+			return cachePath + '.z', len(data)
+	tmpPath = _tmpPath(cachePath)
+	dm.save(tmpPath)
+	os.rename(tmpPath, cachePath)
+	return cachePath, _entrySize(cachePath)
+
+def _loadDataMatrix(path):
+
+	"""
+	Loads a DataMatrix that was saved by _saveDataMatrix(), or by older
+	versions of exparser as an `.npy` array of strings.
+
+	Arguments:
+	path		--	The path to the entry.
+
+	Returns:
+	A DataMatrix.
+	"""
+
+	if path.endswith('.z'):
+		return cPickle.loads(_readFile(path))
+	return DataMatrix(path)
+
+def _savePickle(cachePath, obj):
+
+	"""
+	Pickles an object with the highest protocol, and compresses it
+	(`.pkl.z`) if this makes the file considerably smaller.
+
+	Arguments:
+	cachePath	--	The path to the `.pkl` file.
+	obj			--	A pickable object.
+
+	Returns:
+	A (path, size before compression) tuple.
+	"""
+
+	data = cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
+	z = _compress(data)
+	if z == None:
+		_writeFile(cachePath, data)
+		return cachePath, len(data)
+	_writeFile(cachePath + '.z', z)
+	return cachePath + '.z', len(data)
+
+def _loadPickle(path):
+
+	"""
+	Loads an object that was saved by _savePickle(), or by older versions of
+	exparser as a text pickle.
+
+	Arguments:
+	path		--	The path to the entry.
+
+	Returns:
+	An object.
+	"""
+
+	return cPickle.loads(_readFile(path))
+
+def _freezeArray(a):
+
+	"""
+	Copies an array for the memory cache, so that the cached array is not
+	affected by changes to the array that is returned to the caller.
+
+	Arguments:
+	a			--	An array.
+
+	Returns:
+	A (copy, size in bytes) tuple.
+	"""
+
+	a = np.array(a)
+	return a, a.nbytes
+
+def _freezeDataMatrix(dm):
+
+	"""
+	Keeps a DataMatrix in the memory cache as a view (see
+	DataMatrix.__getitem__), which shares the columns with the DataMatrix.
+	The view takes its copy of a column only when the column is changed in
+	the DataMatrix, so nothing is copied up front.
+
+	Arguments:
+	dm			--	A DataMatrix.
+
+	Returns:
+	A (view, size in bytes) tuple.
+	"""
+
+	size = sum(dm[name].nbytes for name in dm.columns())
+	return dm[:], size
+
+def _thawDataMatrix(dm):
+
+	"""
+	Gives a DataMatrix from the memory cache as a view, which takes its copy
+	of a column only when the column is accessed. Changes to the view
+	therefore never affect the memory cache.
+
+	Arguments:
+	dm			--	A DataMatrix from the memory cache.
+
+	Returns:
+	A DataMatrix.
+	"""
+
+	return dm[:]
+
+def _freezePickle(obj):
+
+	"""
+	Pickles an object for the memory cache. Unpickling is a fast way to
+	create an independent copy.
+
+	Arguments:
+	obj			--	A pickable object.
+
+	Returns:
+	A (pickle, size in bytes) tuple.
+	"""
+
+	data = cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
+	return data, len(data)
+
+def _cachedCall(decorator, func, args, kwargs, ext, save, load, freeze, thaw,
+	valueType=None, legacyExt=None, ignore=[]):
+
+	"""
+	Calls a function through the cache. If the result has been cached, it is
+	taken from memoryCache or, if it is not in memory, loaded from the cache
+	folder. Otherwise, the function is called and the result is saved to the
+	cache folder. Values in memoryCache are frozen when they are stored and
+	thawed when they are taken, so that callers cannot change them. Memory
+	hits are not registered in the index, so that they remain cheap. Entries
+	are locked while they are computed, so that processes that share the
+	cache folder compute each entry only once.
 
 	Arguments:
+	decorator	--	The name of the decorator, for messages.
 	func		--	A function.
+	args		--	A list of arguments.
+	kwargs		--	A dictionary of keywords.
+	ext			--	The extension of the cache entry.
+	save		--	A function that saves the result to a cache path, and
+					returns the path of the entry and the size before
+					compression. A `.z` may be appended to the path.
+	load		--	A function that loads the result from the path of an
+					entry.
+	freeze		--	A function that copies the result for memoryCache, or
+					otherwise protects it against changes, and returns the
+					frozen value and its size in bytes.
+	thaw		--	A function that gives an independent copy or view of a
+					value from memoryCache.
+
+	Keywords:
+	valueType	--	A (type, description) tuple to check the result, or None.
+					(default=None)
+	legacyExt	--	The extension of entries that were cached by older
+					versions of exparser, or None. (default=None)
+	ignore		--	A list of keywords that are not part of automatic cache
+					keys. (default=[])
+
+	Returns:
+	The result of the function.
+	"""
+
+	cachePath = getCachePath(func, args, kwargs, ext, ignore)
+	if cachePath == None:
+		value = func(*args, **kwargs)
+		_checkType(decorator, value, valueType)
+		return value
+	if not skipCache:
+		frozen = memoryCache.get(cachePath)
+		if frozen is not None:
+			print '%s: loading %s from memory' % (decorator, cachePath)
+			return thaw(frozen)
+		found, value = _loadEntry(decorator, cachePath, load, legacyExt)
+		if found:
+			memoryCache.put(cachePath, *freeze(value))
+			return value
+	# The entry is computed by only one process at a time. Other processes
+	# wait, and then load the entry that has been saved in the meantime.
+	lock = _lock(cachePath)
+	try:
+		if not skipCache:
+			found, value = _loadEntry(decorator, cachePath, load, legacyExt)
+			if found:
+				memoryCache.put(cachePath, *freeze(value))
+				return value
+		t0 = time.time()
+		value = func(*args, **kwargs)
+		_checkType(decorator, value, valueType)
+		computeTime = time.time()-t0
+		# Remove outdated entries, which may have been saved in another
+		# format.
+		for path in _entryPaths(cachePath, legacyExt):
+			_removeEntry(path)
+		path, rawSize = save(cachePath, value)
+		print '%s: saving %s (%s)' % (decorator, path,
+			_formatSize(_entrySize(path)))
+		_recordMiss(path, computeTime, rawSize)
+	finally:
+		_unlock(lock)
+	memoryCache.put(cachePath, *freeze(value))
+	return value
+
+def _entryPaths(cachePath, legacyExt=None):
+
+	"""
+	Gives the paths at which an entry may have been saved.
+
+	Arguments:
+	cachePath	--	The cache path of the entry.
+
+	Keywords:
+	legacyExt	--	The extension of entries that were cached by older
+					versions of exparser, or None. (default=None)
+
+	Returns:
+	A list of paths, in order of preference.
+	"""
+
+	lPath = [cachePath, cachePath + '.z']
+	if legacyExt != None:
+		lPath.append(os.path.splitext(cachePath)[0] + legacyExt)
+	return lPath
+
+def _loadEntry(decorator, cachePath, load, legacyExt=None):
+
 	"""
+	Loads an entry from the cache folder. Entries that cannot be loaded,
+	because they are corrupt or incomplete, are removed, so that they are
+	computed again. Other errors, such as a MemoryError or an ImportError for
+	a pickled class that no longer exists, are raised.
+
+	Arguments:
+	decorator	--	The name of the decorator, for messages.
+	cachePath	--	The cache path of the entry.
+	load		--	A function that loads a value from the path of an entry.
+
+	Keywords:
+	legacyExt	--	The extension of entries that were cached by older
+					versions of exparser, or None. (default=None)
+
+	Returns:
+	A (found, value) tuple. If the entry was not found, the value is None.
+	"""
+
+	for path in _entryPaths(cachePath, legacyExt):
+		if not os.path.exists(path):
+			continue
+		t0 = time.time()
+		try:
+			cTime = time.ctime(os.path.getctime(path))
+		except OSError:
+			# The entry was removed by another process
+			continue
+		try:
+			value = load(path)
+		except (ValueError, EOFError, zlib.error, pickle.UnpicklingError,
+			cPickle.UnpicklingError, IOError) as e:
+			# IOErrors without an errno are raised by numpy for files with an
+			# invalid header or size, and a missing file means that a
+			# DataMatrix folder is incomplete. Other IOErrors, such as
+			# those of an unavailable network drive, are not caused by the
+			# entry.
+			if isinstance(e, IOError) and e.errno not in (None, errno.ENOENT):
+				raise
+			print '%s: removing corrupt entry %s (%s)' % (decorator, path, e)
+			_removeEntry(path)
+			continue
+		loadTime = time.time()-t0
+		print '%s: loading %s (created %s, %.3f s)' % (decorator, path,
+			cTime, loadTime)
+		_recordHit(path, loadTime)
+		return True, value
+	return False, None
+
+def _checkType(decorator, value, valueType):
+
+	"""
+	Checks the type of the result of a cached function.
+
+	Arguments:
+	decorator	--	The name of the decorator, for messages.
+	value		--	The result.
+	valueType	--	A (type, description) tuple, or None to accept any type.
+	"""
+
+	if valueType != None and not isinstance(value, valueType[0]):
+		raise Exception( \
+			'You can use the %s decorator only for functions that return %s.' \
+			% (decorator, valueType[1]))
+
+def cachedArray(func=None, ignore=[]):
+
+	"""
+	A decorator function that provides a cache for functions that return
+	numpy arrays. The decorator is used as `@cachedArray`, or with
+	keywords, for example as `@cachedArray(ignore=['workers'])`.
+
+	Keywords:
+	func		--	A function, or None if the decorator is called with
+					keywords. (default=None)
+	ignore		--	A list of keywords that do not affect the result of the
+					function, such as the number of parallel workers, and
+					that are therefore not part of automatic cache keys.
+					(default=[])
+	"""
+
+	if func == None:
+		return lambda func: cachedArray(func, ignore=ignore)
 
 	def inner(*args, **kwargs):
 
 		isCached = True
-		if 'cacheId' in kwargs:
-			cachePath = os.path.join(cacheFolder, kwargs['cacheId']) + '.npy'
-			del kwargs['cacheId']
-		else:
-			cachePath = None
-		if skipCache or cachePath == None or not os.path.exists(cachePath):
-			dm = func(*args, **kwargs)
-			if not isinstance(dm, DataMatrix):
-				raise Exception( \
-					'You can use the @cachedDataMatrix decorator only for functions that return a DataMatrix.')
-			if cachePath != None:
-				print '@cachedDataMatrix: saving %s' % cachePath
-				dm.save(cachePath)
-		else:
-			cTime = time.ctime(os.path.getctime(cachePath))
-			print '@cachedDataMatrix: loading %s (created %s)' % (cachePath, \
-				cTime)
-			dm = DataMatrix(cachePath)
-		return dm
+		return _cachedCall('@cachedArray', func, args, kwargs, '.npy',
+			_saveArray, _loadArray, _freezeArray, np.array,
+			valueType=(np.ndarray, 'a NumPy array'), ignore=ignore)
 
 	return inner
 
-def cachedPickle(func):
+def cachedDataMatrix(func=None, ignore=[]):
 
 	"""
 	A decorator function that provides a cache for functions that return
-	a pickable value.
+	DataMatrices. The decorator is used as `@cachedDataMatrix`, or with
+	keywords, for example as `@cachedDataMatrix(ignore=['workers'])`.
 
-	Arguments:
-	func		--	A function.
+	Keywords:
+	func		--	A function, or None if the decorator is called with
+					keywords. (default=None)
+	ignore		--	A list of keywords that do not affect the result of the
+					function, such as the number of parallel workers, and
+					that are therefore not part of automatic cache keys.
+					(default=[])
 	"""
 
+	if func == None:
+		return lambda func: cachedDataMatrix(func, ignore=ignore)
+
 	def inner(*args, **kwargs):
 
 		isCached = True
-		if 'cacheId' in kwargs:
-			cachePath = os.path.join(cacheFolder, kwargs['cacheId']) + '.pkl'
-			del kwargs['cacheId']
-		else:
-			cachePath = None
-		if skipCache or cachePath == None or not os.path.exists(cachePath):
-			a = func(*args, **kwargs)
-			if cachePath != None:
-				print '@cachedPickle: saving %s' % cachePath
-				with open(cachePath, u'w') as fd:
-					pickle.dump(a, fd)
-		else:
-			cTime = time.ctime(os.path.getctime(cachePath))
-			print '@cachedPickle: loading %s (created %s)' % (cachePath, cTime)
-			with open(cachePath, u'r') as fd:
-				a = pickle.load(fd)
-		return a
+		return _cachedCall('@cachedDataMatrix', func, args, kwargs, '.dm',
+			_saveDataMatrix, _loadDataMatrix, _freezeDataMatrix,
+			_thawDataMatrix, valueType=(DataMatrix, 'a DataMatrix'),
+			legacyExt='.npy', ignore=ignore)
+
+	return inner
+
+def cachedPickle(func=None, ignore=[]):
+
+	"""
+	A decorator function that provides a cache for functions that return
+	a pickable value. The decorator is used as `@cachedPickle`, or with
+	keywords, for example as `@cachedPickle(ignore=['workers'])`.
+
+	Keywords:
+	func		--	A function, or None if the decorator is called with
+					keywords. (default=None)
+	ignore		--	A list of keywords that do not affect the result of the
+					function, such as the number of parallel workers, and
+					that are therefore not part of automatic cache keys.
+					(default=[])
+	"""
+
+	if func == None:
+		return lambda func: cachedPickle(func, ignore=ignore)
+
+	def inner(*args, **kwargs):
+
+		isCached = True
+		return _cachedCall('@cachedPickle', func, args, kwargs, '.pkl',
+			_savePickle, _loadPickle, _freezePickle, cPickle.loads,
+			ignore=ignore)
 
 	return inner
 
@@ -146,3 +1285,71 @@ def isCached(func):
 	"""
 
 	return 'isCached' in func.func_code.co_varnames
+
+def main(argv):
+
+	"""
+	The command-line interface of the cache, which is used as follows:
+
+		python -m exparser.Cache stats
+		python -m exparser.Cache ls
+		python -m exparser.Cache prune [max size in MB]
+
+	`stats` shows the size of the cache, the hit rate, and the total compute
+	time that was saved. `ls` lists the entries, starting with the most
+	recently accessed entry, with their size on disk, their compression
+	ratio, and their compute and load times. `prune` removes the least
+	recently accessed entries until the cache fits in the specified size, or
+	in `maxCacheSize`.
+
+	Arguments:
+	argv		--	A list of command-line arguments, without the name of the
+					script.
+	"""
+
+	if len(argv) == 0 or argv[0] not in ('stats', 'ls', 'prune'):
+		print 'Usage: python -m exparser.Cache stats|ls|prune [max size in MB]'
+		return
+	if argv[0] == 'stats':
+		d = stats()
+		print 'Cache folder:  %s' % os.path.abspath(cacheFolder)
+		print 'Entries:       %d' % d['entries']
+		print 'Size:          %s of %s (%s uncompressed)' % ( \
+			_formatSize(d['size']), _formatSize(d['maxSize']),
+			_formatSize(d['rawSize']))
+		print 'Hits:          %d' % d['hits']
+		print 'Misses:        %d' % d['misses']
+		print 'Hit rate:      %.1f%%' % (100*d['hitRate'])
+		print 'Evictions:     %d' % d['evictions']
+		print 'Time saved:    %.1f s' % d['savedTime']
+	elif argv[0] == 'ls':
+		index = loadIndex()
+		entries = listEntries(index)
+		print '%-10s %6s %6s %10s %10s %10s %-16s %s' % ('size', 'ratio',
+			'hits', 'compute', 'load', 'saved', 'accessed', 'name')
+		for name in sorted(entries, key=lambda name: entries[name]['accessed'],
+			reverse=True):
+			entry = entries[name]
+			if entry['rawSize'] == None or entry['size'] == 0:
+				ratio = '?'
+			else:
+				ratio = '%.2f' % (float(entry['rawSize'])/entry['size'])
+			print '%-10s %6s %6d %10s %10s %10s %-16s %s' % ( \
+				_formatSize(entry['size']), ratio, entry['hits'],
+				_formatTime(entry['computeTime']),
+				_formatTime(entry['loadTime']),
+				_formatTime(entry['savedTime']),
+				time.strftime('%Y-%m-%d %H:%M',
+				time.localtime(entry['accessed'])), name)
+	else:
+		if len(argv) > 1:
+			maxBytes = int(float(argv[1])*1024**2)
+		else:
+			maxBytes = None
+		removed = prune(maxBytes)
+		for name in removed:
+			print 'Removed %s' % name
+		print 'Removed %d entries' % len(removed)
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -55,6 +55,7 @@ class CsvFolderReader(BaseReader):
 
 		print 'Scanning \'%s\'' % path
 		self.dm = None
+		lDm = []
 		l = sorted(os.listdir(path))
 		if maxN != None:
 			l = l[:maxN]
@@ -77,11 +78,11 @@ class CsvFolderReader(BaseReader):
 					except:
 						print 'Trying again ...'
 				dm['__src__'] = fname
-				if self.dm == None:
-					self.dm = dm
-				else:
-					self.dm += dm
+				lDm.append(dm)
 				print '(%d rows)' % len(dm)
+		# Concatenate all files at once, rather than one by one
+		if len(lDm) > 0:
+			self.dm = DataMatrix.concat(lDm)
 
 	def dataMatrix(self):
 
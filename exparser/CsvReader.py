@@ -39,7 +39,7 @@ class CsvReader(BaseReader):
 		l = []
 		for row in reader:
 			l.append(row)
-		self.m = np.array(l, dtype='|S128')
+		self.m = np.array(l, dtype=str)
 
 	def dataMatrix(self):
 
@@ -15,8 +15,13 @@ You should have received a copy of the GNU General Public License
 along with exparser.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import os
 import sys
+import json
+import cPickle
+import hashlib
 import types
+import weakref
 import warnings
 import numpy as np
 from numpy import ma
@@ -25,10 +30,136 @@ from scipy.spatial.distance import cdist
 from scipy import stats
 from scipy.stats.stats import nanmean, nanstd, nanmedian
 from copy import deepcopy
+from collections import OrderedDict
 from itertools import product
 from exparser.BaseMatrix import BaseMatrix
 from exparser.PivotMatrix import PivotMatrix
 from exparser import Constants
+from exparser.Query import compileQuery
+
+def registerAggregation(name, func, vectorized=False):
+
+	"""
+	desc: |
+		Registers an aggregation, which is calculated by
+		[DataMatrix.collapse] and stored in a column with the same name.
+		Registering an aggregation with an existing name replaces the existing
+		aggregation.
+
+	arguments:
+		name:
+			desc:	The name of the aggregation.
+			type:	[str, unicode]
+		func:
+			desc:	If `vectorized` is False, a function that takes an array
+					with the values for a single group, and returns a single
+					value. If `vectorized` is True, a function that takes an
+					array with all values sorted by group and an array with
+					the start position of each group, and returns an array
+					with one value per group.
+			type:	function
+
+	keywords:
+		vectorized:
+			desc:	Indicates whether `func` processes all groups at once.
+			type:	bool
+
+	example: |
+		registerAggregation('max', lambda a, starts: \
+			np.maximum.reduceat(a, starts), vectorized=True)
+	"""
+
+	aggregationRegistry[name] = func, vectorized
+
+def _aggCount(a, starts):
+
+	"""
+	Arguments:
+	a		--	An array with values, sorted by group.
+	starts	--	The start positions of the groups.
+
+	Returns:
+	The number of values per group, including nan values.
+	"""
+
+	return np.diff(np.append(starts, len(a)))
+
+def _aggValidCount(a, starts):
+
+	"""
+	Returns:
+	The number of non-nan values per group. See _aggCount().
+	"""
+
+	return np.add.reduceat(~np.isnan(a), starts)
+
+def _aggMean(a, starts):
+
+	"""
+	Returns:
+	The mean of the non-nan values per group. See _aggCount().
+	"""
+
+	return np.add.reduceat(np.where(np.isnan(a), 0, a), starts) \
+		/ _aggValidCount(a, starts)
+
+def _aggMedian(a, starts):
+
+	"""
+	Returns:
+	The median of the non-nan values per group. See _aggCount().
+	"""
+
+	# Sort by value within each group. Nan values end up at the end of each
+	# group, so the median lies between the positions (n-1)/2 and n/2, where n
+	# is the number of non-nan values.
+	groupId = np.repeat(np.arange(len(starts)), _aggCount(a, starts))
+	a = a[np.lexsort((a, groupId))]
+	n = _aggValidCount(a, starts)
+	empty = n == 0
+	i1 = starts + np.where(empty, 0, (n-1)/2)
+	i2 = starts + np.where(empty, 0, n/2)
+	median = (a[i1] + a[i2]) / 2.
+	median[empty] = np.nan
+	return median
+
+def _aggStd(a, starts):
+
+	"""
+	Returns:
+	The unbiased standard deviation of the non-nan values per group, like
+	scipy.stats.nanstd(). See _aggCount().
+	"""
+
+	dev = a - np.repeat(_aggMean(a, starts), _aggCount(a, starts))
+	ss = np.add.reduceat(np.where(np.isnan(dev), 0, dev**2), starts)
+	return np.sqrt(ss / np.maximum(_aggValidCount(a, starts) - 1, 0))
+
+def _aggSe(a, starts):
+
+	"""
+	Returns:
+	The standard error per group. See _aggCount().
+	"""
+
+	return _aggStd(a, starts) / np.sqrt(_aggCount(a, starts))
+
+def _aggCi95(a, starts):
+
+	"""
+	Returns:
+	The 95% confidence interval per group. See _aggCount().
+	"""
+
+	return 1.96 * _aggSe(a, starts)
+
+aggregationRegistry = OrderedDict()
+registerAggregation('mean', _aggMean, vectorized=True)
+registerAggregation('median', _aggMedian, vectorized=True)
+registerAggregation('std', _aggStd, vectorized=True)
+registerAggregation('se', _aggSe, vectorized=True)
+registerAggregation('95ci', _aggCi95, vectorized=True)
+registerAggregation('count', _aggCount, vectorized=True)
 
 class DataMatrix(BaseMatrix):
 
@@ -37,7 +168,7 @@ class DataMatrix(BaseMatrix):
 		Provides functionality for convenient processing of experimental data.
 	"""
 
-	def __init__(self, a, structured=False):
+	def __init__(self, a, structured=False, schema=None):
 
 		"""
 		desc: |
@@ -48,7 +179,8 @@ class DataMatrix(BaseMatrix):
 				desc:	A NumPy array, list, or filename. For unstructured
 						NumPy arrays or lists, the first row is assumed to
 						contain column names. Filenames are assumed to refer to
-						a `.npy` file.
+						a `.npy` file, or to a folder that was saved in the
+						columnar format (see [DataMatrix.save]).
 				type:	[ndarray, list, str, unicode]
 
 
@@ -56,10 +188,28 @@ class DataMatrix(BaseMatrix):
 			structured:
 				desc:	Indicates whether `a` is a structured NumPy array.
 				type:	bool
+			schema:
+				desc:	A dict or a list of (name, dtype) tuples, such as
+						returned by `columns(dtype=True)`, that specifies the
+						dtype of columns. The types of columns that are in the
+						schema are not inferred from the data.
+				type:	[dict, list, NoneType]
+
+		example: |
+			dm = DataMatrix(a, schema={'subject_nr' : int,
+				'response_time' : float})
 		"""
 
+		if schema == None:
+			schema = {}
+		else:
+			schema = dict(schema)
+
 		# Load from disk
 		if isinstance(a, basestring):
+			if os.path.isdir(a):
+				self._setColumns(_loadColumns(a))
+				return
 			a = np.load(a)
 
 		# Try to convert lists to arrays
@@ -69,61 +219,376 @@ class DataMatrix(BaseMatrix):
 		# If a structured array was passed, we still need to convert it, to
 		# choose the optimal data type for each column.
 		if structured:
-			dtype = []
-			for i in range(len(a.dtype.names)):
-				vName = a.dtype.names[i]
+			cols = OrderedDict()
+			for vName in a.dtype.names:
 				try:
-					np.array(a[vName], dtype=np.float64)
-					dtype.append( (vName, np.float64) )
-				except:
-					dtype.append( (vName, Constants.strDType) )
-			try:
-				self.m = np.array(a, dtype=dtype)
-			except Exception as e:
-				raise Exception('Failed to convert %s (original exception %s)' \
-					% (a, e))
+					if vName in schema:
+						cols[vName] = _schemaColumn(a[vName], schema[vName])
+						continue
+					try:
+						cols[vName] = np.array(a[vName], dtype=np.float64)
+					except (ValueError, TypeError):
+						cols[vName] = _encodeStrings(a[vName])
+				except Exception as e:
+					raise Exception( \
+						'Failed to convert %s (original exception %s)' \
+						% (a, e))
+			self._setColumns(cols)
 			return
 
-		# Extract the variable names (first row) and values (the rest)
-		vNames = a[0]
+		# Extract the variable names (first row) and values (the rest), and
+		# convert the values column by column.
+		vNames = a[0].tolist()
 		vVals = a[1:]
-		_vVals = vVals.swapaxes(0,1)
-
-		# Determine the appropriate dtype for each column
-		dtype = []
+		cols = OrderedDict()
 		for i in range(len(vNames)):
-			try:
-				for v in _vVals[i]: int(v)
-				dtype.append( (vNames[i], np.int32) )
-			except:
-				try:
-					for v in _vVals[i]: float(v)
-					dtype.append( (vNames[i], np.float64) )
-				except:
-					dtype.append( (vNames[i], Constants.strDType) )
+			vName = vNames[i]
+			if vName in schema:
+				cols[vName] = _schemaColumn(vVals[:,i], schema[vName])
+			else:
+				cols[vName] = _inferColumn(vVals[:,i])
+		self._setColumns(cols)
 
-		# Fill the structured array row by row
-		self.m = np.zeros( len(vVals), dtype=dtype)
-		for i in range(len(vVals)):
-			try:
-				self.m[i] = tuple(vVals[i])
-			except:
-				for j in range(len(vVals[i])):
-					try:
-						self.m[i][j] = vVals[i][j]
-					except:
-						self.m[i][j] = 0
-						warnings.warn( \
-							"Column %d is not numeric but '%s'. Falling back to 0" \
-							% (j, vVals[i][j]))
+	@property
+	def m(self):
 
-	def __getitem__(self, key):
+		"""
+		desc: |
+			A structured NumPy array with all data. The data is stored as a
+			dict of columns, and the structured array is only built when it is
+			accessed. After that, the numeric columns are views of the
+			structured array, so that changes through either are visible in
+			both. String columns are stored as codes (see
+			[DataMatrix.columns]), so the structured array holds a copy of
+			their values. The string fields and the string columns are kept in
+			sync: changes to a string field are passed on to the column when
+			the column or the structured array is accessed, and changes to a
+			string column are passed on to the field when the structured
+			array is accessed. To find changes, a string field is compared
+			to a copy of its values, so accessing string columns is slower
+			after the structured array has been built.
+
+		returns:
+			type:	ndarray
+		"""
+
+		if self._m is None:
+			self._materialize()
+			m = np.empty(len(self), dtype=[(name, col.dtype) \
+				for name, col in self._cols.items()])
+			cols = OrderedDict()
+			for name, col in self._cols.items():
+				if isinstance(col, StringColumn):
+					m[name] = col.decode()
+					cols[name] = col
+				else:
+					m[name] = col
+					cols[name] = m[name]
+			self._setColumns(cols)
+			self._setStructured(m)
+			return m
+		if len(self._shared) > 0:
+			# The columns are views of the structured array, which may be
+			# changed in place.
+			self._detach()
+		self._syncStructured()
+		return self._m
+
+	@m.setter
+	def m(self, m):
 
 		"""
 		desc:
-			Returns a column, index, or slice. Note that some operations return
-			a copy of the DataMatrix, so they cannot be used to modify the
-			contents of the DataMatrix.
+			Replaces all data by a structured NumPy array.
+
+		arguments:
+			m:
+				desc:	A structured array.
+				type:	ndarray
+		"""
+
+		cols = OrderedDict()
+		for name in m.dtype.names:
+			if m.dtype[name] == object:
+				cols[name] = _encodeStrings(m[name])
+			else:
+				cols[name] = m[name]
+		self._setColumns(cols)
+		self._setStructured(m)
+
+	def _setStructured(self, m):
+
+		"""
+		Keeps a structured array that has been built from, or is the source
+		of, the current columns, and remembers which version of each string
+		column it holds.
+
+		Arguments:
+		m -- a structured array
+		"""
+
+		self._m = m
+		self._mVersions = dict((name, col.version) for name, col in \
+			self._cols.items() if isinstance(col, StringColumn))
+		self._mStrings = dict((name, m[name].copy()) for name in \
+			self._mVersions)
+
+	def _syncStructured(self, names=None):
+
+		"""
+		Keeps the string fields of the structured array in sync with the
+		string columns. Changes to the string fields are found by comparing
+		them to a copy of their values, and are passed on to the columns.
+		After that, the fields of columns that have changed are updated.
+
+		Keyword arguments:
+		names -- a list of column names, or None for all string columns
+				 (default=None)
+		"""
+
+		if self._m is None:
+			return
+		if names is None:
+			names = self._mVersions.keys()
+		for name in names:
+			if name not in self._mVersions:
+				continue
+			col = self._cols[name]
+			field = self._m[name]
+			copy = self._mStrings[name]
+			stale = col.version != self._mVersions[name]
+			changed = np.flatnonzero(np.asarray(field != copy, dtype=bool))
+			# Values that are not equal to themselves, such as nan, have not
+			# changed if they are still the same object.
+			changed = [i for i in changed if field[i] is not copy[i]]
+			if len(changed) > 0:
+				# Views should not see the change.
+				if id(col) in self._shared:
+					self._detach(col)
+				col.decode()[changed] = field[changed]
+				copy[changed] = field[changed]
+			if stale:
+				self._m[name] = col.decode()
+				self._mStrings[name] = self._m[name].copy()
+			self._mVersions[name] = col.version
+
+	def _setColumns(self, cols):
+
+		"""
+		Replaces all data by a dict of columns. Views of the current
+		DataMatrix remain registered, because the new columns may include
+		columns that the views still refer to. Object arrays are encoded as
+		string columns.
+
+		Arguments:
+		cols -- an OrderedDict of 1-D numpy arrays and StringColumns
+		"""
+
+		for name, col in cols.items():
+			if isinstance(col, np.ndarray) and col.dtype == object:
+				cols[name] = _encodeStrings(col)
+		self._m = None
+		self._cols = cols
+		self._baseCols = None
+		self._index = None
+		self._root = None
+		if not hasattr(self, '_views'):
+			self._views = weakref.WeakSet()
+			self._shared = set()
+
+	def _col(self, name):
+
+		"""
+		Gets a column. String columns are decoded (see StringColumn).
+
+		Arguments:
+		name -- a column name
+
+		Returns:
+		A 1-D numpy array.
+		"""
+
+		col = self._storedCol(name)
+		if isinstance(col, StringColumn):
+			return col.decode()
+		return col
+
+	def _storedCol(self, name, detach=True):
+
+		"""
+		Gets a column as it is stored. If the current DataMatrix is a view,
+		the column is taken from the base columns first. Otherwise, the column
+		may be changed in place by the caller, so views that still refer to
+		the column take their copy of it first.
+
+		Arguments:
+		name -- a column name
+
+		Keyword arguments:
+		detach -- indicates whether views should take their copy of the
+				  column. This is not necessary if the column is only read.
+				  (default=True)
+
+		Returns:
+		A 1-D numpy array or a StringColumn.
+		"""
+
+		if self._baseCols != None:
+			if name not in self._cols:
+				self._cols[name] = self._baseCols[name][self._index]
+			return self._cols[name]
+		if self._m is not None:
+			self._syncStructured([name])
+		col = self._cols[name]
+		if detach and id(col) in self._shared:
+			self._detach(col)
+		return col
+
+	def _stringCodes(self, name):
+
+		"""
+		Gives access to the codes of a string column, for example to compare
+		the values of a column in a query without decoding it.
+
+		Arguments:
+		name -- a column name
+
+		Returns:
+		A (codes, StringLevels) tuple for string columns, or None for numeric
+		columns. The codes should not be changed.
+		"""
+
+		col = self._storedCol(name, detach=False)
+		if isinstance(col, StringColumn):
+			return col.codes, col.levels
+		return None
+
+	def _detach(self, col=None):
+
+		"""
+		Lets the views of the current DataMatrix take their copy of a column,
+		or of all columns, before it can be changed in place, so that views
+		never see later changes to the current DataMatrix. Only the rows of
+		the views are copied.
+
+		Keyword arguments:
+		col -- a column, or None for all columns (default=None)
+		"""
+
+		for view in list(self._views):
+			if view._baseCols == None:
+				continue
+			for name, _col in view._baseCols.items():
+				if (col is None or _col is col) and name not in view._cols:
+					view._cols[name] = _col[view._index]
+		if col is None:
+			self._shared.clear()
+		else:
+			self._shared.discard(id(col))
+
+	def _materialize(self):
+
+		"""
+		Turns a view into a regular DataMatrix by taking all columns that
+		have not been taken yet from the base columns. For a regular
+		DataMatrix, changes to the string fields of the structured array are
+		passed on to the columns, so that all columns are up to date.
+		"""
+
+		if self._baseCols == None:
+			self._syncStructured()
+			return
+		cols = OrderedDict()
+		for name in self._baseCols:
+			cols[name] = self._storedCol(name)
+		self._setColumns(cols)
+
+	def _copyColumns(self, copy=True):
+
+		"""
+		Arguments:
+		copy -- indicates whether the columns should be copied, or only the
+				dict that contains them.
+
+		Returns:
+		An OrderedDict with the columns.
+		"""
+
+		self._materialize()
+		if not copy and len(self._shared) > 0:
+			# The columns will be shared with a new DataMatrix, through which
+			# they may be changed in place.
+			self._detach()
+		cols = OrderedDict()
+		for name, col in self._cols.items():
+			if isinstance(col, StringColumn):
+				if copy:
+					col = col.copy()
+			elif copy:
+				col = np.copy(col)
+			cols[name] = col
+		return cols
+
+	def _selectRows(self, index):
+
+		"""
+		Selects rows. The result is a view, which holds the columns of the
+		current DataMatrix and an array of row indices. Columns are only
+		taken from the view when they are accessed, and views of views
+		compose their indices, so that nested selections only copy the
+		columns that have been accessed. Views are registered with the
+		DataMatrix that holds the columns, which lets the views take their
+		copy of a column before it can be changed (see _detach()).
+
+		Arguments:
+		index -- an index, slice, list of indices or boolean mask
+
+		Returns:
+		A DataMatrix
+		"""
+
+		if isinstance(index, slice):
+			index = np.arange(*index.indices(len(self)))
+		else:
+			index = np.asarray(index)
+			if index.dtype == bool:
+				index = np.flatnonzero(index)
+		dm = DataMatrix.__new__(DataMatrix)
+		if self._baseCols == None:
+			self._syncStructured()
+			dm._setColumns(OrderedDict())
+			dm._baseCols = OrderedDict(self._cols)
+			dm._index = index
+			dm._root = weakref.ref(self)
+			self._views.add(dm)
+			self._shared.update(id(col) for col in self._cols.values())
+			return dm
+		# Columns that have already been taken by the current view may have
+		# been modified, so they are carried over. The other columns are still
+		# taken from the base columns.
+		cols = OrderedDict()
+		for name, col in self._cols.items():
+			cols[name] = col[index]
+		dm._setColumns(cols)
+		dm._baseCols = self._baseCols
+		dm._index = self._index[index]
+		dm._root = self._root
+		root = self._root()
+		if root is not None:
+			root._views.add(dm)
+		return dm
+
+	def __getitem__(self, key):
+
+		"""
+		desc: |
+			Returns a column, index, or slice. Selecting rows gives a view on
+			the current DataMatrix. Columns are copied from the current
+			DataMatrix only when they are accessed by the view, or when they
+			may be changed in the current DataMatrix. A view behaves like a
+			copy: changes to the view are never visible in the current
+			DataMatrix, and later changes to the current DataMatrix are never
+			visible in the view.
 
 		example: |
 			dm['rt'] # returns column 'rt' as numpy array
@@ -143,15 +608,13 @@ class DataMatrix(BaseMatrix):
 			type:	[DataMatrix, ndarray]
 		"""
 
-		if type(key) == int or type(key) == np.int64:
-			a = np.array(self.m[key])
-			a.shape = (1,)
-			return DataMatrix(a, structured=True)
+		if isinstance(key, (int, np.integer)):
+			return self._selectRows([key])
 		elif isinstance(key, basestring):
-			return self.m[key]
+			return self._col(key)
 		elif isinstance(key, slice) or isinstance(key, list) \
 			or isinstance(key, np.ndarray):
-			return DataMatrix(self.m[key], structured=True)
+			return self._selectRows(key)
 		else:
 			raise Exception('Cannot get %s (%s)' % (key, type(key)))
 
@@ -163,7 +626,48 @@ class DataMatrix(BaseMatrix):
 			type:	int
 		"""
 
-		return len(self.m)
+		if self._m is not None:
+			return len(self._m)
+		if self._baseCols != None:
+			return len(self._index)
+		if len(self._cols) == 0:
+			return 0
+		return len(self._cols.values()[0])
+
+	def __getstate__(self):
+
+		"""
+		The structured array is not part of the state, because the columns may
+		be views of it, and pickle and deepcopy do not preserve views. Views
+		are materialized first.
+
+		Returns:
+		The state for pickling and copying.
+		"""
+
+		self._materialize()
+		state = self.__dict__.copy()
+		for key in ('_m', '_mVersions', '_mStrings', '_root', '_views',
+			'_shared'):
+			state.pop(key, None)
+		return state
+
+	def __setstate__(self, state):
+
+		"""
+		Restores the state, also from DataMatrices that were pickled before
+		the data was stored as columns, or before string columns were stored
+		as codes.
+
+		Arguments:
+		state -- the state
+		"""
+
+		if 'm' in state:
+			self.m = state.pop('m')
+			state['_cols'] = self._cols
+		self.__dict__.update(state)
+		self._setColumns(self._cols)
 
 	def __add__(self, dm, cautious=False):
 
@@ -187,22 +691,7 @@ class DataMatrix(BaseMatrix):
 			type:	DataMatrix
 		"""
 
-		cols = np.intersect1d(self.columns(), dm.columns())
-		a = np.zeros( (1+len(self)+len(dm), len(cols)), dtype='|S128')
-		i = 0
-		for col in cols:
-			a[0, i] = str(col)
-			if self[col].dtype != dm[col].dtype:
-				warnings.warn( \
-					'%s has non-matching types (%s and %s)' \
-					% (col, self[col].dtype, dm[col].dtype))
-				a1 = np.array(self[col], dtype='|S128')
-				a2 = np.array(dm[col], dtype='|S128')
-				a[1:, i] = np.concatenate( (a1, a2) )
-			else:
-				a[1:, i] = np.concatenate( (self[col], dm[col]) )
-			i += 1
-		return DataMatrix(a)
+		return DataMatrix.concat([self, dm])
 
 	def __setitem__(self, key, val):
 
@@ -222,7 +711,7 @@ class DataMatrix(BaseMatrix):
 			dm['rt'] = 100
 		"""
 
-		self.m[key] = val
+		self._col(key)[...] = val
 
 	def __iter__(self):
 
@@ -241,7 +730,7 @@ class DataMatrix(BaseMatrix):
 
 		return DataMatrixIterator(self)
 
-	def addField(self, key, dtype=np.int32, default=None):
+	def addField(self, key, dtype=np.int32, default=None, copy=True):
 
 		"""
 
@@ -249,18 +738,20 @@ class DataMatrix(BaseMatrix):
 			Creates a new DataMatrix that is a copy of the current DataMatrix
 			with an additional field.
 
-		source:
-			http://stackoverflow.com/questions/1201817/\
-			adding-a-field-to-a-structured-numpy-array>
-
 		arguments:
 			key:
 				desc:	The name of the new field.
 				type:	[str, unicode]
 
 		keywords:
-			dtype:		The dtype for the new field.
+			dtype:		The dtype for the new field. String columns (`str` or
+						`object`) are stored as described under
+						[DataMatrix.columns].
 			default:	The default value or `None` for no default.
+			copy:		Indicates whether the existing columns are copied. If
+						not, the new DataMatrix shares the existing columns
+						with the current DataMatrix, and only the new column is
+						allocated.
 
 		example: |
 			dm = dm.addField('rt', dtype=float, default=-1000)
@@ -271,10 +762,12 @@ class DataMatrix(BaseMatrix):
 
 		if key in self.columns():
 			raise Exception('field "%s" already exists' % key)
-		a = np.zeros(self.m.shape, dtype=self.m.dtype.descr + [(key, dtype)])
-		for name in self.m.dtype.names:
-			a[name] = self.m[name]
-		dm = DataMatrix(a, structured=True)
+		cols = self._copyColumns(copy)
+		if _isStrType(dtype):
+			cols[key] = _encodeStrings(np.zeros(len(self), dtype=str))
+		else:
+			cols[key] = np.zeros(len(self), dtype=dtype)
+		dm = _fromColumns(cols)
 		if default != None:
 			dm[key] = default
 		return dm
@@ -290,7 +783,7 @@ class DataMatrix(BaseMatrix):
 		l = [list(self.m.dtype.names)]
 		for row in self.m:
 			l.append(list(row))
-		return np.array(l, dtype='|S128')
+		return np.array(l, dtype=str)
 
 	def balance(self, key, maxErr, ref=0, verbose=False):
 
@@ -406,7 +899,7 @@ class DataMatrix(BaseMatrix):
 		print "targetVName = ", targetVName
 
 		if keys != None:
-			l = [list(self.m.dtype.names)]
+			l = [self.columns()]
 			for dm in self.group(keys):
 				dm = dm.calcPerc(vName, targetVName, nBin=nBin)
 				for row in dm.m:
@@ -415,7 +908,7 @@ class DataMatrix(BaseMatrix):
 
 		dm = DataMatrix(self.m, structured=True)
 		for row in dm.m:
-			p = stats.percentileofscore(self.m[vName], row[vName])
+			p = stats.percentileofscore(self[vName], row[vName])
 			if nBin != None:
 				binSize = 100./nBin
 				try:
@@ -425,22 +918,50 @@ class DataMatrix(BaseMatrix):
 			row[targetVName] = p
 		return dm
 
-	def collapse(self, keys, vName):
+	def clone(self):
+
+		"""
+		desc:
+			Creates a copy of the DataMatrix. This is equivalent to, but much
+			faster than, a deep copy, because the cells of string columns are
+			immutable and therefore do not need to be copied.
+
+		returns:
+			type:	DataMatrix
+		"""
+
+		return _fromColumns(self._copyColumns())
+
+	def collapse(self, keys, vName, aggregations=None):
 
 		"""
 		desc:
 			Collapse the data by a (list of) keys and get statistics on a
-			dependent variable.
+			dependent variable. All statistics are calculated in a single
+			vectorized pass over the groups (see [DataMatrix.groupIndex]).
 
 		arguments:
 			keys:
 				desc:	A key or list of keys to collapse the data on.
 				type:	[list, str, unicode]
 			vName:
-				desc:	The dependent variable to collapse. Alternative, you can
-						specifiy a function, in which case the error will be 0.
+				desc:	The dependent variable to collapse. Alternatively, you
+						can specify a function, which is called with each
+						group. Its result is stored in the `mean` column, and
+						all other statistics except the count are then `nan`.
 				type:	[str, unicode, function]
 
+		keywords:
+			aggregations:
+				desc:	A list of names of aggregations (see
+						[registerAggregation]) to calculate, or `None` to
+						calculate all registered aggregations.
+				type:	[list, NoneType]
+
+		example: |
+			dm.collapse(['subject_nr', 'cond'], 'rt', aggregations=['mean',
+				'count'])
+
 		returns:
 			desc:	A DataMatrix with the collapsed data, with the descriptives
 					statistics on `vName`.
@@ -449,36 +970,58 @@ class DataMatrix(BaseMatrix):
 
 		if isinstance(keys, basestring):
 			keys = [keys]
-
-		m = [keys + ['mean', 'median', 'std', 'se', '95ci', 'count']]
-		for g in self.group(keys):
-			l = []
-			for key in keys:
-				l.append(g[key][0])
-			if type(vName) == types.FunctionType:
-				l.append(vName(g))
-				l.append(np.nan)
-				l.append(np.nan)
-				l.append(np.nan)
-				l.append(np.nan)
-				l.append(len(g))
-			else:
-				a = g[vName]
-				l.append(nanmean(a))
-				l.append(nanmedian(a))
-				l.append(nanstd(a))
-				l.append(nanstd(a)/np.sqrt(a.size))
-				l.append(1.96*nanstd(a)/np.sqrt(a.size))
-				l.append(a.size)
-			m.append(l)
-		return DataMatrix(m)
+		if aggregations == None:
+			aggregations = aggregationRegistry.keys()
+		for name in aggregations:
+			if name not in aggregationRegistry:
+				raise Exception('Unknown aggregation "%s"' % name)
+		order, starts = self.groupIndex(keys)
+		dtype = [(key, self[key].dtype) for key in keys]
+		dtype += [(name, np.float64) for name in aggregations]
+		if 'count' in aggregations:
+			dtype[len(keys)+aggregations.index('count')] = ('count', np.int32)
+		if type(vName) == types.FunctionType and 'mean' not in aggregations:
+			dtype.append(('mean', np.float64))
+		m = np.zeros(len(starts), dtype=dtype)
+		for key in keys:
+			m[key] = self[key][order[starts]]
+		if type(vName) == types.FunctionType:
+			# A function can only be applied group by group, and its result is
+			# stored as the mean. Except for the count, the other statistics
+			# are undefined.
+			for name in aggregations:
+				m[name] = np.nan
+			for i, g in enumerate(self.group(keys)):
+				m['mean'][i] = vName(g)
+			if 'count' in aggregations:
+				m['count'] = np.diff(np.append(starts, len(order)))
+			return _fromArray(m)
+		a = np.array(self[vName][order], dtype=np.float64)
+		with np.errstate(divide='ignore', invalid='ignore'):
+			for name in aggregations:
+				func, vectorized = aggregationRegistry[name]
+				if vectorized:
+					m[name] = func(a, starts)
+				else:
+					ends = np.append(starts[1:], len(a))
+					m[name] = [func(a[i:j]) for i, j in zip(starts, ends)]
+		return _fromArray(m)
 
 	def columns(self, dtype=False):
 
 		"""
-		desc:
+		desc: |
 			Returns a list of the columns.
 
+			String columns have the `object` dtype (`'|O'`), and can hold
+			strings of any length. They are stored as an int32 code for each
+			cell and a table of the distinct values, or levels, of the column.
+			Queries (see [DataMatrix.select]), [DataMatrix.group], and
+			[DataMatrix.unique] work directly on the codes. A string column is
+			decoded into an object array when it is accessed as `dm[name]`,
+			and changes to this array are passed on to the codes. The values
+			of a string column must be hashable.
+
 		keywords:
 			dtype:
 				desc:	Indicates whether the dtype for each column should be
@@ -492,9 +1035,93 @@ class DataMatrix(BaseMatrix):
 			type:	list
 		"""
 
+		if self._baseCols != None:
+			cols = self._baseCols
+		else:
+			cols = self._cols
 		if dtype:
-			return self.m.dtype.descr
-		return list(self.m.dtype.names)
+			return [(name, col.dtype.str) for name, col in cols.items()]
+		return cols.keys()
+
+	def fingerprint(self):
+
+		"""
+		desc: |
+			Computes a fingerprint of the DataMatrix, which changes whenever
+			the column names, column types, or values change. Numeric columns
+			are hashed directly from their buffers, and string columns from
+			their joined values. This is used to recognize input data, for
+			example by the `exparser.Cache` decorators.
+
+		example: |
+			if dm.fingerprint() != oldFingerprint:
+				print 'The data has changed'
+
+		returns:
+			desc:	An md5 hex digest.
+			type:	str
+		"""
+
+		md5 = hashlib.md5()
+		md5.update('%d\x00' % len(self))
+		for name in self.columns():
+			col = self._col(name)
+			md5.update('%s\x00%s\x00' % (name, col.dtype.str))
+			if col.dtype == object:
+				try:
+					md5.update('\x00'.join(col.tolist()))
+				except (TypeError, UnicodeError):
+					md5.update(repr(col.tolist()))
+			else:
+				md5.update(np.ascontiguousarray(col))
+		return md5.hexdigest()
+
+	@staticmethod
+	def concat(l):
+
+		"""
+		desc: |
+			Concatenates a list of DataMatrices in one go. Only the columns
+			that occur in all DataMatrices are kept. Each column keeps its
+			type, or is promoted to a type that can hold all values, for
+			example when an int column is concatenated with a float column.
+			Numeric columns that are concatenated with string columns are
+			converted to strings.
+
+		arguments:
+			l:
+				desc:	A list of DataMatrices.
+				type:	list
+
+		example: |
+			dm = DataMatrix.concat([dm1, dm2, dm3])
+
+		returns:
+			desc:	The concatenation of all DataMatrices.
+			type:	DataMatrix
+		"""
+
+		if len(l) == 0:
+			raise Exception('Cannot concatenate an empty list of DataMatrices')
+		cols = set(l[0].columns())
+		for dm in l[1:]:
+			cols &= set(dm.columns())
+		# Each column is concatenated in one go. np.concatenate() promotes
+		# numeric types as needed.
+		_cols = OrderedDict()
+		for col in sorted(cols):
+			lCol = [dm._storedCol(col, detach=False) for dm in l]
+			lStr = [_isStrType(a.dtype) for a in lCol]
+			if any(lStr):
+				if not all(lStr):
+					warnings.warn('%s has non-matching types (%s)' % (col,
+						', '.join(sorted(set([a.dtype.str for a in lCol])))))
+				lCol = [a if isinstance(a, StringColumn) else \
+					_encodeStrings(a.astype(str)) for a in lCol]
+				_cols[col] = _concatStrings(lCol)
+			else:
+				_cols[col] = np.concatenate(lCol)
+		return _fromColumns(_cols)
 
 	def count(self, key):
 
@@ -532,9 +1159,8 @@ class DataMatrix(BaseMatrix):
 		"""
 
 		l = []
-		for a in np.array_split(self.m, N):
-			dm = DataMatrix(a, structured=True)
-			l.append(dm)
+		for a in np.array_split(np.arange(len(self)), N):
+			l.append(self._selectRows(a))
 		return l
 
 	def intertrialer(self, keys, dv, _range=[1]):
@@ -572,13 +1198,73 @@ class DataMatrix(BaseMatrix):
 				v = '%s_m%d' % (dv, -1*i)
 			else:
 				v = '%s_p%d' % (dv, i)
-			dm = dm.addField(v, dtype=type(dm[dv][0]))
+			dm = dm.addField(v, dtype=type(dm[dv][0]), copy=False)
 			if i < 0:
 				dm[v][:i] = dm[dv][-i:]
 			else:
 				dm[v][i:] = dm[dv][:-i]
 		return dm
 
+	def iterrows(self, chunkSize=1000):
+
+		"""
+		desc: |
+			Walks through the DataMatrix row by row, without creating a
+			DataMatrix for each row. Each row is a light-weight record, which
+			gives access to its values by column name, either as an item or as
+			an attribute. Values are fetched in chunks of rows, and are
+			regular Python values, rather than NumPy scalars.
+
+			Changes to a row are not possible, and changes to the DataMatrix
+			are not visible in rows that have already been fetched.
+
+		keywords:
+			chunkSize:
+				desc:	The number of rows that are fetched at once.
+				type:	int
+
+		example: |
+			for row in dm.iterrows():
+				print row.rt, row['cond']
+
+		returns:
+			desc:	A generator of rows.
+			type:	generator
+		"""
+
+		names = self.columns()
+		index = dict((name, i) for i, name in enumerate(names))
+		for values in self.itertuples(chunkSize=chunkSize):
+			yield DataMatrixRow(index, values)
+
+	def itertuples(self, chunkSize=1000):
+
+		"""
+		desc: |
+			Walks through the DataMatrix row by row, and gives each row as a
+			tuple of values in the order of [DataMatrix.columns]. This is the
+			fastest way to walk through a DataMatrix.
+
+		keywords:
+			chunkSize:
+				desc:	The number of rows that are fetched at once.
+				type:	int
+
+		example: |
+			for subject, rt in dm.selectColumns(['subject', 'rt']).itertuples():
+				print subject, rt
+
+		returns:
+			desc:	A generator of tuples.
+			type:	generator
+		"""
+
+		lCol = [self._col(name) for name in self.columns()]
+		for start in range(0, len(self), chunkSize):
+			lChunk = [col[start:start+chunkSize].tolist() for col in lCol]
+			for values in zip(*lChunk):
+				yield values
+
 	def range(self):
 
 		"""
@@ -620,12 +1306,13 @@ class DataMatrix(BaseMatrix):
 				self.recode(key, _coding)
 			return
 		elif hasattr(coding, '__call__'):
-			for i in range(len(self.m)):
-				self.m[key][i] = coding(self.m[key][i])
+			a = self[key]
+			for i in range(len(a)):
+				a[i] = coding(a[i])
 		else:
 			oldValue, newValue = coding
-			i = np.where(self.m[key] == oldValue)
-			self.m[key][i] = newValue
+			i = np.where(self[key] == oldValue)
+			self[key][i] = newValue
 
 	def removeNan(self, key):
 
@@ -642,12 +1329,11 @@ class DataMatrix(BaseMatrix):
 			type:	DataMatrix
 		"""
 
-		i = np.where(~np.isnan(self.m[key]))[0]
+		i = np.where(~np.isnan(self[key]))[0]
 		print 'Removing %d rows with nans' % len(i)
-		dm = DataMatrix(self.m[i], structured=True)
-		return dm
+		return self._selectRows(i)
 
-	def removeField(self, key):
+	def removeField(self, key, copy=True):
 
 		"""
 		desc:
@@ -659,21 +1345,21 @@ class DataMatrix(BaseMatrix):
 				desc:	The name of the field to be removed.
 				type:	[str, unicode]
 
-		returns:
-			type:	DataMatrix
+		keywords:
+			copy:
+				desc:	Indicates whether the remaining columns are copied. If
+						not, the new DataMatrix shares the remaining columns
+						with the current DataMatrix.
+				type:	bool
+
+		returns:
+			type:	DataMatrix
 		"""
 
-		newDtype = []
-		for i in range(len(self.m.dtype)):
-			_key = self.m.dtype.names[i]
-			_dtype = self.m.dtype[i]
-			if _key != key:
-				newDtype.append( (_key, _dtype) )
-		a = np.zeros(self.m.shape, dtype=newDtype)
-		for name in self.m.dtype.names:
-			if name != key:
-				a[name] = self.m[name]
-		return DataMatrix(a, structured=True)
+		cols = self._copyColumns(copy)
+		if key in cols:
+			del cols[key]
+		return _fromColumns(cols)
 
 	def rename(self, oldKey, newKey):
 
@@ -694,13 +1380,16 @@ class DataMatrix(BaseMatrix):
 			type:	DataMatrix
 		"""
 
-		dtype = []
-		for key in self.m.dtype.names:
-			_type = self.m.dtype[key]
+		if oldKey not in self.columns():
+			return self
+		self._materialize()
+		cols = OrderedDict()
+		for key, col in self._cols.items():
 			if key == oldKey:
 				key = newKey
-			dtype.append( (key, _type) )
-		self.m.dtype = dtype
+			cols[key] = col
+		# The structured array is rebuilt from the columns when it is needed
+		self._setColumns(cols)
 		return self
 
 	def group(self, keys, _sort=True):
@@ -725,21 +1414,67 @@ class DataMatrix(BaseMatrix):
 			type:	list
 		"""
 
-		if type(keys) == str:
+		if isinstance(keys, basestring):
 			keys = [keys]
 		if len(keys) == 0:
 			return [self]
-		vName = keys[0]
-		vVals = np.unique(self.m[vName])
-		if _sort:
-			vVals = sorted(list(vVals))
+		# Reorder the rows once, so that each group is a contiguous slice (and
+		# therefore a view) of the sorted array.
+		order, starts = self.groupIndex(keys)
+		dm = self._selectRows(order)
+		ends = np.append(starts[1:], len(dm))
 		l = []
-		for vVal in vVals:
-			a = self.m[self.m[vName] == vVal]
-			dm = DataMatrix(a, structured=True)
-			l += dm.group(keys[1:])
+		for start, end in zip(starts, ends):
+			l.append(dm._selectRows(slice(start, end)))
 		return l
 
+	def groupIndex(self, keys):
+
+		"""
+		desc: |
+			Builds an index of the groups that are defined by unique
+			combinations of values for the key variables. The keys are
+			factorized into integer codes, and the rows are sorted by these
+			codes in a single pass, so that each group corresponds to a
+			contiguous range in the sort order. Groups are sorted by value,
+			and rows keep their original order within each group.
+
+		arguments:
+			keys:
+				desc:	A key or list of keys to group the data on.
+				type:	[str, unicode, list]
+
+		example: |
+			order, starts = dm.groupIndex(['subject_nr', 'cond'])
+			ends = np.append(starts[1:], len(order))
+			for start, end in zip(starts, ends):
+				print dm['rt'][order[start:end]].mean()
+
+		returns:
+			desc:	An `(order, starts)` tuple, where `order` is an array of
+					row indices sorted by group, and `starts` is an array with
+					the position in `order` at which each group starts.
+			type:	tuple
+		"""
+
+		if isinstance(keys, basestring):
+			keys = [keys]
+		n = len(self)
+		if n == 0:
+			return np.arange(0), np.arange(0)
+		if len(keys) == 0:
+			return np.arange(n), np.zeros(1, dtype=int)
+		codes = [_factorize(self._storedCol(key, detach=False))[1] \
+			for key in keys]
+		# np.lexsort() is stable and treats the last key as dominant.
+		order = np.lexsort(codes[::-1])
+		change = np.zeros(n, dtype=bool)
+		change[0] = True
+		for c in codes:
+			c = c[order]
+			change[1:] |= c[1:] != c[:-1]
+		return order, np.where(change)[0]
+
 	def walk(self, key):
 
 		l = []
@@ -752,15 +1487,74 @@ class DataMatrix(BaseMatrix):
 			l.append((val, _dm))
 		return l
 
+	def save(self, path='DataMatrix.csv', delimiter=',', fmt='%s'):
+
+		"""
+		desc: |
+			Saves the DataMatrix. Paths that end with `.dm` are saved in a
+			binary columnar format: a folder with one `.npy` file per column
+			and a `schema.json` file that describes the columns. The column
+			types are preserved, and opening such a folder with
+			`DataMatrix(path)` is nearly instantaneous, because columns are
+			memory-mapped and only read from disk when they are used. String
+			columns are stored as integer codes and a table of levels, as they
+			are in memory (see [DataMatrix.columns]). The levels are pickled,
+			so that they keep their type, such as `unicode` or `None`.
+
+			Other paths are saved as a text `.csv` file or, for paths that end
+			with `.npy`, as an array of strings.
+
+		keywords:
+			path:
+				desc:	The path to save to.
+				type:	[str, unicode]
+			delimiter:
+				desc:	The column delimiter for text files.
+				type:	[str, unicode]
+			fmt:
+				desc:	The cell format for text files.
+				type:	[str, unicode]
+
+		example: |
+			dm.save('data.dm')
+			dm = DataMatrix('data.dm')
+		"""
+
+		if not path.lower().endswith('.dm'):
+			BaseMatrix.save(self, path, delimiter=delimiter, fmt=fmt)
+			return
+		if not os.path.isdir(path):
+			os.makedirs(path)
+		lCol = []
+		for i, name in enumerate(self.columns()):
+			col = self._storedCol(name, detach=False)
+			info = {'name' : name, 'dtype' : col.dtype.str,
+				'file' : '%d.npy' % i}
+			if isinstance(col, StringColumn):
+				levels, codes = _factorize(col)
+				info['levels'] = '%d.levels.pkl' % i
+				_saveLevels(os.path.join(path, info['levels']), levels)
+				col = codes.astype(np.int32)
+			_saveArray(os.path.join(path, info['file']), col)
+			lCol.append(info)
+		# The schema is written last, so that it only refers to complete
+		# column files.
+		with open(os.path.join(path, 'schema.json'), 'w') as fd:
+			json.dump({'version' : 2, 'length' : len(self),
+				'columns' : lCol}, fd, indent=1)
+
 	def select(self, query, verbose=True):
 
 		"""
 		desc:
-			Select a subset of the data.
+			Select a subset of the data. See [Query.compileQuery] for the
+			query syntax. The result is a view on the current DataMatrix (see
+			[DataMatrix.__getitem__]).
 
 		arguments:
 			query:
-				desc:	A query, e.g. 'rt > 1000'.
+				desc:	A query, e.g. 'rt > 1000' or
+						'100 < rt < 1000 and cond in ["a", "b"]'.
 				type:	[str, unicode]
 
 		keywords:
@@ -775,29 +1569,27 @@ class DataMatrix(BaseMatrix):
 		if len(self) == 0:
 			warnings.warn('Selecting from empty DataMatrix (%s)' % query)
 			return self.clone()
-		l = query.split(' ')
-		vName = l[0]
-		op = l[1]
-		test = query[len(vName)+len(op)+1:]
-		flt = eval('self.m[vName] %s %s' % (op, test))
-		if type(flt) == bool: # The whole array is selected
+		flt = compileQuery(query)(self)
+		if np.ndim(flt) > 0:
+			dm = self._selectRows(flt)
+		elif flt: # The whole array is selected
 			dm = self
 		else:
-			dm = DataMatrix(self.m[flt], structured=True)
+			dm = self._selectRows(slice(0, 0))
 		if verbose:
 			a = np.empty((4,3), dtype='|S128')
 			a[0,0] = '[QUERY]'
 			a[0,1] = query
 			a[0,2] = '-'
 			a[1,0] = '[N BEFORE]'
-			a[1,1] = self.m.size #len(self.m)
+			a[1,1] = len(self)
 			a[1,2] = 100.
 			a[2,0] = '[N DISCARDED]'
-			a[2,1] = self.m.size -dm.m.size #len(self.m) - len(dm.m)
-			a[2,2] = 100.*(self.m.size-dm.m.size)/self.m.size #100.*(len(self.m) - len(dm.m))/len(self.m)
+			a[2,1] = len(self) - len(dm)
+			a[2,2] = 100.*(len(self) - len(dm))/len(self)
 			a[3,0] = '[N AFTER]'
-			a[3,1] = dm.m.size #len(dm.m)
-			a[3,2] = 100.*dm.m.size/self.m.size #100.*len(dm.m)/len(self.m)
+			a[3,1] = len(dm)
+			a[3,2] = 100.*len(dm)/len(self)
 			BaseMatrix(a)._print()
 		return dm
 
@@ -821,7 +1613,14 @@ class DataMatrix(BaseMatrix):
 		for key in keys:
 			if key not in self.columns():
 				raise Exception('The column "%s" does not exist' % key)
-		return DataMatrix(self.m[keys], structured=True)
+		cols = OrderedDict()
+		for key in keys:
+			col = self._storedCol(key, detach=False)
+			if isinstance(col, StringColumn):
+				cols[key] = col.copy()
+			else:
+				cols[key] = np.copy(col)
+		return _fromColumns(cols)
 
 	def selectByStdDev(self, keys, dv, thr=2.5, verbose=False):
 
@@ -860,15 +1659,16 @@ class DataMatrix(BaseMatrix):
 
 		# Create a dummy field that combines the keys, so we can simply group
 		# based on one key
-		dm = dm.removeField('__dummyCond__')
-		dm = dm.addField('__dummyCond__', dtype=str, default='__dummy__')
+		dm = dm.removeField('__dummyCond__', copy=False)
+		dm = dm.addField('__dummyCond__', dtype=str, default='__dummy__',
+			copy=False)
 		for key in keys:
 			for i in range(len(dm)):
 				dm['__dummyCond__'][i] += str(dm[key][i]) + '__'
 
 		# Add a field to store outliers
-		dm = dm.removeField('__stdOutlier__')
-		dm = dm.addField('__stdOutlier__', dtype=int)
+		dm = dm.removeField('__stdOutlier__', copy=False)
+		dm = dm.addField('__stdOutlier__', dtype=int, copy=False)
 		dm['__stdOutlier__'] = 0
 
 		for cond in np.unique(dm['__dummyCond__']):
@@ -902,12 +1702,9 @@ class DataMatrix(BaseMatrix):
 			Shuffles the DataMatrix in place.
 		"""
 
-		# Directly shuffling the array does not preserve all items! This seems
-		# to be a bug in numpy. This workaround preserves the integrity of the
-		# DataMatrix.
-		l = list(self.m)
-		np.random.shuffle(l)
-		self.m = np.array(l, dtype=self.m.dtype)
+		order = np.arange(len(self))
+		np.random.shuffle(order)
+		self._reorder(order)
 
 	def sort(self, keys, ascending=True):
 
@@ -928,9 +1725,37 @@ class DataMatrix(BaseMatrix):
 				type:	bool
 		"""
 
-		self.m.sort(order=keys)
+		if isinstance(keys, basestring):
+			keys = [keys]
+		# Like sorting the structured array, the other columns break ties in
+		# the order in which they appear.
+		self._materialize()
+		names = list(keys) + [name for name in self._cols if name not in keys]
+		lKey = []
+		for name in names[::-1]:
+			col = self._cols[name]
+			if isinstance(col, StringColumn):
+				col = col.levels.rank()[col.codes]
+			lKey.append(col)
+		order = np.lexsort(lKey)
 		if not ascending:
-			self.m = self.m[::-1]
+			order = order[::-1]
+		self._reorder(order)
+
+	def _reorder(self, order):
+
+		"""
+		Reorders the rows in place.
+
+		Arguments:
+		order -- an array with the new order of the row indices
+		"""
+
+		self._materialize()
+		cols = OrderedDict()
+		for name, col in self._cols.items():
+			cols[name] = col[order]
+		self._setColumns(cols)
 
 	def split(self, key):
 
@@ -1051,13 +1876,14 @@ class DataMatrix(BaseMatrix):
 			type:	list
 		"""
 
-		return list(np.unique(self[key]))
+		return list(_factorize(self._storedCol(key, detach=False))[0])
 
 	def where(self, query):
 
 		"""
 		desc:
-			Return indices corresponding to the query.
+			Return indices corresponding to the query. See
+			[Query.compileQuery] for the query syntax.
 
 		arguments:
 			query:
@@ -1069,12 +1895,10 @@ class DataMatrix(BaseMatrix):
 			type:	ndarray
 		"""
 
-		l = query.split(' ')
-		vName = l[0]
-		op = l[1]
-		test = query[len(vName)+len(op)+1:]
-		flt = np.where(eval('self.m[vName] %s %s' % (op, test)))
-		return flt[0]
+		flt = compileQuery(query)(self)
+		if np.ndim(flt) == 0:
+			flt = np.repeat(bool(flt), len(self))
+		return np.where(flt)[0]
 
 	def withinize(self, vName, targetVName, key, verbose=True, whiten=False):
 
@@ -1110,21 +1934,23 @@ class DataMatrix(BaseMatrix):
 		"""
 
 
-		self.m[targetVName] = self.m[vName]
-		gAvg = self.m[targetVName].mean()
+		a = self[targetVName]
+		a[:] = self[vName]
+		gAvg = a.mean()
 		if verbose:
 			print "Grand avg =", gAvg
-		for f in np.unique(self.m[key]):
-			i = np.where(self.m[key] == f)
-			fAvg = self.m[targetVName][i].mean()
-			fStd = self.m[targetVName][i].std()
+		order, starts = self.groupIndex(key)
+		for start, end in zip(starts, np.append(starts[1:], len(order))):
+			i = order[start:end]
+			fAvg = a[i].mean()
+			fStd = a[i].std()
 			if verbose:
-				print "Avg(%s) = %f" % (f, fAvg)
+				print "Avg(%s) = %f" % (self[key][i[0]], fAvg)
 			if whiten:
-				self.m[targetVName][i] -= fAvg
-				self.m[targetVName][i] /= fStd
+				a[i] -= fAvg
+				a[i] /= fStd
 			else:
-				self.m[targetVName][i] += gAvg - fAvg
+				a[i] += gAvg - fAvg
 		return self
 
 class DataMatrixIterator(object):
@@ -1166,10 +1992,719 @@ class DataMatrixIterator(object):
 
 		if self.i >= len(self.dm):
 			raise StopIteration
-		a = self.dm.m[[self.i]]
+		dm = self.dm[self.i]
 		self.i += 1
-		return DataMatrix(a, structured=True)
+		return dm
+
+class DataMatrixRow(object):
+
+	"""
+	A single row of a DataMatrix, as given by DataMatrix.iterrows(). Values
+	can be accessed by column name, as items or as attributes.
+	"""
+
+	__slots__ = ['_index', '_values']
+
+	def __init__(self, index, values):
+
+		"""
+		Constructor
+
+		Arguments:
+		index -- a dict that maps column names onto positions in values. This
+				 dict is shared by all rows of a DataMatrix.
+		values -- a tuple of values
+		"""
+
+		self._index = index
+		self._values = values
+
+	def __getitem__(self, key):
+
+		"""
+		Arguments:
+		key -- a column name or position
+
+		Returns:
+		The value
+		"""
+
+		if isinstance(key, basestring):
+			if key not in self._index:
+				raise Exception('The column "%s" does not exist' % key)
+			key = self._index[key]
+		return self._values[key]
+
+	def __getattr__(self, name):
+
+		"""
+		Arguments:
+		name -- a column name
+
+		Returns:
+		The value
+		"""
+
+		try:
+			return self._values[self._index[name]]
+		except KeyError:
+			raise AttributeError(name)
+
+	def __contains__(self, key):
+
+		"""
+		Arguments:
+		key -- a column name
+
+		Returns:
+		True if the column exists, False otherwise.
+		"""
+
+		return key in self._index
+
+	def __repr__(self):
+
+		"""
+		Returns:
+		A string representation of the row.
+		"""
+
+		return 'DataMatrixRow(%s)' % ', '.join(['%s=%r' % (name,
+			self._values[i]) for name, i in sorted(self._index.items(),
+			key=lambda item: item[1])])
+
+	def columns(self):
+
+		"""
+		Returns:
+		A list of column names.
+		"""
+
+		return sorted(self._index, key=self._index.get)
+
+class StringLevels(object):
+
+	"""
+	A table of the distinct values (levels) of string columns. The code of a
+	level is its position in the table. Levels are only added, and never
+	removed or reordered, so that codes remain valid when the table grows.
+	This allows columns that are derived from each other, such as
+	selections, to share a single table.
+	"""
+
+	def __init__(self, values=()):
+
+		"""
+		Constructor
+
+		Keyword arguments:
+		values -- a list of distinct values (default=())
+		"""
+
+		self.values = list(values)
+		self.index = dict((value, code) for code, value in \
+			enumerate(self.values))
+		self._array = None
+		self._rank = None
+
+	def __len__(self):
+
+		"""
+		Returns:
+		The number of levels.
+		"""
+
+		return len(self.values)
+
+	def __getstate__(self):
+
+		"""
+		Returns:
+		The state for pickling and copying, which consists of the levels only.
+		"""
+
+		return self.values
+
+	def __setstate__(self, values):
+
+		"""
+		Arguments:
+		values -- a list of levels
+		"""
+
+		self.__init__(values)
+
+	def code(self, value):
+
+		"""
+		Arguments:
+		value -- a value
+
+		Returns:
+		The code of the value, which is added to the table if necessary.
+		"""
+
+		try:
+			return self.index[value]
+		except KeyError:
+			self.index[value] = len(self.values)
+			self.values.append(value)
+			return len(self.values) - 1
+
+	def find(self, value):
+
+		"""
+		Arguments:
+		value -- a value
+
+		Returns:
+		The code of the value, or -1 if the value is not in the table.
+		"""
+
+		return self.index.get(value, -1)
+
+	def encode(self, values):
+
+		"""
+		Arguments:
+		values -- a list of values
+
+		Returns:
+		An int32 array with the code of each value. Values that are not in
+		the table yet are added.
+		"""
+
+		index = self.index
+		code = self.code
+		return np.fromiter((index[value] if value in index else code(value) \
+			for value in values), dtype=np.int32, count=len(values))
+
+	def array(self):
+
+		"""
+		Returns:
+		An object array with all levels, in the order of their codes.
+		"""
+
+		if self._array is None or len(self._array) != len(self.values):
+			self._array = np.empty(len(self.values), dtype=object)
+			self._array[:] = self.values
+		return self._array
+
+	def rank(self):
+
+		"""
+		Returns:
+		An array with the position of each level when the levels are sorted
+		by value.
+		"""
+
+		if self._rank is None or len(self._rank) != len(self.values):
+			order = np.argsort(self.array())
+			self._rank = np.empty(len(order), dtype=np.intp)
+			self._rank[order] = np.arange(len(order))
+		return self._rank
+
+class StringColumn(object):
+
+	"""
+	The storage of a string column: an int32 array with one code per cell,
+	and a table of levels (see StringLevels). Columns are decoded into object
+	arrays only when they are accessed through DataMatrix.__getitem__(). The
+	decoded array passes changes on to the codes (see StringArray).
+	"""
+
+	dtype = np.dtype(object)
+
+	def __init__(self, codes, levels):
+
+		"""
+		Constructor
+
+		Arguments:
+		codes -- an int32 array of codes
+		levels -- a StringLevels object
+		"""
+
+		self.codes = codes
+		self.levels = levels
+		self.version = 0
+		self._decoded = None
+
+	def __len__(self):
+
+		"""
+		Returns:
+		The number of cells.
+		"""
+
+		return len(self.codes)
+
+	def __getitem__(self, index):
+
+		"""
+		Arguments:
+		index -- an array of row indices or a boolean mask
+
+		Returns:
+		A new StringColumn with the selected rows, which shares the table of
+		levels with the current column.
+		"""
+
+		return StringColumn(self.codes[index], self.levels)
+
+	def __getstate__(self):
+
+		"""
+		Returns:
+		The state for pickling and copying, without the decoded array.
+		"""
+
+		return self.codes, self.levels
+
+	def __setstate__(self, state):
+
+		"""
+		Arguments:
+		state -- a (codes, levels) tuple
+		"""
+
+		self.__init__(*state)
+
+	@property
+	def nbytes(self):
+
+		"""
+		Returns:
+		The size of the codes in bytes.
+		"""
+
+		return self.codes.nbytes
+
+	def copy(self):
+
+		"""
+		Returns:
+		A copy of the column, which shares the table of levels with the
+		current column.
+		"""
+
+		return StringColumn(self.codes.copy(), self.levels)
+
+	def decode(self):
+
+		"""
+		Decodes the column. The decoded array is created when it is first
+		needed, and is kept for later calls.
+
+		Returns:
+		A StringArray.
+		"""
+
+		if self._decoded is None:
+			a = self.levels.array().take(self.codes).view(StringArray)
+			a._column = weakref.ref(self)
+			a._owner = a
+			self._decoded = a
+		return self._decoded
+
+	def update(self, key, values):
+
+		"""
+		Updates the codes of some cells.
+
+		Arguments:
+		key -- an index, slice, or array of indices into the codes
+		values -- the new value or values
+		"""
+
+		if np.ndim(values) == 0:
+			self.codes[key] = self.levels.code(values)
+		else:
+			self.codes[key] = self.levels.encode(np.asarray(values).tolist())
+		self.version += 1
+
+class StringArray(np.ndarray):
+
+	"""
+	The decoded values of a StringColumn, as an object array. Changes through
+	item assignment, in-place operators, and the fill(), put(), and sort()
+	methods are passed on to the codes of the column, also when they are made
+	through a slice of the array. Other ways of changing the array in place,
+	such as np.copyto(), are not passed on.
+	"""
+
+	def __array_finalize__(self, obj):
+
+		"""
+		Slices of a decoded array remain connected to its column.
+
+		Arguments:
+		obj -- the array from which the current array is derived
+		"""
+
+		self._column = None
+		self._owner = None
+		if isinstance(obj, StringArray) and obj._column is not None and \
+			self.base is obj and self.ndim == 1:
+			self._column = obj._column
+			self._owner = obj._owner
+
+	def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+
+		"""
+		Applies ufuncs to regular arrays, so that their results are regular
+		arrays, and passes in-place changes on to the column.
+		"""
+
+		inputs = [np.asarray(a) if isinstance(a, StringArray) else a \
+			for a in inputs]
+		out = kwargs.get('out', ())
+		if out:
+			kwargs['out'] = tuple(np.asarray(a) if isinstance(a, \
+				StringArray) else a for a in out)
+		result = getattr(ufunc, method)(*inputs, **kwargs)
+		if not out:
+			return result
+		for a in out:
+			if isinstance(a, StringArray):
+				a._update(Ellipsis)
+		if len(out) == 1:
+			return out[0]
+		return out
+
+	def __repr__(self):
+
+		"""
+		Returns:
+		The representation of a regular object array with the same values.
+		"""
+
+		return repr(np.asarray(self))
+
+	def __setitem__(self, key, value):
+
+		"""
+		Sets items, and passes the change on to the column.
+		"""
+
+		np.ndarray.__setitem__(self, key, value)
+		self._update(key)
+
+	def fill(self, value):
+
+		"""
+		Fills the array, and passes the change on to the column.
+		"""
+
+		np.ndarray.fill(self, value)
+		self._update(Ellipsis)
+
+	def put(self, indices, values, mode='raise'):
+
+		"""
+		Sets items, and passes the change on to the column.
+		"""
+
+		np.ndarray.put(self, indices, values, mode=mode)
+		self._update(Ellipsis)
+
+	def sort(self, *args, **kwargs):
+
+		"""
+		Sorts the array in place, and passes the change on to the column.
+		"""
+
+		np.ndarray.sort(self, *args, **kwargs)
+		self._update(Ellipsis)
+
+	def _update(self, key):
+
+		"""
+		Passes a change on to the column.
+
+		Arguments:
+		key -- the index of the changed cells in the current array
+		"""
+
+		if self._column is None:
+			return
+		column = self._column()
+		if column is None:
+			return
+		owner = self._owner
+		if isinstance(key, tuple) and len(key) == 1:
+			key = key[0]
+		if self is not owner:
+			# Translate the index into the current array, which is a slice,
+			# into an index into the decoded array of the column.
+			itemSize = self.dtype.itemsize
+			start = (self.__array_interface__['data'][0] - \
+				owner.__array_interface__['data'][0]) / itemSize
+			step = self.strides[0] / itemSize
+			if isinstance(key, (int, np.integer)):
+				key = start + step * (key % len(self))
+			else:
+				key = start + step * np.arange(len(self))[key]
+		elif not isinstance(key, (int, np.integer, slice)):
+			key = np.arange(len(self))[key]
+		column.update(key, owner[key])
+
+
+def _inferColumn(a, sampleSize=100):
+
+	"""
+	Converts a column to the most specific type that can hold all values:
+	int32 (or int64 for large values), float64, or a string column. The
+	conversions are done by NumPy on the column as a whole. A sample of the
+	values is checked first, so that conversions that are bound to fail are
+	skipped quickly.
+
+	Arguments:
+	a -- a 1-D numpy array, typically of strings
+
+	Keyword arguments:
+	sampleSize -- the number of values to check first (default=100)
+
+	Returns:
+	A 1-D numpy array
+	"""
+
+	sample = a[::max(1, len(a)/sampleSize)]
+	for dtype in (np.int64, np.float64):
+		try:
+			sample.astype(dtype)
+			col = a.astype(dtype)
+		except (ValueError, TypeError, OverflowError):
+			continue
+		if dtype == np.int64 and (len(col) == 0 or \
+			(col.min() >= np.iinfo(np.int32).min and \
+			col.max() <= np.iinfo(np.int32).max)):
+			col = col.astype(np.int32)
+		return col
+	return _encodeStrings(a)
+
+def _isStrType(dtype):
+
+	"""
+	Arguments:
+	dtype -- a dtype, or something that can be converted to a dtype
+
+	Returns:
+	True if the dtype should be stored as a string column, False otherwise.
+	"""
+
+	return np.dtype(dtype).kind in 'SUO'
+
+def _encodeStrings(a):
+
+	"""
+	Converts values to a string column, which stores an int32 code for each
+	cell and a table with the distinct values, or levels, of the column (see
+	StringColumn). This takes much less memory than fixed-width strings, does
+	not truncate long strings, and allows comparisons and grouping to work on
+	the codes. The levels are found with np.unique(), so that they are
+	initially sorted.
+
+	Arguments:
+	a -- a 1-D numpy array, typically of strings
+
+	Returns:
+	A StringColumn
+	"""
+
+	try:
+		levels, codes = np.unique(a, return_inverse=True)
+	except (TypeError, UnicodeError):
+		# Values that cannot be sorted are encoded in order of appearance
+		levels = StringLevels()
+		return StringColumn(levels.encode(a.tolist()), levels)
+	return StringColumn(codes.astype(np.int32), StringLevels(levels.tolist()))
+
+def _schemaColumn(a, dtype):
+
+	"""
+	Converts values to a column with a given type.
+
+	Arguments:
+	a -- a 1-D numpy array
+	dtype -- the dtype of the column
+
+	Returns:
+	A 1-D numpy array
+	"""
+
+	if _isStrType(dtype):
+		return _encodeStrings(np.asarray(a))
+	return np.array(a, dtype=dtype)
+
+def _factorize(a):
+
+	"""
+	Determines the sorted unique values of a column, and the position of each
+	value in the list of unique values, like np.unique() with
+	`return_inverse=True`. For string columns, this is done on the codes, so
+	that only the levels that occur in the column need to be sorted.
+
+	Arguments:
+	a -- a 1-D numpy array or a StringColumn
+
+	Returns:
+	A (levels, codes) tuple.
+	"""
+
+	if not isinstance(a, StringColumn):
+		return np.unique(a, return_inverse=True)
+	present, codes = np.unique(a.codes, return_inverse=True)
+	order = np.argsort(a.levels.rank()[present])
+	rank = np.empty(len(order), dtype=np.intp)
+	rank[order] = np.arange(len(order))
+	return a.levels.array()[present[order]], rank[codes]
+
+def _concatStrings(lCol):
+
+	"""
+	Concatenates string columns. Columns that share a table of levels are
+	concatenated by their codes. Otherwise, the levels of each column are
+	mapped onto a new table, and the codes are translated.
+
+	Arguments:
+	lCol -- a list of StringColumns
+
+	Returns:
+	A StringColumn
+	"""
+
+	levels = lCol[0].levels
+	if all(col.levels is levels for col in lCol):
+		return StringColumn(np.concatenate([col.codes for col in lCol]),
+			levels)
+	levels = StringLevels()
+	lCodes = []
+	for col in lCol:
+		mapping = levels.encode(col.levels.values)
+		lCodes.append(mapping[col.codes])
+	return StringColumn(np.concatenate(lCodes).astype(np.int32), levels)
+
+def _saveArray(path, a):
+
+	"""
+	Saves an array to a `.npy` file. The array is first written to a temporary
+	file and then renamed, so that an existing file that is memory-mapped,
+	for example because the DataMatrix was loaded from the same folder, is
+	not overwritten while it is being read.
+
+	Arguments:
+	path -- the path of the `.npy` file
+	a -- an array
+	"""
+
+	with open(path + '.tmp', 'wb') as fd:
+		np.save(fd, a)
+	os.rename(path + '.tmp', path)
+
+def _saveLevels(path, levels):
+
+	"""
+	Saves the levels of a string column to a pickle file, in the same way as
+	_saveArray(). Unlike an array of strings, a pickle preserves the type of
+	each level.
+
+	Arguments:
+	path -- the path of the `.pkl` file
+	levels -- an array of levels
+	"""
+
+	with open(path + '.tmp', 'wb') as fd:
+		cPickle.dump(levels.tolist(), fd, cPickle.HIGHEST_PROTOCOL)
+	os.rename(path + '.tmp', path)
+
+def _loadLevels(path):
+
+	"""
+	Loads the levels of a string column that were saved by _saveLevels(), or
+	by older versions of exparser as an `.npy` array of strings.
+
+	Arguments:
+	path -- the path of the levels file
+
+	Returns:
+	A StringLevels object
+	"""
+
+	if path.endswith('.npy'):
+		return StringLevels(np.load(path).tolist())
+	with open(path, 'rb') as fd:
+		return StringLevels(cPickle.load(fd))
+
+def _loadColumns(path):
+
+	"""
+	Loads the columns of a DataMatrix that was saved in the columnar format.
+	Numeric columns are memory-mapped in copy-on-write mode, so that they can
+	be modified without affecting the files on disk.
+
+	Arguments:
+	path -- the folder with the columns
+
+	Returns:
+	An OrderedDict of columns
+	"""
+
+	with open(os.path.join(path, 'schema.json')) as fd:
+		schema = json.load(fd)
+	# Empty files cannot be memory-mapped
+	if schema['length'] > 0:
+		mmapMode = 'c'
+	else:
+		mmapMode = None
+	cols = OrderedDict()
+	for info in schema['columns']:
+		# The memory map is wrapped in a regular array, because Python 2
+		# slices np.memmap objects incorrectly when a negative start lies
+		# before the beginning of the array.
+		col = np.asarray(np.load(os.path.join(path, info['file']),
+			mmap_mode=mmapMode))
+		if 'levels' in info:
+			col = StringColumn(col, _loadLevels(os.path.join(path,
+				info['levels'])))
+		cols[info['name'].encode('utf-8')] = col
+	return cols
+
+def _fromArray(a):
+
+	"""
+	Wraps a structured array in a DataMatrix without converting the column
+	types, which is only safe for arrays that are derived from an existing
+	DataMatrix.
+
+	Arguments:
+	a -- a structured numpy array
+
+	Returns:
+	A DataMatrix
+	"""
+
+	dm = DataMatrix.__new__(DataMatrix)
+	dm.m = a
+	return dm
+
+def _fromColumns(cols):
+
+	"""
+	Wraps a dict of columns in a DataMatrix without converting the column
+	types. All columns should have the same length.
+
+	Arguments:
+	cols -- an OrderedDict of 1-D numpy arrays
+
+	Returns:
+	A DataMatrix
+	"""
 
+	dm = DataMatrix.__new__(DataMatrix)
+	dm._setColumns(cols)
+	return dm
 
 def fromMySQL(query, user, passwd, db, charset='utf8', use_unicode=True):
 
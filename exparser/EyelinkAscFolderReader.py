@@ -18,22 +18,56 @@ along with exparser.  If not, see <http://www.gnu.org/licenses/>.
 from exparser.BaseReader import BaseReader
 from exparser.DataMatrix import DataMatrix
 from exparser import TraceKit
+from exparser import TraceStore
+from exparser.TraceStore import TraceStoreWriter
 import os
 import sys
+import json
+import hashlib
+import inspect
+import multiprocessing
 import numpy as np
 from matplotlib import pyplot as plt
 from scipy.spatial.distance import euclidean
 import warnings
 
+# Strings that float() accepts, even though they start with a letter
+floatWords = set(['nan', 'inf', 'infinity'])
+# The line handlers that receive sample lines if they are overridden. This
+# is slower, because sample lines then need to be tokenized with
+# strToList(). startTrial() and parseDriftCorr() are also called for lines
+# outside of trials.
+sampleHandlers = ['startTrial', 'endTrial', 'startBlink', 'endBlink',
+	'parseStartTracePhase', 'parseVariables', 'parseDriftCorr', 'parseLine']
+# The methods that determine the values of a sample in a trace. If none of
+# these has been overridden, the values are converted directly from the
+# tokens of a sample line.
+sampleParsers = ['strToList', 'parseTrace', 'toSample', 'sampleValues']
+# The channels that can be extracted from a sample. The first three are
+# always stored in traces. The others are only available in the elaborate
+# sample format, and are nan otherwise.
+sampleChannels = ['x', 'y', 'pupil', 'time', 'xvel', 'yvel', 'res']
+
 class EyelinkAscFolderReader(BaseReader):
 
-	"""Parses Eyelink ASCII data"""
+	"""
+	Parses Eyelink ASCII data. Each line is first classified by its first
+	character. Sample lines, which start with a timestamp, make up most of
+	the file. By default, they are skipped unless they are part of a trace
+	phase, in which case they are only split into tokens, and the sample
+	values are converted directly from the tokens. All other lines (MSG,
+	SBLINK, EBLINK, ESACC, EFIX, etc.) are tokenized with strToList() and
+	passed to all line handlers. If a line handler has been overridden (see
+	sampleHandlers), sample lines are also tokenized and passed to all line
+	handlers.
+	"""
 
 	def __init__(self, path='data', ext='.asc', startTrialKey='start_trial',
-		endTrialKey='stop_trial', variableKey='var', dtype='|S128', maxN=None,
+		endTrialKey='stop_trial', variableKey='var', dtype=str, maxN=None,
 		maxTrialId=None, requireEndTrial=True, traceFolder='traces',
 		offlineDriftCorr=False, skipList=[], blinkReconstruct=False, only=None,
-		acceptNonMatchingColumns=True):
+		acceptNonMatchingColumns=True, workers=1, traceExtraChannels=[],
+		incremental=False):
 
 		"""
 		Constructor. Reads all Eyelink ASCII files from a specific folder.
@@ -44,7 +78,8 @@ class EyelinkAscFolderReader(BaseReader):
 		startTrialKey	-- 	the start trial keyword (default='start_trial')
 		endTrialKey		--	the stop trial keyword (default='stop_trial')
 		variableKey		--	the variable keyword (default='var')
-		dtype			--	the numpy dtype to be used (default='|S128')
+		dtype			--	the numpy dtype to be used. The default `str`
+							does not truncate long values. (default=str)
 		maxN			--	the maximum number of subjects to process
 							(default=None)
 		maxTrialId		--	the maximum number of trials to process
@@ -52,11 +87,13 @@ class EyelinkAscFolderReader(BaseReader):
 		requireEndTrial	--	indicates whether an exception should be raised if a
 							trial hasn't been neatly closed. Otherwise the trial
 							is simply disregarded. (default=True)
-		traceFolder		--	the folder to save the gaze traces. Traces are saved
-							as 3d numpy arrays (x, y, pupil size) in .npy
-							format. To start collecting traces, set
-							`self.tracePhase` to a value. Use the value
-							'__baseline__' to use an automatic baseline.
+		traceFolder		--	the folder to save the gaze traces. Traces are
+							(x, y, pupil size) arrays, and all traces of a
+							file are saved in a single trace store
+							([file]-[hash].traces.npy, see TraceStore), which the
+							trace columns refer to. To start collecting
+							traces, set `self.tracePhase` to a value. Use the
+							value '__baseline__' to use an automatic baseline.
 							(default='traces')
 		offlineDriftCorr	--	Indicates whether coordinates should be
 								corrected based on the drift-correction check,
@@ -79,6 +116,22 @@ class EyelinkAscFolderReader(BaseReader):
 										is not carried out. If set to False,
 										the the check is carried out.
 										(default=True)
+		workers			--	The number of processes that parse files in
+							parallel. Each file is parsed by a copy of this
+							reader, so custom parsers work as usual, but
+							changes that a parser makes to itself are not
+							kept. The results are merged in the same order
+							as when parsing sequentially. (default=1)
+		traceExtraChannels	--	A list of channels that are stored in
+								traces after the x, y, and pupil columns:
+								'time', 'xvel', 'yvel', and/ or 'res'
+								(resolution). (default=[])
+		incremental		--	Indicates whether files that have been parsed
+							before should be loaded from the traceFolder,
+							rather than parsed again. A file is parsed again
+							if its contents or the parser configuration
+							(including the code of the reader class) have
+							changed. See manifestPath(). (default=False)
 		"""
 
 		self.startTrialKey = startTrialKey
@@ -90,6 +143,12 @@ class EyelinkAscFolderReader(BaseReader):
 		self.tracePhase = None
 		self.traceFolder = traceFolder
 		self.traceSmoothParams = None
+		for channel in traceExtraChannels:
+			if channel not in sampleChannels[3:]:
+				raise Exception('Invalid trace channel: %s' % channel)
+		self.traceChannels = sampleChannels[:3] + traceExtraChannels
+		self.traceChannelIndex = [sampleChannels.index(channel) \
+			for channel in self.traceChannels]
 		self.offlineDriftCorr = offlineDriftCorr
 		self.driftAdjust = 0,0
 		self.skipList = skipList
@@ -100,43 +159,97 @@ class EyelinkAscFolderReader(BaseReader):
 
 		print '\nScanning \'%s\'' % path
 		self.dm = None
-		nFile = 0
-		for fname in os.listdir(path):
+		lFname = []
+		for fname in sorted(os.listdir(path)):
 			if only != None and fname not in only:
 				print 'Skipping %s ...' % fname
 				continue
 			if os.path.splitext(fname)[1] == ext:
+				lFname.append(fname)
+			if maxN != None and len(lFname) >= maxN:
+				break
+		lPath = [os.path.join(path, fname) for fname in lFname]
+		# In incremental mode, unchanged files are loaded from the cache, and
+		# only the remaining files are parsed.
+		lCached = [False] * len(lPath)
+		if incremental:
+			manifest = self.loadManifest()
+			signature = self.parserSignature()
+			lEntry = []
+			for i, filePath in enumerate(lPath):
+				key = os.path.abspath(filePath)
+				entry = self.fileEntry(filePath, manifest.get(key))
+				entry['signature'] = signature
+				lCached[i] = self.isCached(filePath, manifest.get(key), entry)
+				if lCached[i]:
+					# Keep the modification time up to date, so that the file
+					# does not need to be hashed again next time.
+					entry['traces'] = manifest[key].get('traces', False)
+					manifest[key] = entry
+				lEntry.append(entry)
+		lParse = [filePath for filePath, cached in zip(lPath, lCached) \
+			if not cached]
+		# Files are parsed lazily, one by one or in parallel. Results are
+		# always returned in the order of the files.
+		if workers > 1 and len(lParse) > 1:
+			pool = multiprocessing.Pool(workers)
+			results = pool.imap(_parseFile, [(self, filePath) \
+				for filePath in lParse])
+		else:
+			pool = None
+			results = (self.parseFile(filePath) for filePath in lParse)
+		# Collect the DataMatrices for all files, and concatenate them once at
+		# the end.
+		lDm = []
+		# Stop the worker processes if reading fails, for example because the
+		# columns do not match.
+		try:
+			for i, fname in enumerate(lFname):
 				sys.stdout.write('Reading %s ...' % fname)
 				sys.stdout.flush()
-				a = self.parseFile(os.path.join(path, fname))
-				dm = DataMatrix(a)
-
-				if self.dm == None:
-					self.dm = dm
+				if lCached[i]:
+					sys.stdout.write('(cached) ')
+					dm = DataMatrix(self.cachePath(lPath[i]))
 				else:
-
-					# If column headers are not identical:
-					if self.dm.columns() != dm.columns():
-
-						# Determine warning message:
-						warningMsg = "The column headers are not identical. Difference:\n%s"\
-						% "\n".join(list(set(self.dm.columns()).\
-							symmetric_difference(set(dm.columns()))))
-
-						# Determine whether to only print the warning,
-						# or to raise an exception:
-						if not acceptNonMatchingColumns:
-							raise Exception(warningMsg)
-						if acceptNonMatchingColumns:
-							print warningMsg
-
-					self.dm += dm
-
+					dm = DataMatrix(results.next())
+					# The trace store may have been rewritten by another process
+					TraceStore.invalidate(self.traceStorePath(lPath[i]))
+					if incremental:
+						dm.save(self.cachePath(lPath[i]))
+						entry = lEntry[i]
+						entry['traces'] = os.path.exists(self.traceStorePath(
+							lPath[i]))
+						manifest[os.path.abspath(lPath[i])] = entry
+						self.saveManifest(manifest)
+
+				# If column headers are not identical:
+				if len(lDm) > 0 and lDm[0].columns() != dm.columns():
+
+					# Determine warning message:
+					warningMsg = "The column headers are not identical. Difference:\n%s"\
+					% "\n".join(list(set(lDm[0].columns()).\
+						symmetric_difference(set(dm.columns()))))
+
+					# Determine whether to only print the warning,
+					# or to raise an exception:
+					if not acceptNonMatchingColumns:
+						raise Exception(warningMsg)
+					if acceptNonMatchingColumns:
+						print warningMsg
+
+				lDm.append(dm)
 				print '(%d rows)' % len(dm)
-				nFile += 1
-			if maxN != None and nFile >= maxN:
-				break
-		print '%d files\n' % nFile
+			if pool != None:
+				pool.close()
+				pool.join()
+		finally:
+			if pool != None:
+				pool.terminate()
+		if incremental and len(lPath) > 0:
+			self.saveManifest(manifest)
+		if len(lDm) > 0:
+			self.dm = DataMatrix.concat(lDm)
+		print '%d files\n' % len(lDm)
 
 	def startBlink(self, l):
 
@@ -166,6 +279,194 @@ class EyelinkAscFolderReader(BaseReader):
 		# EBLINK R 4999128
 		return l[0] == 'EBLINK'
 
+	def storeName(self, path):
+
+		"""
+		Gives a name that identifies a file in the traceFolder. The name
+		consists of the file name and a hash of the absolute path, so that
+		files with the same name in different folders do not share a cached
+		DataMatrix or a trace store.
+
+		Arguments:
+		path -- the path of an Eyelink ASCII file
+
+		Returns:
+		A file name, without extension
+		"""
+
+		return '%s-%s' % (os.path.basename(path),
+			hashlib.md5(os.path.abspath(path)).hexdigest()[:12])
+
+	def cachePath(self, path):
+
+		"""
+		Gives the path of the cached DataMatrix of a file, which is used in
+		incremental mode.
+
+		Arguments:
+		path -- the path of an Eyelink ASCII file
+
+		Returns:
+		The path of a DataMatrix in the columnar .dm format
+		"""
+
+		return os.path.join(self.traceFolder, '%s.dm' % self.storeName(path))
+
+	def traceStorePath(self, path):
+
+		"""
+		Gives the path of the trace store of a file.
+
+		Arguments:
+		path -- the path of an Eyelink ASCII file
+
+		Returns:
+		The path of a trace store
+		"""
+
+		return os.path.join(self.traceFolder, '%s.traces.npy' \
+			% self.storeName(path))
+
+	def manifestPath(self):
+
+		"""
+		Gives the path of the manifest, which is used in incremental mode. The
+		manifest is a json file with an entry for each file that has been
+		parsed, indexed by the absolute path of the file. Each entry contains
+		the size, modification time, and md5 hash of the file, and the parser
+		signature (see parserSignature()).
+
+		Returns:
+		The path of the manifest
+		"""
+
+		return os.path.join(self.traceFolder, 'manifest.json')
+
+	def loadManifest(self):
+
+		"""
+		Loads the manifest.
+
+		Returns:
+		A dictionary with manifest entries, which is empty if there is no
+		(valid) manifest.
+		"""
+
+		try:
+			with open(self.manifestPath()) as fd:
+				manifest = json.load(fd)
+		except (IOError, ValueError):
+			return {}
+		if not isinstance(manifest, dict):
+			return {}
+		return manifest
+
+	def saveManifest(self, manifest):
+
+		"""
+		Saves the manifest. The manifest is first written to a temporary file,
+		so that an interrupted write does not corrupt it.
+
+		Arguments:
+		manifest -- a dictionary with manifest entries
+		"""
+
+		if not os.path.exists(self.traceFolder):
+			os.makedirs(self.traceFolder)
+		path = self.manifestPath()
+		with open(path + '.part', 'w') as fd:
+			json.dump(manifest, fd, indent=1, sort_keys=True)
+		os.rename(path + '.part', path)
+
+	def parserSignature(self):
+
+		"""
+		Creates a signature of the parser configuration. Files that were
+		parsed with a different signature are parsed again in incremental
+		mode. The signature covers the trial keys, the trace settings, and the
+		source code of the reader class and its base classes, so that changes
+		to custom parsers are also detected.
+
+		Returns:
+		An md5 hex digest
+		"""
+
+		l = [self.startTrialKey, self.endTrialKey, self.variableKey,
+			str(self.dtype), self.maxTrialId, self.requireEndTrial,
+			self.offlineDriftCorr, self.skipList, self.blinkReconstruct,
+			self.traceSmoothParams, self.traceChannels,
+			os.path.abspath(self.traceFolder)]
+		for cls in inspect.getmro(self.__class__):
+			if cls is object:
+				continue
+			try:
+				l.append(inspect.getsource(cls))
+			except (IOError, TypeError):
+				l.append(cls.__name__)
+		return hashlib.md5(repr(l)).hexdigest()
+
+	def fileEntry(self, path, oldEntry=None):
+
+		"""
+		Creates a manifest entry for a file. The md5 hash is only calculated if
+		the size or modification time of the file differ from those in the
+		old entry, because hashing requires reading the entire file.
+
+		Arguments:
+		path -- the path of an Eyelink ASCII file
+
+		Keyword arguments:
+		oldEntry -- the current manifest entry of the file, or None
+					(default=None)
+
+		Returns:
+		A manifest entry
+		"""
+
+		stat = os.stat(path)
+		entry = {'size' : stat.st_size, 'mtime' : stat.st_mtime}
+		if oldEntry != None and oldEntry.get('size') == entry['size'] and \
+			oldEntry.get('mtime') == entry['mtime']:
+			entry['hash'] = oldEntry.get('hash')
+			return entry
+		md5 = hashlib.md5()
+		with open(path, 'rb') as fd:
+			while True:
+				s = fd.read(1024*1024)
+				if s == '':
+					break
+				md5.update(s)
+		entry['hash'] = md5.hexdigest()
+		return entry
+
+	def isCached(self, path, oldEntry, entry):
+
+		"""
+		Checks whether a file can be loaded from the cache.
+
+		Arguments:
+		path -- the path of an Eyelink ASCII file
+		oldEntry -- the current manifest entry of the file, or None
+		entry -- a new manifest entry, as created by fileEntry(), with a
+				 signature
+
+		Returns:
+		True or False
+		"""
+
+		if oldEntry == None:
+			return False
+		if oldEntry.get('hash') != entry['hash'] or \
+			oldEntry.get('signature') != entry['signature']:
+			return False
+		if not os.path.exists(os.path.join(self.cachePath(path),
+			'schema.json')):
+			return False
+		if oldEntry.get('traces') and not os.path.exists(
+			self.traceStorePath(path)):
+			return False
+		return True
+
 	def dataMatrix(self):
 
 		"""
@@ -240,24 +541,25 @@ class EyelinkAscFolderReader(BaseReader):
 			plt.figure(figsize=(12,12))
 			plt.subplots_adjust(hspace=.5, wspace=.5)
 		for phase, trace in self.traceDict.iteritems():
-			a = np.array(trace, dtype=float)
+			a = trace.array()
 			if len(a) == 0:
 				continue
 			origA = a.copy()
 			if self.blinkReconstruct:
 				a[:,2] = TraceKit.blinkReconstruct(a[:,2])
 			if self.traceSmoothParams != None:
-				a[:,0] = TraceKit.smooth(a[:,0], **self.traceSmoothParams)
-				a[:,1] = TraceKit.smooth(a[:,1], **self.traceSmoothParams)
-				a[:,2] = TraceKit.smooth(a[:,2], **self.traceSmoothParams)
+				a[:,:3] = TraceKit.smooth(a[:,:3], axis=0,
+					**self.traceSmoothParams)
 			self.traceDict[phase] = a
-			path = os.path.join(self.traceFolder, '%s-%.5d-%s.npy' \
-				% (trialDict['file'], trialDict['trialId'], phase))
 			if not os.path.exists(self.traceFolder):
 				print('Creating traceFolder: %s' % self.traceFolder)
-				os.makedirs(self.traceFolder)
-
-			np.save(path, a)
+				# Another process may create the folder at the same time
+				try:
+					os.makedirs(self.traceFolder)
+				except OSError:
+					if not os.path.isdir(self.traceFolder):
+						raise
+			path = self.traceStore.add(a)
 			trialDict['__trace_%s__' % phase] = path
 			if self.traceImg or self.tracePlot:
 				plt.subplot(nPhase, 3, i)
@@ -332,6 +634,9 @@ class EyelinkAscFolderReader(BaseReader):
 		An array
 		"""
 
+		# All traces of the file are collected in a single trace store
+		self.traceStore = TraceStoreWriter(self.traceStorePath(path))
+		parseSamples = self.overridden(['startTrial', 'parseDriftCorr'])
 		# First read all trials into a list of trialDicts
 		fd = open(path, 'r')
 		lTrialDict = []
@@ -339,6 +644,8 @@ class EyelinkAscFolderReader(BaseReader):
 			s = fd.readline()
 			if s == '':
 				break
+			if _isSample(s) and not parseSamples:
+				continue
 			l = self.strToList(s)
 			if self.offlineDriftCorr:
 				self.parseDriftCorr(l)
@@ -349,6 +656,7 @@ class EyelinkAscFolderReader(BaseReader):
 				trialDict = self.parseTrial(trialId, fd)
 				if trialDict != None:
 					lTrialDict.append(trialDict)
+		self.traceStore.close()
 		# Extract the column names
 		lVar = []
 		for trialDict in lTrialDict:
@@ -356,16 +664,12 @@ class EyelinkAscFolderReader(BaseReader):
 				if var not in lVar:
 					lVar.append(var)
 		lVar.sort()
-		# Construct a numpy array with the variable names on the first row
-		a = np.zeros( (len(lTrialDict)+1, len(lVar)), dtype=self.dtype )
-		a[0] = np.array(lVar, dtype=self.dtype)
-		i = 1
+		# Construct a numpy array with the variable names on the first row.
+		# Missing variables are left empty.
+		l = [lVar]
 		for trialDict in lTrialDict:
-			for var in lVar:
-				if var in trialDict:
-					a[i, lVar.index(var)] = trialDict[var]
-			i += 1
-		return a
+			l.append([trialDict.get(var, '') for var in lVar])
+		return np.array(l, dtype=self.dtype)
 
 	def parseLine(self, trialDict, l):
 
@@ -379,6 +683,24 @@ class EyelinkAscFolderReader(BaseReader):
 
 		pass
 
+	def overridden(self, names):
+
+		"""
+		Checks whether methods have been overridden by a custom parser.
+
+		Arguments:
+		names -- a list of method names
+
+		Returns:
+		True if any of the methods has been overridden, False otherwise.
+		"""
+
+		for name in names:
+			if getattr(self, name).im_func is not \
+				getattr(EyelinkAscFolderReader, name).im_func:
+				return True
+		return False
+
 	def parseTrial(self, trialId, fd):
 
 		"""
@@ -394,21 +716,34 @@ class EyelinkAscFolderReader(BaseReader):
 
 		trialDict = {'trialId' : trialId, 'file' : os.path.basename(fd.name), \
 			'outlier' : 0, 'eye_used' : 'undefined', 'n_blink' : 0}
-		if trialDict['trialId'] not in self.skipList:
+		skip = trialDict['trialId'] in self.skipList
+		if not skip:
 			self.__initTrial__(trialDict) # Internal stuff
 			self.initTrial(trialDict) # To be overridden
+		# Sample lines are only passed to the line handlers if one of them has
+		# been overridden. Otherwise, they are only needed for traces, for
+		# which the tokens can be used directly.
+		parseSamples = self.overridden(sampleHandlers)
+		if self.overridden(sampleParsers):
+			toSampleList = self.strToList
+		else:
+			toSampleList = str.split
 		self.inBlink = False
 		while True:
 			s = fd.readline()
 			if s == '':
 				break
+			if not parseSamples and _isSample(s):
+				if not skip and self.tracePhase != None:
+					self.parseTrace(toSampleList(s))
+				continue
 			l = self.strToList(s)
 			if self.endTrial(l):
-				if trialDict['trialId'] not in self.skipList:
+				if not skip:
 					self.__finishTrial__(trialDict) # Internal stuff
 					self.finishTrial(trialDict) # To be overridden
 				return trialDict
-			if trialDict['trialId'] in self.skipList:
+			if skip:
 				continue
 			if self.startBlink(l):
 				self.inBlink = True
@@ -440,12 +775,24 @@ class EyelinkAscFolderReader(BaseReader):
 		l -- a list
 		"""
 
-		s = self.toSample(l)
-		if s == None:
-			return
+		# If toSample() has been overridden, it determines the values.
+		# Otherwise the values are extracted without building a dict.
+		if self.toSample.im_func is not EyelinkAscFolderReader.toSample.im_func:
+			s = self.toSample(l)
+			if s == None:
+				return
+			values = [s.get(channel, np.nan) for channel in self.traceChannels]
+		else:
+			values = self.sampleValues(l, allChannels= \
+				len(self.traceChannels) > 3)
+			if values == None:
+				return
+			if len(self.traceChannels) > 3:
+				values = [values[i] for i in self.traceChannelIndex]
 		if self.tracePhase not in self.traceDict:
-			self.traceDict[self.tracePhase] = []
-		self.traceDict[self.tracePhase].append( (s['x'], s['y'], s['pupil']) )
+			self.traceDict[self.tracePhase] = \
+				SampleBuffer(len(self.traceChannels))
+		self.traceDict[self.tracePhase].append(values)
 
 	def parseStartTracePhase(self, l):
 
@@ -492,7 +839,8 @@ class EyelinkAscFolderReader(BaseReader):
 
 		"""
 		Converts a string, corresponding to a single line from a file, to a
-		list of values.
+		list of values. Values are converted to int if possible, otherwise to
+		float if possible, and are otherwise kept as strings.
 
 		Arguments:
 		s -- a string
@@ -501,16 +849,7 @@ class EyelinkAscFolderReader(BaseReader):
 		A list
 		"""
 
-		l = []
-		for v in s.split():
-			try:
-				l.append(int(v))
-			except:
-				try:
-					l.append(float(v))
-				except:
-					l.append(v)
-		return l
+		return [_toValue(v) for v in s.split()]
 
 	def toSaccade(self, l):
 
@@ -554,6 +893,51 @@ class EyelinkAscFolderReader(BaseReader):
 		except:
 			return None
 
+	def sampleValues(self, l, allChannels=False):
+
+		"""
+		Extracts sample values from a line (in list format). See toSample()
+		for the accepted formats. The values may also be the tokens of the
+		line, as given by str.split(), in which case each value is converted
+		only once.
+
+		Arguments:
+		l -- a list
+
+		Keyword arguments:
+		allChannels -- indicates whether all channels in `sampleChannels`
+					   should be extracted, or only x, y, and pupil.
+					   (default=False)
+
+		Returns:
+		None if the list isn't a sample, otherwise a list of values in the
+		order of `sampleChannels`.
+		"""
+
+		if len(l) not in (5, 9):
+			return None
+		try:
+			time = int(float(l[0]))
+			if l[1] == '.':
+				x = np.nan
+			else:
+				x = float(l[1]) - self.driftAdjust[0]
+			if l[2] == '.':
+				y = np.nan
+			else:
+				y = float(l[2]) - self.driftAdjust[1]
+			pupil = float(l[3])
+		except (ValueError, TypeError):
+			return None
+		if pupil == 0:
+			pupil = np.nan
+		if not allChannels:
+			return [x, y, pupil]
+		if len(l) == 9:
+			return [x, y, pupil, time, _toFloat(l[5]), _toFloat(l[6]),
+				_toFloat(l[7])]
+		return [x, y, pupil, time, np.nan, np.nan, np.nan]
+
 	def toSample(self, l):
 
 		"""
@@ -576,29 +960,13 @@ class EyelinkAscFolderReader(BaseReader):
 
 		Returns:
 		None if the list isn't a sample, otherwise a dictionary with the
-		following keys: 'x', 'y', 'time'.
+		channels in `sampleChannels` as keys.
 		"""
 
-		if len(l) not in (5, 9):
-			return None
-		try:
-			sample = {}
-			sample["time"] = int(l[0])
-			if l[1] == '.':
-				sample['x'] = np.nan
-			else:
-				sample["x"] = float(l[1]) - self.driftAdjust[0]
-			if l[2] == '.':
-				sample["y"] = np.nan
-			else:
-				sample["y"] = float(l[2]) - self.driftAdjust[1]
-			if l[3] == 0:
-				sample['pupil'] = np.nan
-			else:
-				sample['pupil'] = float(l[3])
-			return sample
-		except:
+		values = self.sampleValues(l, allChannels=True)
+		if values == None:
 			return None
+		return dict(zip(sampleChannels, values))
 
 	def toFixation(self, l):
 
@@ -629,3 +997,134 @@ class EyelinkAscFolderReader(BaseReader):
 		fixation["eTime"] = l[3]
 		fixation["duration"] = fixation['eTime'] - fixation['sTime']
 		return fixation
+
+class SampleBuffer(object):
+
+	"""
+	A growable buffer of samples, with one column per channel. Each sample is
+	written as a single row into a preallocated (samples x channels) array,
+	which doubles in size when it is full.
+	"""
+
+	def __init__(self, nChannel, size=4096):
+
+		"""
+		Constructor
+
+		Arguments:
+		nChannel -- the number of channels
+
+		Keyword arguments:
+		size -- the initial number of samples that fit in the buffer
+				(default=4096)
+		"""
+
+		self.nChannel = nChannel
+		self.a = np.empty((max(1, size), nChannel))
+		self.n = 0
+
+	def __len__(self):
+
+		"""
+		Returns:
+		The number of samples.
+		"""
+
+		return self.n
+
+	def append(self, values):
+
+		"""
+		Adds a sample.
+
+		Arguments:
+		values -- a list with one value per channel
+		"""
+
+		if self.n == len(self.a):
+			a = np.empty((2*len(self.a), self.nChannel))
+			a[:self.n] = self.a
+			self.a = a
+		self.a[self.n] = values
+		self.n += 1
+
+	def array(self):
+
+		"""
+		Returns:
+		A (samples x channels) array with a copy of the samples.
+		"""
+
+		return self.a[:self.n].copy()
+
+def _toFloat(v):
+
+	"""
+	Arguments:
+	v -- a value
+
+	Returns:
+	The value as float, or nan if it cannot be converted.
+	"""
+
+	try:
+		return float(v)
+	except (ValueError, TypeError):
+		return np.nan
+
+def _parseFile(job):
+
+	"""
+	Parses a single file in a worker process.
+
+	Arguments:
+	job -- a (reader, path) tuple
+
+	Returns:
+	An array, as returned by EyelinkAscFolderReader.parseFile()
+	"""
+
+	reader, path = job
+	return reader.parseFile(path)
+
+def _isSample(s):
+
+	"""
+	Checks whether a line is a sample line, which starts with a timestamp.
+
+	Arguments:
+	s -- a string
+
+	Returns:
+	True or False
+	"""
+
+	return s[:1].isdigit()
+
+def _toValue(v):
+
+	"""
+	Converts a single token to an int, float, or string, like int() and
+	float() would do. Tokens that are obviously ints or strings are
+	recognized without raising exceptions, so that only ambiguous tokens
+	need a try/ except.
+
+	Arguments:
+	v -- a non-empty string without whitespace
+
+	Returns:
+	An int, float, or string
+	"""
+
+	c = v[0]
+	if v.isdigit() or (c in '+-' and v[1:].isdigit()):
+		return int(v)
+	if c.isalpha():
+		if v.lower() not in floatWords:
+			return v
+	elif c == '.' and (len(v) == 1 or not v[1].isdigit()):
+		return v
+	try:
+		return float(v)
+	except ValueError:
+		return v
@@ -0,0 +1,164 @@
+#-*- coding:utf-8 -*-
+
+"""
+This file is part of exparser.
+
+exparser is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+exparser is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with exparser.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from collections import OrderedDict
+
+class MemoryCache(object):
+
+	"""
+	desc: |
+		An in-memory cache, which discards the least recently used items when
+		the total size of the cached items exceeds a budget. The size of
+		each item is specified when it is added. The cache does not copy or
+		protect the items, so this should be done by the caller if needed.
+
+		The `hits` and `misses` attributes count how often items were and
+		were not found in the cache.
+
+	example: |
+		cache = MemoryCache(maxBytes=64*1024**2)
+		value = cache.get(key)
+		if value is None:
+			value = compute()
+			cache.put(key, value, len(value))
+		print cache.stats()
+	"""
+
+	def __init__(self, maxBytes=256*1024**2):
+
+		"""
+		desc:
+			Constructor.
+
+		keywords:
+			maxBytes:
+				desc:	The maximum total size of the cached items in bytes.
+				type:	int
+		"""
+
+		self.maxBytes = maxBytes
+		self.items = OrderedDict()
+		self.nBytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def __len__(self):
+
+		"""
+		returns:
+			desc:	The number of cached items.
+			type:	int
+		"""
+
+		return len(self.items)
+
+	def get(self, key):
+
+		"""
+		desc:
+			Gets an item from the cache, and marks it as recently used.
+
+		arguments:
+			key:
+				desc:	A hashable key.
+
+		returns:
+			desc:	The item, or None if the item is not cached.
+		"""
+
+		item = self.items.pop(key, None)
+		if item is None:
+			self.misses += 1
+			return None
+		self.items[key] = item
+		self.hits += 1
+		return item[0]
+
+	def put(self, key, value, nBytes):
+
+		"""
+		desc:
+			Adds an item to the cache. Items that are larger than the budget
+			are not cached.
+
+		arguments:
+			key:
+				desc:	A hashable key.
+			value:
+				desc:	The item.
+			nBytes:
+				desc:	The size of the item in bytes.
+				type:	int
+		"""
+
+		if key in self.items:
+			self.nBytes -= self.items.pop(key)[1]
+		if nBytes > self.maxBytes:
+			return
+		self.items[key] = value, nBytes
+		self.nBytes += nBytes
+		self.prune()
+
+	def prune(self):
+
+		"""
+		desc:
+			Discards the least recently used items until the cache fits in
+			the budget. This is useful after lowering `maxBytes`.
+		"""
+
+		while self.nBytes > self.maxBytes and len(self.items) > 0:
+			key, item = self.items.popitem(last=False)
+			self.nBytes -= item[1]
+			self.evictions += 1
+
+	def clear(self):
+
+		"""
+		desc:
+			Discards all items and resets the counters.
+		"""
+
+		self.items.clear()
+		self.nBytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def stats(self):
+
+		"""
+		returns:
+			desc:	A dictionary with the number of hits, misses, evictions,
+					and cached items, the size of the cached items in bytes,
+					the budget, and the hit rate.
+			type:	dict
+		"""
+
+		n = self.hits + self.misses
+		return {
+			'hits' : self.hits,
+			'misses' : self.misses,
+			'evictions' : self.evictions,
+			'items' : len(self.items),
+			'bytes' : self.nBytes,
+			'maxBytes' : self.maxBytes,
+			'hitRate' : float(self.hits)/n if n > 0 else 0.
+			}
@@ -0,0 +1,282 @@
+#-*- coding:utf-8 -*-
+
+"""
+This file is part of exparser.
+
+exparser is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+exparser is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with exparser.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import ast
+import operator
+import numpy as np
+
+# Compiled queries, indexed by the query string
+queryCache = {}
+maxCacheSize = 1000
+
+compareOps = {
+	ast.Eq		: operator.eq,
+	ast.NotEq	: operator.ne,
+	ast.Lt		: operator.lt,
+	ast.LtE		: operator.le,
+	ast.Gt		: operator.gt,
+	ast.GtE		: operator.ge,
+	}
+
+# Equality operators, which are evaluated on the codes of string columns
+equalOps = {
+	ast.Eq		: True,
+	ast.NotEq	: False,
+	}
+
+# The operator that gives the same result when the operands are swapped
+swappedOps = {
+	ast.Eq		: ast.Eq,
+	ast.NotEq	: ast.NotEq,
+	ast.Lt		: ast.Gt,
+	ast.LtE		: ast.GtE,
+	ast.Gt		: ast.Lt,
+	ast.GtE		: ast.LtE,
+	}
+
+def compileQuery(query):
+
+	"""
+	desc: |
+		Compiles a query into a function that returns a boolean mask for a
+		DataMatrix. A query is a Python-style expression, in which names refer
+		to columns. Supported are comparisons between columns and values or
+		between two columns, range comparisons, `in` and `not in` with a list
+		of values, and combinations of these with `and`, `or`, `not`, and
+		parentheses. The entire query is evaluated in a single pass over the
+		data. Queries that cannot be compiled are treated as a single
+		comparison of the form `[column] [operator] [python expression]`.
+		Compiled queries are cached.
+
+	arguments:
+		query:
+			desc:	A query.
+			type:	[str, unicode]
+
+	example: |
+		mask = compileQuery('100 < rt < 1000 and cond in ["a", "b"]')(dm)
+		mask = compileQuery('rt_left > rt_right or not correct == 1')(dm)
+
+	returns:
+		desc:	A function that takes a DataMatrix and returns a boolean array,
+				or a single bool if the query does not depend on the rows.
+		type:	function
+	"""
+
+	if query in queryCache:
+		return queryCache[query]
+	try:
+		func = _compileNode(ast.parse(query.strip(), mode='eval').body)
+	except (SyntaxError, ValueError):
+		func = _compileLegacy(query)
+	if len(queryCache) >= maxCacheSize:
+		queryCache.clear()
+	queryCache[query] = func
+	return func
+
+def _compileNode(node):
+
+	"""
+	Compiles a node from the syntax tree of a query.
+
+	Arguments:
+	node -- an ast node
+
+	Returns:
+	A function that takes a DataMatrix and returns a mask.
+	"""
+
+	if isinstance(node, ast.BoolOp):
+		lFunc = [_compileNode(value) for value in node.values]
+		if isinstance(node.op, ast.And):
+			combine = np.logical_and
+		else:
+			combine = np.logical_or
+		def boolOp(dm):
+			mask = lFunc[0](dm)
+			for func in lFunc[1:]:
+				mask = combine(mask, func(dm))
+			return mask
+		return boolOp
+	if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+		func = _compileNode(node.operand)
+		return lambda dm: np.logical_not(func(dm))
+	if isinstance(node, ast.Compare):
+		# A chained comparison, such as `100 < rt < 1000`, is split into
+		# pairwise comparisons that must all hold.
+		lOperand = [node.left] + node.comparators
+		lFunc = []
+		for i, op in enumerate(node.ops):
+			lFunc.append(_compileComparison(lOperand[i], op,
+				lOperand[i+1]))
+		def compare(dm):
+			mask = lFunc[0](dm)
+			for func in lFunc[1:]:
+				mask = np.logical_and(mask, func(dm))
+			return mask
+		return compare
+	raise ValueError('Unsupported expression in query')
+
+def _compileComparison(left, op, right):
+
+	"""
+	Compiles a single comparison. Comparisons between a column and a value
+	are compiled so that they work on the codes of string columns (see
+	_compileCodes()).
+
+	Arguments:
+	left -- the left operand node
+	op -- the operator node
+	right -- the right operand node
+
+	Returns:
+	A function that takes a DataMatrix and returns a mask.
+	"""
+
+	if _columnName(right) != None and _columnName(left) == None and \
+		type(op) in swappedOps:
+		left, op, right = right, swappedOps[type(op)](), left
+	name = _columnName(left)
+	left = _compileOperand(left)
+	if isinstance(op, (ast.In, ast.NotIn)):
+		values = np.array(ast.literal_eval(right))
+		if isinstance(op, ast.In):
+			test = lambda a: np.in1d(a, values)
+		else:
+			test = lambda a: ~np.in1d(a, values)
+		return _compileCodes(name, test, lambda dm: test(left(dm)))
+	if type(op) not in compareOps:
+		raise ValueError('Unsupported operator in query')
+	func = compareOps[type(op)]
+	if name != None and _columnName(right) == None:
+		value = ast.literal_eval(right)
+		test = lambda a: func(a, value)
+		return _compileCodes(name, test, lambda dm: test(left(dm)),
+			value=value, equal=equalOps.get(type(op)))
+	right = _compileOperand(right)
+	return lambda dm: func(left(dm), right(dm))
+
+def _compileCodes(name, test, fallback, value=None, equal=None):
+
+	"""
+	Compiles a comparison between a column and a value. For string columns,
+	the comparison is evaluated once for each level, and the result is
+	looked up by code, so that the values are never decoded. Equality is
+	tested by looking up the code of the value, and comparing it to the codes
+	of the column.
+
+	Arguments:
+	name -- the column name
+	test -- a function that takes an array of values and returns a mask
+	fallback -- a function that takes a DataMatrix and returns a mask, for
+				numeric columns
+
+	Keyword arguments:
+	value -- the value, for equality tests (default=None)
+	equal -- True for `==`, False for `!=`, or None for other comparisons
+			 (default=None)
+
+	Returns:
+	A function that takes a DataMatrix and returns a mask.
+	"""
+
+	def compare(dm):
+		if name not in dm.columns():
+			return fallback(dm)
+		stringCodes = dm._stringCodes(name)
+		if stringCodes == None:
+			return fallback(dm)
+		codes, levels = stringCodes
+		if equal != None:
+			try:
+				code = levels.find(value)
+			except TypeError:
+				# Unhashable values cannot be levels
+				code = -1
+			if equal:
+				return codes == code
+			return codes != code
+		return test(levels.array())[codes]
+	return compare
+
+def _columnName(node):
+
+	"""
+	Arguments:
+	node -- an ast node
+
+	Returns:
+	The column name if the node refers to a column, None otherwise.
+	"""
+
+	if isinstance(node, ast.Name) and node.id not in ('True', 'False',
+		'None'):
+		return node.id
+	return None
+
+def _compileOperand(node):
+
+	"""
+	Compiles an operand, which is either a column name or a literal value.
+
+	Arguments:
+	node -- an ast node
+
+	Returns:
+	A function that takes a DataMatrix and returns a column or a value.
+	"""
+
+	name = _columnName(node)
+	if name != None:
+		def column(dm):
+			if name not in dm.columns():
+				raise Exception('The column "%s" does not exist' % name)
+			return dm[name]
+		return column
+	value = ast.literal_eval(node)
+	return lambda dm: value
+
+def _compileLegacy(query):
+
+	"""
+	Compiles a query of the form `[column] [operator] [python expression]`,
+	where the column name can contain characters that are not allowed in
+	Python names. As in the original DataMatrix.select(), the expression is
+	evaluated in the namespace of the DataMatrix module, and can refer to
+	the DataMatrix as `self`.
+
+	Arguments:
+	query -- a query
+
+	Returns:
+	A function that takes a DataMatrix and returns a mask.
+	"""
+
+	l = query.split(' ')
+	vName = l[0]
+	op = l[1]
+	test = query[len(vName)+len(op)+1:]
+	code = compile('__column__ %s %s' % (op, test), '<query>', 'eval')
+	def legacyQuery(dm):
+		# Imported here, because the DataMatrix module imports this module
+		from exparser import DataMatrix
+		return eval(code, DataMatrix.__dict__, {'__column__' : dm[vName],
+			'self' : dm, 'query' : query, 'vName' : vName, 'op' : op,
+			'test' : test})
+	return legacyQuery
@@ -31,10 +31,18 @@ class RBridge(object):
 
 	"""Provides a very basic two-bridge to R."""
 
-	def __init__(self):
+	def __init__(self, prefix='.rbridge'):
 
-		"""Constructor."""
+		"""
+		Constructor.
+
+		Keyword arguments:
+		prefix	--	The prefix for the files that are used to exchange data
+					with R. Bridges that are used at the same time should have
+					different prefixes. (default='.rbridge')
+		"""
 
+		self.prefix = prefix
 		self.RProcess = subprocess.Popen(['R', '--vanilla'], \
 			stdin=subprocess.PIPE, stdout=subprocess.PIPE)
 		self.poll = select.poll()
@@ -64,20 +72,21 @@ class RBridge(object):
 		A DataMatrix with the `aov()` output as summarized by `summary()`.
 		"""
 
-		if os.path.exists('.rbridge-aov.txt'):
-			os.remove('.rbridge-aov.txt')
+		path = self.prefix + '-aov.txt'
+		if os.path.exists(path):
+			os.remove(path)
 		# Peform aov
 		s = self.call('(%s <- aov(%s))' % (aovVar, formula))
 		print self.call('summary(aov1)')
 		# Summarize the data
 		self.write( \
-			'capture.output(summary(%s)$"Error: Within", file=".rbridge-aov.txt")' \
-			% aovVar)
-		while not os.path.exists('.rbridge-aov.txt'):
+			'capture.output(summary(%s)$"Error: Within", file="%s")' \
+			% (aovVar, path))
+		while not os.path.exists(path):
 			time.sleep(.1)
 		# The output is saved in an ugly ad-hock format, and we need to parse it
 		# line by line into a readable format for DataMatrix.
-		s = open('.rbridge-aov.txt').read()
+		s = open(path).read()
 		l = [['effect', 'Df', 'SumSq', 'MeanSq', 'F', 'p', 'sign']]
 		for row in s.split('\n')[1:-1]:
 			# Do not include signficance ratings, which come after the `---`
@@ -107,18 +116,19 @@ class RBridge(object):
 		A DataMatrix with the output for the model comparison.
 		"""
 
-		if os.path.exists('.rbridge-anova.csv'):
-			os.remove('.rbridge-anova.csv')
+		path = self.prefix + '-anova.csv'
+		if os.path.exists(path):
+			os.remove(path)
 		self.write( \
 			'%s <- anova(%s, %s)' % (anovaVar, model1, model2))
-		self.call('write.csv(%s, ".rbridge-anova.csv")' % anovaVar)
-		while not os.path.exists('.rbridge-anova.csv'):
+		self.call('write.csv(%s, "%s")' % (anovaVar, path))
+		while not os.path.exists(path):
 			time.sleep(.1)
 		# Try this a few times, because sometimes the csv hasn't been written
 		# yet
 		for i in range(10):
 			try:
-				dm = CsvReader('.rbridge-anova.csv').dataMatrix()
+				dm = CsvReader(path).dataMatrix()
 				break
 			except:
 				time.sleep(1)
@@ -144,8 +154,9 @@ class RBridge(object):
 		bestVar	--	The variable to store best output. (default='BESTout')
 		"""
 
-		if os.path.exists('.rbridge-best.csv'):
-			os.remove('.rbridge-best.csv')
+		path = self.prefix + '-best.csv'
+		if os.path.exists(path):
+			os.remove(path)
 		self.write('library(BEST)')
 		l1 = [str(i) for i in a1]
 		self.write('a1 <- c(%s)' % (','.join(l1)))
@@ -158,16 +169,16 @@ class RBridge(object):
 			self.call('%s <- BESTmcmc(a1, numSavedSteps=%d)' % (bestVar, steps))
 		self.call('s <- summary(%s, compValeff=%f, ROPEm=c(%f, %f))' % (bestVar,
 			compVal, rope[0], rope[1]))
-		self.call('write.csv(s, ".rbridge-best.csv")')
+		self.call('write.csv(s, "%s")' % path)
 		# Try this a few times, because sometimes the csv hasn't been written
 		# yet
 		for i in range(100):
 			try:
-				dm = CsvReader('.rbridge-best.csv').dataMatrix()
+				dm = CsvReader(path).dataMatrix()
 				break
 			except:
 				time.sleep(1)
-		dm = CsvReader('.rbridge-best.csv').dataMatrix()
+		dm = CsvReader(path).dataMatrix()
 		return dm
 
 	def call(self, cmd):
@@ -215,21 +226,21 @@ class RBridge(object):
 			type:	DataMatrix
 		"""
 
-		if os.path.exists('.rbridge-lmer.csv'):
-			os.remove('.rbridge-lmer.csv')
+		path = self.prefix + '-lmer.csv'
+		if os.path.exists(path):
+			os.remove(path)
 
 		# Peform lmer
 		self.write('library(lmerTest)')
 		s = self.call('(%s <- lmer(%s))' % (lmerVar, formula))
-		self.write('write.csv(summary(%s)$coef, ".rbridge-lmer.csv")' % \
-			lmerVar)
-		while not os.path.exists('.rbridge-lmer.csv'):
+		self.write('write.csv(summary(%s)$coef, "%s")' % (lmerVar, path))
+		while not os.path.exists(path):
 			time.sleep(.1)
 		# Try this a few times, because sometimes the csv hasn't been written
 		# yet
 		for i in range(10):
 			try:
-				dm = CsvReader('.rbridge-lmer.csv').dataMatrix()
+				dm = CsvReader(path).dataMatrix()
 				break
 			except:
 				time.sleep(1)
@@ -242,22 +253,22 @@ class RBridge(object):
 
 	def glmer(self, formula, family, lmerVar='glmer1'):
 
-		if os.path.exists('.rbridge-glmer.csv'):
-			os.remove('.rbridge-glmer.csv')
+		path = self.prefix + '-glmer.csv'
+		if os.path.exists(path):
+			os.remove(path)
 
 		# Peform lmer
 		self.write('library(lmerTest)')
 		s = self.call('(%s <- glmer(%s, family=%s))' \
 			% (lmerVar, formula, family))
-		self.write('write.csv(summary(%s)$coef, ".rbridge-glmer.csv")' % \
-			lmerVar)
-		while not os.path.exists('.rbridge-glmer.csv'):
+		self.write('write.csv(summary(%s)$coef, "%s")' % (lmerVar, path))
+		while not os.path.exists(path):
 			time.sleep(.1)
 		# Try this a few times, because sometimes the csv hasn't been written
 		# yet
 		for i in range(10):
 			try:
-				dm = CsvReader('.rbridge-glmer.csv').dataMatrix()
+				dm = CsvReader(path).dataMatrix()
 				break
 			except:
 				time.sleep(1)
@@ -308,11 +319,27 @@ class RBridge(object):
 		frame	--	The variable name for the dataframe in R. (default=data)
 		"""
 
-		dm.save('.rbridge.csv')
+		path = self.prefix + '.csv'
+		dm.save(path)
+		self.loadCsv(path, frame=frame)
+
+	def loadCsv(self, path, frame='data'):
+
+		"""
+		Attaches a csv file as a dataframe to R. This allows multiple bridges
+		to share the same data.
+
+		Arguments:
+		path	--	The path to a csv file, as written by DataMatrix.save().
+
+		Keyword arguments:
+		frame	--	The variable name for the dataframe in R. (default=data)
+		"""
+
 		if self.needDetach:
 			self.write('detach(%s)' % frame)
 		self.needDetach = True
-		self.write('%s <- read.csv(".rbridge.csv")' % frame)
+		self.write('%s <- read.csv("%s")' % (frame, path))
 		self.write('attach(%s)' % frame)
 
 	def read(self):
@@ -23,7 +23,8 @@ from exparser import Cache, GUI
 import time
 import warnings
 
-def callFunc(dm, mods, func, cachePrefix='autoCache.', redo=False):
+def callFunc(dm, mods, func, cachePrefix='autoCache.', redo=False,
+	autoKey=False):
 
 	"""
 	Calls a single function from a module.
@@ -38,6 +39,10 @@ def callFunc(dm, mods, func, cachePrefix='autoCache.', redo=False):
 					function name will be appended. (default='autoCache.')
 	redo		--	Indicates whether functions should be redone, even if a
 					cache is available. (default=False)
+	autoKey		--	Indicates whether the cache key should be derived from
+					the function and the DataMatrix, so that the cache is not
+					used when the DataMatrix has changed. If so, cachePrefix
+					is ignored. See Cache.cacheKey(). (default=False)
 
 	Returns:
 	A DataMatrix.
@@ -51,7 +56,10 @@ def callFunc(dm, mods, func, cachePrefix='autoCache.', redo=False):
 			t1 = time.time()
 			_func = getattr(mod, func)
 			if not redo and Cache.isCached(_func):
-				cacheId = cachePrefix + func
+				if autoKey:
+					cacheId = 'auto'
+				else:
+					cacheId = cachePrefix + func
 				print '-> Calling %s.%s() [cacheId=%s]' \
 					% (mod.__name__, func, cacheId)
 				retVal = _func(dm, cacheId=cacheId)
@@ -71,7 +79,7 @@ def callFunc(dm, mods, func, cachePrefix='autoCache.', redo=False):
 	return dm
 
 def analysisLoop(dm, mods=[], pre=[], post=[], full=[],
-	cachePrefix='autoCache.'):
+	cachePrefix='autoCache.', autoKey=False):
 
 	"""
 	Executes an analysis loop, in which all functions that specified on the
@@ -92,6 +100,7 @@ def analysisLoop(dm, mods=[], pre=[], post=[], full=[],
 					pathway.
 	cachePrefix	--	A prefix for the cacheId for cachable functions. The
 					function name will be appended. (default='autoCache.')
+	autoKey		--	See callFunc(). (default=False)
 	"""
 
 	if not isinstance(mods, list):
@@ -101,13 +110,15 @@ def analysisLoop(dm, mods=[], pre=[], post=[], full=[],
 	print('Entering analysisLoop()')
 	t0 = time.time()
 	for func in pre:
-		dm = callFunc(dm, mods, func, cachePrefix=cachePrefix)
+		dm = callFunc(dm, mods, func, cachePrefix=cachePrefix,
+			autoKey=autoKey)
 	if '@full' in sys.argv:
 		print('Running full analysis pathway')
 		if len(full) == []:
 			raise Exception('No full analysis pathway specified')
 		for func in full:
-			dm = callFunc(dm, mods, func, cachePrefix=cachePrefix)
+			dm = callFunc(dm, mods, func, cachePrefix=cachePrefix,
+				autoKey=autoKey)
 	else:
 		for func in sys.argv:
 			if not func[0] == '@':
@@ -117,7 +128,9 @@ def analysisLoop(dm, mods=[], pre=[], post=[], full=[],
 				redo = True
 			else:
 				redo = False
-			dm = callFunc(dm, mods, func, cachePrefix=cachePrefix, redo=redo)
+			dm = callFunc(dm, mods, func, cachePrefix=cachePrefix,
+				redo=redo, autoKey=autoKey)
 	for func in post:
-		dm = callFunc(dm, mods, func, cachePrefix=cachePrefix)
+		dm = callFunc(dm, mods, func, cachePrefix=cachePrefix,
+			autoKey=autoKey)
 	print 'Finished analysisLoop() (%.2f s)' % (time.time() - t0)
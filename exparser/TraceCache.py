@@ -0,0 +1,79 @@
+#-*- coding:utf-8 -*-
+
+"""
+This file is part of exparser.
+
+exparser is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+exparser is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with exparser.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+from exparser.MemoryCache import MemoryCache
+
+class TraceCache(MemoryCache):
+
+	"""
+	desc: |
+		An in-memory cache of traces, which discards the least recently used
+		traces when the total size of the cached traces exceeds a budget
+		(see [MemoryCache]). Cached traces are made read-only, so that they
+		cannot be changed by accident.
+
+	example: |
+		cache = TraceCache(maxBytes=64*1024**2)
+		a = cache.get(key)
+		if a is None:
+			a = loadTrace()
+			cache.put(key, a)
+		print cache.stats()
+	"""
+
+	def put(self, key, a, nBytes=None):
+
+		"""
+		desc:
+			Adds a trace to the cache. Traces that are larger than the budget
+			are not cached.
+
+		arguments:
+			key:
+				desc:	A hashable key.
+			a:
+				desc:	A trace.
+				type:	ndarray
+
+		keywords:
+			nBytes:
+				desc:	The size of the trace in bytes, or None to use the
+						size of the array.
+				type:	[int, NoneType]
+		"""
+
+		if nBytes == None:
+			nBytes = a.nbytes
+		a.flags.writeable = False
+		MemoryCache.put(self, key, a, nBytes)
+
+	def stats(self):
+
+		"""
+		returns:
+			desc:	A dictionary as returned by [MemoryCache.stats], in which
+					the number of cached traces is also available as
+					`traces`.
+			type:	dict
+		"""
+
+		d = MemoryCache.stats(self)
+		d['traces'] = d['items']
+		return d
@@ -18,8 +18,10 @@ along with exparser.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import os
+import tempfile
+import multiprocessing
+from collections import OrderedDict
 from scipy.stats import nanmean, nanmedian, nanstd, ttest_ind, linregress
-from scipy.interpolate import interp1d
 from matplotlib import pyplot as plt
 from matplotlib import mpl
 import warnings
@@ -28,6 +30,17 @@ from exparser.TangoPalette import *
 from exparser.RBridge import RBridge
 from exparser.Cache import cachedArray, cachedDataMatrix
 from exparser.DataMatrix import DataMatrix
+from exparser import TraceStore
+from exparser.TraceCache import TraceCache
+
+# Processed traces, as used by getTrace() and getTraceMatrix(). The budget can
+# be changed through traceCache.maxBytes, and traceCache.stats() shows how
+# often traces were found in the cache.
+traceCache = TraceCache()
+# Normalized smoothing windows, indexed by (windowLen, windowType)
+windowCache = {}
+# Windows of at least this length are convolved through an FFT
+fftWindowLen = 256
 
 def getTrace(dm, signal=None, phase=None, traceLen=None, offset=0,
 	lock='start', traceTemplate='__trace_%s__', baseline=None, baselineLen=100,
@@ -40,9 +53,9 @@ def getTrace(dm, signal=None, phase=None, traceLen=None, offset=0,
 
 	arguments:
 		dm:
-			desc:	A DataMatrix with only a single trial (if more trials are in
-					there, only the first will be used).
-			type:	DataMatrix
+			desc:	A DataMatrix with only a single trial, or a single row as
+					given by `DataMatrix.iterrows()`.
+			type:	[DataMatrix, DataMatrixRow]
 
 	keywords:
 		signal:
@@ -89,7 +102,10 @@ def getTrace(dm, signal=None, phase=None, traceLen=None, offset=0,
 					are padded with np.nan values.
 			type:	bool
 		transform:
-			desc:	A function to transform the trace value.
+			desc:	A function to transform the trace value. The trace that
+					is passed to the function may be read-only, so the
+					function should return a new array rather than change the
+					trace in place.
 			type:	[NoneType, function]
 		deriv:
 			desc:	Indicates the derivative that should be used. The 1st
@@ -101,49 +117,24 @@ def getTrace(dm, signal=None, phase=None, traceLen=None, offset=0,
 			type:	FunctionType
 
 	returns:
-		desc:	A 1D NumPy array with the trace.
+		desc:	A 1D NumPy array with the trace. This is always a new array,
+				which the caller may change.
 		type:	ndarray
 	"""
 
-	if len(dm) != 1:
+	if isinstance(dm, DataMatrix) and len(dm) != 1:
 		raise Exception('DataMatrix must have exactly one row')
-	if signal == None or phase == None or traceLen == None:
-		raise Exception('signal, phase, and traceLen are required keywords')
-	if lock not in ['start', 'end']:
-		raise Exception('lock should be start or end')
-	if baselineLock not in ['start', 'end']:
-		raise Exception('baselineLock should be start or end')
-	if signal == 'x':
-		i = 0
-	elif signal == 'y':
-		i = 1
-	elif signal == 'pupil':
-		i = 2
-	else:
-		raise Exception('Invalid signal!')
+	i = _checkTraceParams(signal, phase, traceLen, lock, baselineLock)
 	# Get the trace
-	npy = dm[traceTemplate % phase][0]
-	if not os.path.exists(npy):
-		raise Exception('Missing .npy trace file: %s (path="%s")' \
-			% (traceTemplate % phase, npy))
-	aFull = np.load(npy)
+	key = traceTemplate % phase
+	npy = _trialValue(dm, key)
 	if regress != None:
-		_aTrace = regress(aFull, dm)
-	else:
-		_aTrace = aFull[:,i]
-	if smoothParams != None:
-		try:
-			_aTrace = smooth(_aTrace, **smoothParams)
-		except:
-			warnings.warn('Failed to smooth trace of length %d' % len(_aTrace))
-	if deriv > 0:
-		_aTrace = traceDeriv(_aTrace, deriv)
-	if lock == 'start':
-		_aTrace = _aTrace[offset:offset+traceLen]
-	elif offset > 0:
-		_aTrace = _aTrace[-offset-traceLen:-offset]
+		aFull = _loadTraces([npy], key)[0]
+		_aTrace = _processTraces([regress(aFull, dm)], traceLen, offset, lock,
+			smoothParams, deriv, safe=True)[0]
 	else:
-		_aTrace = _aTrace[-traceLen:]
+		_aTrace = _getTraces([npy], key, i, traceLen, offset, lock,
+			smoothParams, deriv, safe=True)[0]
 	# Paste the trace into a nan-filled trace that has exactly the desired
 	# length. This is necessary to deal with traces that are shorter than the
 	# specified traceLen.
@@ -155,7 +146,9 @@ def getTrace(dm, signal=None, phase=None, traceLen=None, offset=0,
 		else:
 			aTrace[-len(_aTrace):] = _aTrace
 	else:
-		aTrace = _aTrace
+		# The trace may be a read-only view of a trace store, or an array that
+		# is shared through the trace cache.
+		aTrace = _aTrace.copy()
 	# Optionally apply a transform
 	if transform != None:
 		aTrace = transform(aTrace)
@@ -166,31 +159,324 @@ def getTrace(dm, signal=None, phase=None, traceLen=None, offset=0,
 			aTrace = smooth(aTrace, **smoothParams)
 		return aTrace
 	# Get the baseline
-	npy = dm[traceTemplate % baseline][0]
-	if not os.path.exists(npy):
-		raise Exception('Missing .npy trace file: %s (path="%s")' \
-			% (traceTemplate % baseline, npy))
-	aFull = np.load(npy)
+	key = traceTemplate % baseline
+	npy = _trialValue(dm, key)
 	if regress != None:
-		aBaseline = regress(aFull, dm)
+		aFull = _loadTraces([npy], key)[0]
+		aBaseline = _processTraces([regress(aFull, dm)], baselineLen,
+			baselineOffset, baselineLock, smoothParams, deriv)[0]
 	else:
-		aBaseline = aFull[:,i]
-	if smoothParams != None:
-		aBaseline = smooth(aBaseline, **smoothParams)
-	if deriv > 0:
-		aBaseline = traceDeriv(aBaseline, deriv)
-	if baselineLock == 'start':
-		aBaseline = aBaseline[baselineOffset:baselineOffset+baselineLen]
-	elif baselineOffset == 0:
-		aBaseline = aBaseline[-baselineLen:]
-	else:
-		aBaseline = aBaseline[-baselineOffset-baselineLen:-baselineOffset]
+		aBaseline = _getTraces([npy], key, i, baselineLen, baselineOffset,
+			baselineLock, smoothParams, deriv)[0]
 	if transform != None:
 		aBaseline = transform(aBaseline)
 	mBaseline = aBaseline.mean()
-	aTrace /= mBaseline
+	aTrace = aTrace / mBaseline
 	return aTrace
 
+def _trialValue(trial, key):
+
+	"""
+	Gets a value from a single trial.
+
+	Arguments:
+	trial	--	a DataMatrix with a single row, or a DataMatrixRow
+	key		--	a column name
+
+	Returns:
+	The value
+	"""
+
+	if isinstance(trial, DataMatrix):
+		return trial[key][0]
+	return trial[key]
+
+def _checkTraceParams(signal, phase, traceLen, lock, baselineLock):
+
+	"""
+	Checks the trace parameters, as passed to getTrace().
+
+	Returns:
+	The column of the signal in the trace.
+	"""
+
+	if signal == None or phase == None or traceLen == None:
+		raise Exception('signal, phase, and traceLen are required keywords')
+	if lock not in ['start', 'end']:
+		raise Exception('lock should be start or end')
+	if baselineLock not in ['start', 'end']:
+		raise Exception('baselineLock should be start or end')
+	if signal == 'x':
+		return 0
+	if signal == 'y':
+		return 1
+	if signal == 'pupil':
+		return 2
+	raise Exception('Invalid signal!')
+
+def getTraceMatrix(dm, signal=None, phase=None, traceLen=None, offset=0,
+	lock='start', traceTemplate='__trace_%s__', baseline=None, baselineLen=100,
+	baselineOffset=0, baselineLock='end', smoothParams=None, nanPad=True,
+	transform=None, deriv=0, regress=None, **dummy):
+
+	"""
+	desc: |
+		Gets the traces for all trials in a DataMatrix. This gives the same
+		traces as calling `getTrace()` for each trial, but the traces are
+		processed in batches: traces of equal length are smoothed together,
+		and the padding and baseline correction are applied to all traces at
+		once.
+
+		Traces that are shorter than traceLen are padded with nan values at
+		the end, or, if `lock == 'end'` and `nanPad == True`, at the start.
+
+	arguments:
+		dm:
+			desc:	A DataMatrix.
+			type:	DataMatrix
+
+	keywords:
+		regress:
+			desc:	See getTrace(). Regress functions are applied to one
+					trial at a time, so the traces are not processed in
+					batches.
+			type:	FunctionType
+
+	keyword-dict:
+		*traceParams:	All other keywords are the same as for getTrace().
+
+	example: |
+		mTrace = getTraceMatrix(dm, signal='pupil', phase='target',
+			traceLen=1000, baseline='fixation')
+		aAvg = nanmean(mTrace, axis=0)
+
+	returns:
+		desc:	A 2D (trials x traceLen) NumPy array.
+		type:	ndarray
+	"""
+
+	i = _checkTraceParams(signal, phase, traceLen, lock, baselineLock)
+	mTrace = np.empty( (len(dm), traceLen) )
+	mTrace[:] = np.nan
+	if regress != None:
+		# Regress functions expect a DataMatrix with a single row
+		traceParams = dict(signal=signal, phase=phase, traceLen=traceLen,
+			offset=offset, lock=lock, traceTemplate=traceTemplate,
+			baseline=baseline, baselineLen=baselineLen,
+			baselineOffset=baselineOffset, baselineLock=baselineLock,
+			smoothParams=smoothParams, nanPad=nanPad, transform=transform,
+			deriv=deriv, regress=regress)
+		for j, trial in enumerate(dm):
+			aTrace = getTrace(trial, **traceParams)
+			mTrace[j, 0:len(aTrace)] = aTrace
+		return mTrace
+	if len(dm) == 0:
+		return mTrace
+	key = traceTemplate % phase
+	lTrace = _getTraces(dm[key], key, i, traceLen, offset, lock, smoothParams,
+		deriv, safe=True)
+	# Paste the traces into the nan-filled matrix
+	aLen = np.array([len(aTrace) for aTrace in lTrace])
+	aRow = np.repeat(np.arange(len(lTrace)), aLen)
+	aCol = np.arange(aLen.sum()) - np.repeat(np.cumsum(aLen)-aLen, aLen)
+	if nanPad and lock == 'end':
+		aCol += np.repeat(traceLen-aLen, aLen)
+	mTrace[aRow, aCol] = np.concatenate(lTrace)
+	# Without padding, transforms and smoothing only apply to the trace
+	# itself. Otherwise they apply to the full rows of the matrix.
+	if nanPad:
+		if transform != None:
+			mTrace = np.array([transform(aTrace) for aTrace in mTrace])
+		if baseline == None and smoothParams != None:
+			mTrace = smooth(mTrace, axis=1, **smoothParams)
+	else:
+		if transform != None:
+			lTrace = [transform(aTrace) for aTrace in lTrace]
+		if baseline == None and smoothParams != None:
+			lTrace = _smoothTraces(lTrace, smoothParams)
+		for j, aTrace in enumerate(lTrace):
+			mTrace[j, :len(aTrace)] = aTrace
+	if baseline == None:
+		return mTrace
+	# Get the baselines
+	key = traceTemplate % baseline
+	lBaseline = _getTraces(dm[key], key, i, baselineLen, baselineOffset,
+		baselineLock, smoothParams, deriv)
+	if transform != None:
+		lBaseline = [transform(aBaseline) for aBaseline in lBaseline]
+	aBaseline = np.array([aBaseline.mean() for aBaseline in lBaseline])
+	return mTrace / aBaseline[:, np.newaxis]
+
+def _getTraces(lRef, key, i, traceLen, offset, lock, smoothParams=None,
+	deriv=0, safe=False):
+
+	"""
+	Gets one signal of a list of traces, after smoothing, taking the
+	derivative, and taking the part that is specified by traceLen, offset,
+	and lock (see getTrace()). Traces are taken from traceCache when
+	possible. Traces that are not cached are processed together and added to
+	the cache.
+
+	Arguments:
+	lRef			--	a list of trace references
+	key				--	the column with the trace references
+	i				--	the column of the signal in the traces
+	traceLen		--	see getTrace()
+	offset			--	see getTrace()
+	lock			--	see getTrace()
+
+	Keyword arguments:
+	smoothParams	--	see getTrace() (default=None)
+	deriv			--	see getTrace() (default=0)
+	safe			--	see _smoothTraces() (default=False)
+
+	Returns:
+	A list of read-only 1D arrays.
+	"""
+
+	if smoothParams != None:
+		smoothKey = tuple(sorted(smoothParams.items()))
+	else:
+		smoothKey = None
+	lTrace = []
+	# The positions of traces that are not cached, indexed by cache key, so
+	# that each trace is processed only once.
+	dMiss = OrderedDict()
+	for j, ref in enumerate(lRef):
+		path = TraceStore.parseReference(ref)[0]
+		cacheKey = ref, TraceStore.storeVersions.get(path, 0), i, smoothKey, \
+			deriv, traceLen, offset, lock, safe
+		if cacheKey in dMiss:
+			aTrace = None
+		else:
+			aTrace = traceCache.get(cacheKey)
+		if aTrace is None:
+			dMiss.setdefault(cacheKey, []).append(j)
+		lTrace.append(aTrace)
+	if len(dMiss) == 0:
+		return lTrace
+	lFull = _loadTraces([lRef[lIndex[0]] for lIndex in dMiss.values()], key)
+	lNew = _processTraces([aFull[:,i] for aFull in lFull], traceLen, offset,
+		lock, smoothParams, deriv, safe=safe)
+	for (cacheKey, lIndex), aTrace in zip(dMiss.items(), lNew):
+		# A copy, so that the cache does not keep larger arrays alive
+		aTrace = np.array(aTrace)
+		traceCache.put(cacheKey, aTrace)
+		for j in lIndex:
+			lTrace[j] = aTrace
+	return lTrace
+
+def _loadTraces(lRef, key):
+
+	"""
+	Loads traces.
+
+	Arguments:
+	lRef	--	a list of trace references
+	key		--	the column with the trace references
+
+	Returns:
+	A list of (samples x channels) arrays.
+	"""
+
+	lTrace = []
+	checked = set()
+	for ref in lRef:
+		path = TraceStore.parseReference(ref)[0]
+		if path not in checked:
+			if not os.path.exists(path):
+				raise Exception('Missing .npy trace file: %s (path="%s")' \
+					% (key, ref))
+			checked.add(path)
+		lTrace.append(TraceStore.loadTrace(ref))
+	return lTrace
+
+def _processTraces(lTrace, traceLen, offset, lock, smoothParams=None,
+	deriv=0, safe=False):
+
+	"""
+	Smooths traces, takes the derivative, and takes the part that is
+	specified by traceLen, offset, and lock (see getTrace()).
+
+	Arguments:
+	lTrace			--	a list of 1D arrays
+	traceLen		--	see getTrace()
+	offset			--	see getTrace()
+	lock			--	see getTrace()
+
+	Keyword arguments:
+	smoothParams	--	see getTrace() (default=None)
+	deriv			--	see getTrace() (default=0)
+	safe			--	see _smoothTraces() (default=False)
+
+	Returns:
+	A list of 1D arrays.
+	"""
+
+	if smoothParams != None:
+		lTrace = _smoothTraces(lTrace, smoothParams, safe=safe)
+	if deriv > 0:
+		lTrace = [traceDeriv(aTrace, deriv) for aTrace in lTrace]
+	return _sliceTraces(lTrace, traceLen, offset, lock)
+
+def _smoothTraces(lTrace, smoothParams, safe=False):
+
+	"""
+	Smooths a list of traces. Traces of equal length are smoothed together.
+
+	Arguments:
+	lTrace			--	a list of 1D arrays
+	smoothParams	--	see smooth()
+
+	Keyword arguments:
+	safe			--	indicates whether traces that cannot be smoothed
+						should be left unsmoothed, with a warning, rather
+						than raising an Exception. (default=False)
+
+	Returns:
+	A list of 1D arrays.
+	"""
+
+	lTrace = list(lTrace)
+	dIndex = {}
+	for j, aTrace in enumerate(lTrace):
+		dIndex.setdefault(len(aTrace), []).append(j)
+	for n, lIndex in dIndex.iteritems():
+		mTrace = np.array([lTrace[j] for j in lIndex], dtype=float)
+		try:
+			mTrace = smooth(mTrace, axis=1, **smoothParams)
+		except:
+			if not safe:
+				raise
+			for j in lIndex:
+				warnings.warn('Failed to smooth trace of length %d' % n)
+			continue
+		for j, aTrace in zip(lIndex, mTrace):
+			lTrace[j] = aTrace
+	return lTrace
+
+def _sliceTraces(lTrace, traceLen, offset, lock):
+
+	"""
+	Takes a part of each trace in a list, as described for getTrace().
+
+	Arguments:
+	lTrace		--	a list of 1D arrays
+	traceLen	--	the length of the part
+	offset		--	the first (if lock == start) or last (if lock == end)
+					samples to skip
+	lock		--	'start' or 'end'
+
+	Returns:
+	A list of 1D arrays.
+	"""
+
+	if lock == 'start':
+		return [aTrace[offset:offset+traceLen] for aTrace in lTrace]
+	if offset > 0:
+		return [aTrace[-offset-traceLen:-offset] for aTrace in lTrace]
+	return [aTrace[-traceLen:] for aTrace in lTrace]
+
 def getTraceAvg(dm, avgFunc=nanmean, **traceParams):
 
 	"""
@@ -210,13 +496,7 @@ def getTraceAvg(dm, avgFunc=nanmean, **traceParams):
 	"""
 
 	traceLen = traceParams['traceLen']
-	mTrace = np.empty( (len(dm), traceLen) )
-	mTrace[:] = np.nan
-	i = 0
-	for trialDm in dm:
-		aTrace = getTrace(trialDm, **traceParams)
-		mTrace[i, 0:len(aTrace)] = aTrace
-		i += 1
+	mTrace = getTraceMatrix(dm, **traceParams)
 	xData = np.linspace(0, traceLen, traceLen)
 	yData = nanmean(mTrace, axis=0)
 	errData = nanstd(mTrace, axis=0) / np.sqrt(mTrace.shape[0])
@@ -227,12 +507,28 @@ def getTraceAvg(dm, avgFunc=nanmean, **traceParams):
 def getTracePeak(dm, peakFunc=np.nanmax, **traceParams):
 
 	a = getTrace(dm, **traceParams)
+	return _tracePeak(a, peakFunc)
+
+def _tracePeak(a, peakFunc):
+
+	"""
+	Gets the peak of a trace.
+
+	Arguments:
+	a			--	a trace
+	peakFunc	--	the function that determines the peak value
+
+	Returns:
+	An (xPeak, yPeak) tuple, where xPeak is the first sample with the peak
+	value.
+	"""
+
 	i = np.where(a == peakFunc(a))
 	xPeak = i[0][0]
 	yPeak = a[xPeak]
 	return xPeak, yPeak
 
-def getTracePeakAvg(dm, **traceParams):
+def getTracePeakAvg(dm, peakFunc=np.nanmax, **traceParams):
 
 	"""
 	desc:
@@ -243,6 +539,11 @@ def getTracePeakAvg(dm, **traceParams):
 			desc:	A DataMatrix.
 			type:	DataMatrix
 
+	keywords:
+		peakFunc:
+			desc:	The function that determines the peak value of a trace.
+			type:	function
+
 	keyword-dict:
 		*traceParams:	See getTrace()
 
@@ -251,16 +552,11 @@ def getTracePeakAvg(dm, **traceParams):
 		standard error.
 	"""
 
-	traceLen = traceParams['traceLen']
-	mTrace = np.empty( (len(dm), traceLen) )
-	mTrace[:] = np.nan
-	i = 0
+	mTrace = getTraceMatrix(dm, **traceParams)
 	aXPeak = np.empty(len(dm))
 	aYPeak = np.empty(len(dm))
-	for i, trialDm in enumerate(dm):
-		xPeak, yPeak = getTracePeak(trialDm, **traceParams)
-		aXPeak[i] = xPeak
-		aYPeak[i] = yPeak
+	for i, aTrace in enumerate(mTrace):
+		aXPeak[i], aYPeak[i] = _tracePeak(aTrace, peakFunc)
 	return aXPeak.mean(), aYPeak.mean(), np.std(aXPeak)/np.sqrt(len(aXPeak)), \
 		np.std(aYPeak)/np.sqrt(len(aYPeak))
 
@@ -428,8 +724,9 @@ def traceDiff(dm, select1, select2, epoch=None, **traceParams):
 		raise Exception('Epoch should be None, int, or (int, int)')
 	return d.mean()
 
-@cachedDataMatrix
-def mixedModelTrace(dm, model, winSize=1, effectIndex=1, **traceParams):
+@cachedDataMatrix(ignore=['workers'])
+def mixedModelTrace(dm, model, winSize=1, effectIndex=1, workers=1,
+	nanMean=False, **traceParams):
 
 	"""
 	desc:
@@ -452,6 +749,17 @@ def mixedModelTrace(dm, model, winSize=1, effectIndex=1, **traceParams):
 					each time. For a real analysis, this should be 1, but
 					for a quick look, it can be increased (default=1)
 			type:	int
+		workers:
+			desc:	The number of models that are fitted in parallel, each by
+					a separate R process. This does not affect the results,
+					and is not part of automatic cache keys.
+			type:	int
+		nanMean:
+			desc:	Indicates whether nan values, such as padding, should be
+					ignored when the mean of a window is calculated. If not,
+					the mean of a window that contains a nan value is nan.
+					Windows without valid samples are always nan.
+			type:	bool
 
 	keyword-dict:
 		*traceParams:	See getTrace().
@@ -467,38 +775,110 @@ def mixedModelTrace(dm, model, winSize=1, effectIndex=1, **traceParams):
 		- `t`: t-value of effect
 	"""
 
-	if not model.startswith('mmdv__ ~ '):
-		model = 'mmdv__ ~ ' + model
-	global R
-	try:
-		R
-	except:
-		R = RBridge()
+	if model.startswith('mmdv__ ~ '):
+		model = model[len('mmdv__ ~ '):]
 	traceLen = traceParams['traceLen']
-	l = [ ['i', 'effect', 'est', 'se', 't'] ]
-	for i in range(0, traceLen, winSize):
-		# First calculate the mean value for the current signal slice for each
-		# trial and save that in a copy of the DataMatrix
-		_dm = dm.addField('mmdv__', dtype=float)
-		for trialId in range(len(_dm)):
-			aTrace = getTrace(_dm[trialId], **traceParams)
-			if i < len(aTrace):
-				sliceMean = aTrace[i:i+winSize].mean()
-			else:
-				sliceMean = np.nan
-			_dm['mmdv__'][trialId] = sliceMean
-		# Do mixed effects
-		R.load(_dm)
-		_dm = R.lmer(model)
-		_dm._print(sign=4, title='%d - %d' % (i, i+winSize))
-		for k in range(winSize):
-			if i+k >= traceLen:
-				break
-			for j in _dm.range():
-					l.append([i+k, _dm['effect'][j], _dm['est'][j], _dm['se'][j],
-						_dm['t'][j]])
+	mTrace = getTraceMatrix(dm, **traceParams)
+	# The mean value of each window for each trial. These are saved as columns
+	# of a single csv file, so that the data is passed to R only once.
+	aStart = np.arange(0, traceLen, winSize)
+	if nanMean:
+		mValid = np.isfinite(mTrace)
+		with np.errstate(divide='ignore', invalid='ignore'):
+			mDv = np.add.reduceat(np.where(mValid, mTrace, 0), aStart,
+				axis=1) / np.add.reduceat(mValid.astype(int), aStart, axis=1)
+	else:
+		mDv = np.add.reduceat(mTrace, aStart, axis=1) \
+			/ np.diff(np.r_[aStart, traceLen])
+	fd, csvPath = tempfile.mkstemp(prefix='rbridge-mmdv-', suffix='.csv')
+	pool = None
+	try:
+		with os.fdopen(fd, 'w') as f:
+			_saveWindows(f, dm, mDv)
+		lFormula = ['mmdv__%d ~ %s' % (j, model) for j in range(len(aStart))]
+		# Models are fitted lazily, one by one or in parallel. Results are
+		# always returned in the order of the windows.
+		if workers > 1:
+			pool = multiprocessing.Pool(workers, _initLmerWorker, (csvPath,))
+			results = pool.imap(_lmerWorker, lFormula)
+		else:
+			global R
+			try:
+				R
+			except:
+				R = RBridge()
+			R.loadCsv(csvPath)
+			results = (R.lmer(formula) for formula in lFormula)
+		l = [ ['i', 'effect', 'est', 'se', 't'] ]
+		for i, _dm in zip(aStart, results):
+			_dm._print(sign=4, title='%d - %d' % (i, i+winSize))
+			for k in range(winSize):
+				if i+k >= traceLen:
+					break
+				for j in _dm.range():
+						l.append([i+k, _dm['effect'][j], _dm['est'][j],
+							_dm['se'][j], _dm['t'][j]])
+	finally:
+		if pool != None:
+			pool.close()
+			pool.join()
+		os.remove(csvPath)
 	return DataMatrix(l)
 
+def _saveWindows(f, dm, mDv):
+
+	"""
+	Writes a csv file for mixedModelTrace(), in the format of
+	DataMatrix.save(), with the columns of a DataMatrix followed by a column
+	`mmdv__[j]` for each window. All cells are formatted by a single
+	np.savetxt() call, and the window means are written with full
+	precision.
+
+	Arguments:
+	f		--	a file object
+	dm		--	a DataMatrix
+	mDv		--	a (trials x windows) array with the window means
+	"""
+
+	names = dm.columns()
+	nWin = mDv.shape[1]
+	a = np.empty((len(dm), len(names)+nWin), dtype=object)
+	for i, name in enumerate(names):
+		a[:,i] = dm[name]
+	a[:,len(names):] = mDv
+	header = ','.join(names + ['mmdv__%d' % j for j in range(nWin)])
+	np.savetxt(f, a, fmt=['%s']*len(names) + ['%.17g']*nWin, delimiter=',',
+		header=header, comments='')
+
+def _initLmerWorker(csvPath):
+
+	"""
+	Starts an R process in a worker process of mixedModelTrace().
+
+	Arguments:
+	csvPath	--	the csv file with the data
+	"""
+
+	# A separate variable, because the R process of the parent process is
+	# also visible in the worker process.
+	global workerR
+	workerR = RBridge(prefix='.rbridge-%d' % os.getpid())
+	workerR.loadCsv(csvPath)
+
+def _lmerWorker(formula):
+
+	"""
+	Fits a model in a worker process of mixedModelTrace().
+
+	Arguments:
+	formula	--	an lmer formula
+
+	Returns:
+	A DataMatrix, as returned by RBridge.lmer()
+	"""
+
+	return workerR.lmer(formula)
+
 def statsTrace(dm, key='t', intercept=False, show=True):
 
 	colors = brightColors[:]
@@ -572,7 +952,8 @@ def markStats(ax, aStat, below=False, _abs=True, thr=2., minSmp=200,
 			ax.axvline(i, color='black')
 	return lRoi
 
-def smooth(aTrace, windowLen=11, windowType='hanning', correctLen=True):
+def smooth(aTrace, windowLen=11, windowType='hanning', correctLen=True,
+	axis=-1):
 
 	"""
 	Source: <http://www.scipy.org/Cookbook/SignalSmooth>
@@ -584,6 +965,11 @@ def smooth(aTrace, windowLen=11, windowType='hanning', correctLen=True):
 	(with the window size) in both ends so that transient parts are minimized
 	in the begining and end part of the output signal.
 
+	Multidimensional arrays are smoothed along a single axis in one go, for
+	example a (trials x samples) array along axis 1, or a (samples x channels)
+	array along axis 0. Long windows are convolved through an FFT, unless the
+	signal contains nan or inf values.
+
 	Arguments:
 	aTrace		--	an array with the input signal
 
@@ -595,35 +981,109 @@ def smooth(aTrace, windowLen=11, windowType='hanning', correctLen=True):
 					average smoothing.
 	correctLen	--	indicates whether the return string should be the same
 					length as the input string (default=True).
+	axis		--	the axis along which the signal is smoothed (default=-1)
 
 	Returns:
 	An array with the smoothed signal
 	"""
 
-	if aTrace.ndim != 1:
-		raise ValueError("smooth only accepts 1 dimension arrays.")
-	if aTrace.size < windowLen:
+	aTrace = np.asarray(aTrace)
+	if aTrace.ndim == 0:
+		raise ValueError("smooth does not accept 0 dimension arrays.")
+	if aTrace.shape[axis] < windowLen:
 		raise ValueError("Input vector needs to be bigger than window size.")
 	if windowLen < 3:
 		return aTrace
 	if not windowType in ['flat', 'hanning', 'hamming', 'bartlett', 'blackman']:
 		raise ValueError( \
 			"Window is on of 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'")
-	s = np.r_[aTrace[windowLen-1:0:-1], aTrace, aTrace[-1:-windowLen:-1]]
-	if windowType == 'flat': #moving average
-		w = np.ones(windowLen, 'd')
-	else:
-		func = getattr(np, windowType)
-		w = func(windowLen)
-	y = np.convolve(w/w.sum(), s, mode='valid')
+	w = _smoothWindow(windowLen, windowType)
+	a = np.swapaxes(aTrace, axis, -1)
+	n = a.shape[-1]
+	s = np.concatenate([a[...,windowLen-1:0:-1], a, a[...,-1:-windowLen:-1]],
+		axis=-1)
+	# The samples of the 'valid' convolution that are returned
 	if correctLen:
-		y = y[(windowLen/2-1):-(windowLen/2)]
+		iFrom = windowLen/2-1
 		# The output array can be one shorter than the input array
-		if len(y) > len(aTrace):
-			y = y[:len(aTrace)]
-		elif len(y) < len(aTrace):
+		nOut = min(n, n+windowLen-1-iFrom-windowLen/2)
+		if nOut < n:
 			raise Exception('The output array is too short!')
-	return y
+	else:
+		iFrom = 0
+		nOut = n+windowLen-1
+	if windowLen >= fftWindowLen and np.isfinite(s).all():
+		y = _fftConvolve(s, w)
+	else:
+		y = _directConvolve(s, w)
+	return np.swapaxes(y[...,iFrom:iFrom+nOut], axis, -1)
+
+def _smoothWindow(windowLen, windowType):
+
+	"""
+	Gets a normalized smoothing window. Windows are cached.
+
+	Arguments:
+	windowLen	--	the length of the window
+	windowType	--	the window type, as accepted by smooth()
+
+	Returns:
+	A read-only array that sums to 1
+	"""
+
+	key = windowLen, windowType
+	if key not in windowCache:
+		if windowType == 'flat':
+			w = np.ones(windowLen, 'd')
+		else:
+			w = getattr(np, windowType)(windowLen)
+		w = w/w.sum()
+		w.flags.writeable = False
+		windowCache[key] = w
+	return windowCache[key]
+
+def _directConvolve(s, w):
+
+	"""
+	Convolves signals with a window, along the last axis. All signals are
+	convolved in a single call to np.convolve() by putting them end to end.
+	This does not mix signals, because only the 'valid' part of the
+	convolution of each signal is kept.
+
+	Arguments:
+	s			--	an array of signals
+	w			--	a 1-D window
+
+	Returns:
+	The 'valid' part of the convolution, as given by np.convolve()
+	"""
+
+	n = s.shape[-1]
+	if s.ndim == 1:
+		return np.convolve(w, s, mode='valid')
+	y = np.convolve(w, s.reshape(-1), mode='valid')
+	y = np.r_[y, np.zeros(len(w)-1)]
+	return y.reshape(s.shape)[...,:n-len(w)+1]
+
+def _fftConvolve(s, w):
+
+	"""
+	Convolves signals with a window through an FFT, along the last axis.
+
+	Arguments:
+	s			--	an array of signals
+	w			--	a 1-D window
+
+	Returns:
+	The 'valid' part of the convolution, as given by np.convolve()
+	"""
+
+	n = s.shape[-1]
+	nFull = n+len(w)-1
+	nFft = 2**int(np.ceil(np.log2(nFull)))
+	y = np.fft.irfft(np.fft.rfft(s, nFft, axis=-1) * np.fft.rfft(w, nFft),
+		nFft, axis=-1)
+	return y[...,len(w)-1:n]
 
 def downSample(aTrace, i):
 
@@ -748,18 +1208,23 @@ def latency(aTrace, at=None, vt=None, plot=False):
 def blinkReconstruct(aTrace, vt=5, maxDur=500, margin=10, plot=False):
 
 	"""
-	Reconstructs pupil size during blinks.
+	Reconstructs pupil size during blinks. A blink starts when the pupil
+	velocity drops below -vt, reverses when the velocity rises above vt, and
+	ends when the velocity drops below zero again. Blinks are interpolated
+	with a cubic polynomial through four points around the blink or, near the
+	edges of the trace, linearly.
 
 	Arguments:
-	aTrace		--	The input trace.
+	aTrace		--	The input trace, or a 2-D (trials x samples) array with
+					one trace on each row.
 
 	Keyword arguments:
 	pvt			--	The pupil velocity threshold. Lower tresholds more easily
 					trigger blinks (default=5.)
 	maxDur		--	The maximum duration for a blink. Longer blinks are
 					ignored. (default=500)
-	plot		--	Indicates whether the algorithm should be plotted.
-					(default=False)
+	plot		--	Indicates whether the algorithm should be plotted. This is
+					only possible for a single trace. (default=False)
 
 	Returns:
 	An array with the reconstructed pupil data or an (array, figure) tuple when
@@ -767,15 +1232,20 @@ def blinkReconstruct(aTrace, vt=5, maxDur=500, margin=10, plot=False):
 	"""
 
 	# Create a copy of the signal, a smoothed version, and calculate the
-	# velocity profile.
+	# velocity profile. A single trace is processed as a 2-D array with one
+	# row, which is a view on the same data.
 	aTrace = np.copy(aTrace)
+	if aTrace.ndim not in (1, 2):
+		raise Exception('Only 1 and 2-dimensional arrays are allowed')
+	if plot and aTrace.ndim != 1:
+		raise Exception('Only a single trace can be plotted')
+	a2d = aTrace.reshape(-1, aTrace.shape[-1])
 	try:
-		sTrace = smooth(aTrace, windowLen=21)
+		s2d = smooth(a2d, windowLen=21, axis=1)
 	except Exception as e:
 		warnings.warn(str(e))
-		sTrace = aTrace
-
-	vTrace = sTrace[1:]-sTrace[:-1]
+		s2d = a2d
+	v2d = s2d[:,1:]-s2d[:,:-1]
 
 	if plot:
 		plt.clf()
@@ -790,87 +1260,54 @@ def blinkReconstruct(aTrace, vt=5, maxDur=500, margin=10, plot=False):
 		plt.ylabel('Pupil size (arbitrary units)')
 		plt.subplot(2,2,2)
 		plt.title('Smoothed signal')
-		plt.plot(sTrace, color=blue[1])
+		plt.plot(s2d[0], color=blue[1])
 		plt.xlabel('Time (ms)')
 		plt.ylabel('Pupil size (arbitrary units)')
 		plt.subplot(2,2,3)
 		plt.title('Velocity profile')
-		plt.plot(vTrace, color=blue[1])
+		plt.plot(v2d[0], color=blue[1])
 		plt.xlabel('Time (ms)')
 		plt.ylabel('Velocity (arbitrary units)')
 
-	# Start blink detection
-	iFrom = 0
-	lBlink = []
-	while True:
-		# The onset of the blink is the moment at which the pupil velocity
-		# exceeds the threshold.
-		l = np.where(vTrace[iFrom:] < -vt)[0]
-		if len(l) == 0:
-			break # No blink detected
-		iStart = l[0]+iFrom
-		if iFrom == iStart:
-			break
-		# The reversal period is the moment at which the pupil starts to dilate
-		# again with a velocity above threshold.
-		l = np.where(vTrace[iStart:] > vt)[0]
-		if len(l) == 0:
-			iFrom = iStart
-			continue
-		iMid = l[0]+iStart
-		# The end blink period is the moment at which the pupil velocity drops
-		# back to zero again.
-		l = np.where(vTrace[iMid:] < 0)[0]
-		if len(l) == 0:
-			iFrom = iMid
-			continue
-		iEnd = l[0]+iMid
-		iFrom = iEnd
-		# We generally underestimate the blink period, so compensate for this
-		if iStart-margin >= 0:
-			iStart -= margin
-		if iEnd+margin < len(aTrace):
-			iEnd += margin
-		# We don't accept blinks that are too long, because blinks are not
-		# generally very long (although they can be).
-		if iEnd-iStart > maxDur:
-			continue
-		if plot:
-			plt.axvspan(iStart, iEnd, color=gray[-1], alpha=.4)
-		lBlink.append( (iStart, iEnd) )
+	aRow, aStart, aEnd = _detectBlinks(v2d, vt=vt, maxDur=maxDur,
+		margin=margin)
 
 	if plot:
+		for iStart, iEnd in zip(aStart, aEnd):
+			plt.axvspan(iStart, iEnd, color=gray[-1], alpha=.4)
 		plt.subplot(2,2,4)
 		plt.title('Reconstructed signal')
 
-	# Now reconstruct the trace during the blinks
-	for iStart, iEnd in lBlink:
-		# First create a list of (when possible) four data points that we can
-		# use for interpolation.
-		dur = iEnd - iStart
-		l = []
-		if iStart-dur >= 0:
-			l += [iStart-dur]
-		l += [iStart, iEnd]
-		if iEnd+dur < len(sTrace):
-			l += [iEnd+dur]
-		x = np.array(l)
-		# If the list is long enough we use cubic interpolation, otherwise we
-		# use linear interpolation
-		y = aTrace[x]
-
-		if plot:
-			plt.plot(x, y, 'o', color=orange[1])
-
-		if len(x) >= 4:
-			f2 = interp1d(x, y, kind='cubic')
-		else:
-			f2 = interp1d(x, y)
-		xInt = np.arange(iStart, iEnd)
-		yInt = f2(xInt)
-		aTrace[xInt] = yInt
+	# Now reconstruct the trace during the blinks. Blinks are interpolated in
+	# batches, in which blinks do not overlap and do not use each other's
+	# samples as interpolation points. Blinks that depend on earlier blinks
+	# in this way are interpolated in a later batch, so that the result is
+	# the same as when interpolating blinks one by one.
+	aX, aValid = _blinkPoints(aStart, aEnd, a2d.shape[1])
+	aLevel = np.zeros(len(aStart), dtype=int)
+	iFirst = 0
+	for i in range(len(aStart)):
+		# Blinks are sorted by row, so only the preceding blinks on the same
+		# row need to be considered.
+		if aRow[i] != aRow[iFirst]:
+			iFirst = i
+		if i == iFirst:
+			continue
+		prev = slice(iFirst, i)
+		x = aX[i][aValid[i]][:,np.newaxis]
+		dep = ((x >= aStart[prev]) & (x < aEnd[prev])).any(axis=0)
+		dep |= (aValid[prev] & (aX[prev] >= aStart[i]) & \
+			(aX[prev] < aEnd[i])).any(axis=1)
+		dep |= (aStart[prev] < aEnd[i]) & (aEnd[prev] > aStart[i])
+		if dep.any():
+			aLevel[i] = aLevel[prev][dep].max() + 1
+	for level in range(aLevel.max()+1 if len(aLevel) > 0 else 0):
+		i = aLevel == level
+		_interpolateBlinks(a2d, aRow[i], aX[i], aValid[i])
 
 	if plot:
+		x = aX[aValid]
+		plt.plot(x, aTrace[x], 'o', color=orange[1])
 		plt.plot(aTrace, color=blue[1])
 		plt.xlabel('Time (ms)')
 		plt.ylabel('Pupil size (arbitrary units)')
@@ -879,6 +1316,154 @@ def blinkReconstruct(aTrace, vt=5, maxDur=500, margin=10, plot=False):
 		return aTrace, fig
 	return aTrace
 
+def _detectBlinks(v2d, vt, maxDur, margin):
+
+	"""
+	Detects blinks in a 2-D array of velocity profiles. For each sample, the
+	next onset, reversal, and end transition is looked up in a single pass
+	over the entire array, so that a blink is found with only a few lookups.
+
+	Arguments:
+	v2d			--	A 2-D (trials x samples) array of velocities.
+	vt			--	The velocity threshold.
+	maxDur		--	The maximum duration for a blink.
+	margin		--	The number of samples that is added to both sides of a
+					blink.
+
+	Returns:
+	A (rows, starts, ends) tuple of arrays, where a blink runs from start up
+	to (but not including) end.
+	"""
+
+	nRow, n = v2d.shape
+	nSample = n+1
+	# For each sample, the index of the first sample at or after it that
+	# matches, or n if there is none. The sentinel column allows lookups at
+	# index n.
+	aIndex = np.arange(n+1)
+	def nextIndex(mask):
+		a = np.where(np.c_[mask, np.ones(nRow, dtype=bool)], aIndex, n)
+		return np.minimum.accumulate(a[:,::-1], axis=1)[:,::-1]
+	aOnset = nextIndex(v2d < -vt)
+	aReversal = nextIndex(v2d > vt)
+	aTurn = nextIndex(v2d < 0)
+	lRow = []
+	lStart = []
+	lEnd = []
+	for row in range(nRow):
+		onset = aOnset[row]
+		reversal = aReversal[row]
+		turn = aTurn[row]
+		iFrom = 0
+		while True:
+			# The onset of the blink is the moment at which the pupil velocity
+			# exceeds the threshold.
+			iStart = onset[iFrom]
+			if iStart == n:
+				break # No blink detected
+			if iFrom == iStart:
+				break
+			# The reversal period is the moment at which the pupil starts to
+			# dilate again with a velocity above threshold.
+			iMid = reversal[iStart]
+			if iMid == n:
+				iFrom = iStart
+				continue
+			# The end blink period is the moment at which the pupil velocity
+			# drops back to zero again.
+			iEnd = turn[iMid]
+			if iEnd == n:
+				iFrom = iMid
+				continue
+			iFrom = iEnd
+			# We generally underestimate the blink period, so compensate for
+			# this
+			if iStart-margin >= 0:
+				iStart -= margin
+			if iEnd+margin < nSample:
+				iEnd += margin
+			# We don't accept blinks that are too long, because blinks are not
+			# generally very long (although they can be).
+			if iEnd-iStart > maxDur:
+				continue
+			lRow.append(row)
+			lStart.append(iStart)
+			lEnd.append(iEnd)
+	return np.array(lRow, dtype=int), np.array(lStart, dtype=int), \
+		np.array(lEnd, dtype=int)
+
+def _blinkPoints(aStart, aEnd, nSample):
+
+	"""
+	Determines the points that are used to interpolate blinks: one blink
+	duration before the blink, the start and end of the blink, and one blink
+	duration after the blink. The outer points are only valid if they fall
+	inside the trace.
+
+	Arguments:
+	aStart		--	An array of blink starts.
+	aEnd		--	An array of blink ends.
+	nSample		--	The length of the traces.
+
+	Returns:
+	An (x, valid) tuple of (blinks x 4) arrays.
+	"""
+
+	aDur = aEnd-aStart
+	aX = np.c_[aStart-aDur, aStart, aEnd, aEnd+aDur].astype(int)
+	aValid = np.ones(aX.shape, dtype=bool)
+	aValid[:,0] = aX[:,0] >= 0
+	aValid[:,3] = aX[:,3] < nSample
+	return aX, aValid
+
+def _interpolateBlinks(a2d, aRow, aX, aValid):
+
+	"""
+	Interpolates a batch of blinks in place. Blinks with four valid points
+	are interpolated with the cubic polynomial through these points, which is
+	what a cubic spline through four points reduces to. Other blinks are
+	interpolated linearly between the start and the end of the blink.
+
+	Arguments:
+	a2d			--	A 2-D (trials x samples) array.
+	aRow		--	An array with the row of each blink.
+	aX			--	A (blinks x 4) array of interpolation points.
+	aValid		--	A (blinks x 4) array that indicates which points are
+					valid.
+	"""
+
+	if len(aRow) == 0:
+		return
+	nSample = a2d.shape[1]
+	aFlat = a2d.reshape(-1)
+	aOffset = aRow*nSample
+	aY = aFlat[aOffset[:,np.newaxis] + np.clip(aX, 0, nSample-1)].astype(
+		float)
+	# Expand all blinks into a single array of samples, with for each sample
+	# the blink that it belongs to.
+	aDur = aX[:,2]-aX[:,1]
+	aBlink = np.repeat(np.arange(len(aRow)), aDur)
+	aPos = np.arange(aDur.sum()) - np.repeat(np.cumsum(aDur)-aDur, aDur) \
+		+ aX[aBlink,1]
+	x = aX[aBlink].astype(float)
+	y = aY[aBlink]
+	xNew = aPos.astype(float)
+	aInt = y[:,1] + (y[:,2]-y[:,1]) / (x[:,2]-x[:,1]) * (xNew-x[:,1])
+	cubic = aValid[aBlink].all(axis=1)
+	if cubic.any():
+		x = x[cubic]
+		y = y[cubic]
+		xNew = xNew[cubic]
+		yCubic = np.zeros(len(xNew))
+		for j in range(4):
+			w = np.ones(len(xNew))
+			for m in range(4):
+				if m != j:
+					w *= (xNew-x[:,m]) / (x[:,j]-x[:,m])
+			yCubic += w*y[:,j]
+		aInt[cubic] = yCubic
+	aFlat[aOffset[aBlink] + aPos] = aInt
+
 @cachedDataMatrix
 def splitTrace(dm, splitCol, phase, phaseBefore=None, phaseAfter=None, \
 	traceTemplate='__trace_%s__'):
@@ -916,8 +1501,18 @@ def splitTrace(dm, splitCol, phase, phaseBefore=None, phaseAfter=None, \
 		dm = dm.addField(traceTemplate % phaseAfter, dtype=str)
 	for i in dm.range():
 		npy =  dm[traceTemplate % phase][i]
-		a = np.load(npy)
 		split = dm[splitCol][i]
+		# Traces in a trace store are split by referring to parts of the
+		# original trace.
+		if TraceStore.isReference(npy):
+			if phaseBefore != None:
+				dm[traceTemplate % phaseBefore][i] = \
+					TraceStore.sliceReference(npy, end=split)
+			if phaseAfter != None:
+				dm[traceTemplate % phaseAfter][i] = \
+					TraceStore.sliceReference(npy, start=split)
+			continue
+		a = np.load(npy)
 		aBefore = a[:split]
 		aAfter = a[split:]
 		if phaseBefore != None:
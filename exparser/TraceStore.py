@@ -0,0 +1,293 @@
+#-*- coding:utf-8 -*-
+
+"""
+This file is part of exparser.
+
+exparser is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+exparser is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with exparser.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import struct
+import numpy as np
+
+# Memory-mapped trace stores, indexed by path
+openStores = {}
+# The number of times that each trace store has been rewritten in this
+# process, indexed by path. This allows caches to detect outdated traces.
+storeVersions = {}
+# The size of the `.npy` header that TraceStoreWriter reserves at the start of
+# a store, and fills in when the store is closed. This is a multiple of 64, so
+# that the traces are aligned.
+headerSize = 128
+
+def reference(path, start, end):
+
+	"""
+	desc:
+		Creates a reference to a trace in a trace store. A reference is a
+		string of the form `[path][[start]:[end]]`, such as
+		`traces/pp1.asc.npy[1200:3400]`.
+
+	arguments:
+		path:
+			desc:	The path to the trace store.
+			type:	[str, unicode]
+		start:
+			desc:	The first sample of the trace.
+			type:	int
+		end:
+			desc:	The sample after the last sample of the trace.
+			type:	int
+
+	returns:
+		desc:	A reference.
+		type:	str
+	"""
+
+	return '%s[%d:%d]' % (path, start, end)
+
+def parseReference(ref):
+
+	"""
+	desc:
+		Splits a reference into a path, start, and end. Plain paths, which
+		refer to a `.npy` file with a single trace, are also accepted.
+
+	arguments:
+		ref:
+			desc:	A reference or path.
+			type:	[str, unicode]
+
+	returns:
+		desc:	A (path, start, end) tuple. For plain paths, start and end are
+				None.
+		type:	tuple
+	"""
+
+	if not ref.endswith(']') or '[' not in ref:
+		return ref, None, None
+	path, _slice = ref[:-1].rsplit('[', 1)
+	start, end = _slice.split(':')
+	return path, int(start), int(end)
+
+def isReference(ref):
+
+	"""
+	arguments:
+		ref:
+			desc:	A reference or path.
+			type:	[str, unicode]
+
+	returns:
+		desc:	True if `ref` refers to a trace in a trace store, False if it
+				is a plain path.
+		type:	bool
+	"""
+
+	return parseReference(ref)[1] != None
+
+def exists(ref):
+
+	"""
+	arguments:
+		ref:
+			desc:	A reference or path.
+			type:	[str, unicode]
+
+	returns:
+		desc:	True if the file that contains the trace exists, False
+				otherwise.
+		type:	bool
+	"""
+
+	return os.path.exists(parseReference(ref)[0])
+
+def loadTrace(ref):
+
+	"""
+	desc: |
+		Loads a trace. Traces in a trace store are read-only slices of the
+		memory-mapped store, so no data is copied until it is used. Plain
+		paths are loaded with `np.load()`.
+
+	arguments:
+		ref:
+			desc:	A reference or path.
+			type:	[str, unicode]
+
+	returns:
+		desc:	A (samples x channels) array.
+		type:	ndarray
+	"""
+
+	path, start, end = parseReference(ref)
+	if start == None:
+		return np.load(path)
+	if path not in openStores:
+		# A regular array is slightly faster to slice than np.memmap, and
+		# Python 2 slices np.memmap incorrectly with negative indices.
+		openStores[path] = np.asarray(np.load(path, mmap_mode='r'))
+	return openStores[path][start:end]
+
+def invalidate(path):
+
+	"""
+	desc:
+		Indicates that a trace store has been rewritten, so that traces are
+		not taken from an outdated memory map or cache. This is done
+		automatically when a store is written by a TraceStoreWriter in the
+		same process.
+
+	arguments:
+		path:
+			desc:	The path to the trace store.
+			type:	[str, unicode]
+	"""
+
+	if path in openStores:
+		del openStores[path]
+	storeVersions[path] = storeVersions.get(path, 0) + 1
+
+def sliceReference(ref, start=None, end=None):
+
+	"""
+	desc:
+		Creates a reference to part of a trace, without copying any data.
+		Start and end are interpreted like a Python slice of the trace.
+
+	arguments:
+		ref:
+			desc:	A reference to a trace in a trace store.
+			type:	[str, unicode]
+
+	keywords:
+		start:
+			desc:	The first sample, relative to the start of the trace.
+			type:	[int, NoneType]
+		end:
+			desc:	The sample after the last sample, relative to the start
+					of the trace.
+			type:	[int, NoneType]
+
+	returns:
+		desc:	A reference.
+		type:	str
+	"""
+
+	path, _start, _end = parseReference(ref)
+	if _start == None:
+		raise Exception('%s does not refer to a trace store' % ref)
+	start, end, step = slice(start, end).indices(_end-_start)
+	end = max(start, end)
+	return reference(path, _start+start, _start+end)
+
+class TraceStoreWriter(object):
+
+	"""
+	desc:
+		Writes all traces of a session into a single `.npy` file. Traces are
+		appended to a temporary file while parsing, so they do not need to be
+		kept in memory. Space for the header is reserved at the start of the
+		file, and the header is filled in by close(), which then renames the
+		file to the store, so that each trace is written only once.
+	"""
+
+	def __init__(self, path):
+
+		"""
+		desc:
+			Constructor.
+
+		arguments:
+			path:
+				desc:	The path of the trace store.
+				type:	[str, unicode]
+		"""
+
+		self.path = path
+		self.fd = None
+		self.n = 0
+		self.nChannel = None
+
+	def add(self, a):
+
+		"""
+		desc:
+			Adds a trace.
+
+		arguments:
+			a:
+				desc:	A (samples x channels) array. All traces in a store
+						must have the same number of channels.
+				type:	ndarray
+
+		returns:
+			desc:	A reference to the trace.
+			type:	str
+		"""
+
+		a = np.ascontiguousarray(a, dtype=np.float64)
+		if self.nChannel == None:
+			self.nChannel = a.shape[1]
+			self.fd = open(self.path + '.tmp', 'wb')
+			self.fd.write(' ' * headerSize)
+		elif a.shape[1] != self.nChannel:
+			raise Exception('All traces should have %d channels' \
+				% self.nChannel)
+		self.fd.write(a.tostring())
+		ref = reference(self.path, self.n, self.n+len(a))
+		self.n += len(a)
+		return ref
+
+	def close(self):
+
+		"""
+		desc:
+			Writes the trace store. Nothing is written if no traces have been
+			added.
+		"""
+
+		if self.fd == None:
+			return
+		self.fd.seek(0)
+		self.fd.write(_header((self.n, self.nChannel)))
+		self.fd.close()
+		self.fd = None
+		# The store is written to a temporary file and then renamed, so that
+		# memory maps of an existing store remain valid.
+		os.rename(self.path + '.tmp', self.path)
+		invalidate(self.path)
+
+def _header(shape):
+
+	"""
+	Creates a version 1.0 `.npy` header for a float64 array, padded to
+	headerSize bytes.
+
+	Arguments:
+	shape -- the shape of the array
+
+	Returns:
+	The header as a string.
+	"""
+
+	d = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % ( \
+		np.lib.format.dtype_to_descr(np.dtype(np.float64)), shape)
+	# The magic string and version, the length of the dict, and the dict,
+	# which is padded with spaces and ends with a newline.
+	magic = np.lib.format.magic(1, 0)
+	dictLen = headerSize - len(magic) - 2
+	if len(d) + 1 > dictLen:
+		raise Exception('The header does not fit in %d bytes' % headerSize)
+	return magic + struct.pack('<H', dictLen) + d.ljust(dictLen-1) + '\n'
@@ -0,0 +1,211 @@
+#-*- coding:utf-8 -*-
+
+"""
+This file is part of exparser.
+
+exparser is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+exparser is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with exparser.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from exparser import Cache
+from exparser.DataMatrix import DataMatrix
+
+# The arguments of all calls of the cached functions below
+calls = []
+
+@Cache.cachedArray
+def arange(n, workers=1):
+
+	calls.append(n)
+	return np.arange(n, dtype=float)
+
+@Cache.cachedArray(ignore=['workers'])
+def arangeIgnore(n, workers=1):
+
+	calls.append(n)
+	return np.arange(n, dtype=float)
+
+@Cache.cachedDataMatrix
+def dataMatrix(n):
+
+	calls.append(n)
+	return DataMatrix([['a', 'b']] + [[i, 'x%d' % i] for i in range(n)])
+
+def funcFromSource(src):
+
+	"""
+	Defines a function `func` from source code, so that functions with the
+	same name, but with different code, can be compared.
+	"""
+
+	namespace = {}
+	exec src in namespace
+	return namespace['func']
+
+class TestCache(unittest.TestCase):
+
+	def setUp(self):
+
+		self.cacheFolder = Cache.cacheFolder
+		Cache.cacheFolder = tempfile.mkdtemp()
+		Cache.memoryCache.clear()
+		del calls[:]
+
+	def tearDown(self):
+
+		shutil.rmtree(Cache.cacheFolder)
+		Cache.cacheFolder = self.cacheFolder
+		Cache.memoryCache.clear()
+
+	def testAutoKeyIsStable(self):
+
+		"""
+		Automatic cache keys do not depend on the order of keywords or on
+		the identity of the arguments.
+		"""
+
+		dm1 = DataMatrix([['a'], [1], [2]])
+		dm2 = DataMatrix([['a'], [1], [2]])
+		self.assertEqual(
+			Cache.cacheKey(arange, [dm1], {'x' : 1, 'y' : [1, 2]}),
+			Cache.cacheKey(arange, [dm2], {'y' : [1, 2], 'x' : 1}))
+		self.assertEqual(arange(3, cacheId='auto').tolist(), [0, 1, 2])
+		self.assertEqual(arange(3, cacheId='auto').tolist(), [0, 1, 2])
+		Cache.memoryCache.clear()
+		self.assertEqual(arange(3, cacheId='auto').tolist(), [0, 1, 2])
+		self.assertEqual(calls, [3])
+
+	def testAutoKeyIsInvalidated(self):
+
+		"""
+		Automatic cache keys change when the arguments, the contents of a
+		DataMatrix, or the code of the function change, but not when ignored
+		keywords change.
+		"""
+
+		key = Cache.cacheKey(arange, [3], {})
+		self.assertNotEqual(key, Cache.cacheKey(arange, [4], {}))
+		self.assertNotEqual(key, Cache.cacheKey(arange, [3.], {}))
+		self.assertNotEqual(key, Cache.cacheKey(arange, [3], {'workers' : 2}))
+		self.assertEqual(key, Cache.cacheKey(arange, [3], {'workers' : 2},
+			ignore=['workers']))
+		dm = DataMatrix([['a'], [1], [2]])
+		key = Cache.cacheKey(arange, [dm], {})
+		dm['a'][0] = 3
+		self.assertNotEqual(key, Cache.cacheKey(arange, [dm], {}))
+		func1 = funcFromSource('def func(x):\n\treturn x+1\n')
+		func2 = funcFromSource('def func(x):\n\treturn x+2\n')
+		self.assertNotEqual(Cache.cacheKey(func1, [3], {}),
+			Cache.cacheKey(func2, [3], {}))
+		arange(3, cacheId='auto')
+		arange(4, cacheId='auto')
+		arange(3, workers=2, cacheId='auto')
+		arangeIgnore(3, cacheId='auto')
+		arangeIgnore(3, workers=2, cacheId='auto')
+		self.assertEqual(calls, [3, 4, 3, 3])
+
+	def testPrune(self):
+
+		"""
+		prune() removes the least recently accessed entries until the cache
+		fits in the budget, and hits that are still in the hit log count as
+		accesses.
+		"""
+
+		for n in (1000, 1001, 1002):
+			arange(n, cacheId='arange%d' % n)
+			time.sleep(.01)
+		Cache.memoryCache.clear()
+		arange(1000, cacheId='arange1000')
+		self.assertEqual(calls, [1000, 1001, 1002])
+		size = Cache.stats()['size']
+		maxBytes = size - 8000
+		self.assertEqual(Cache.prune(maxBytes), ['arange1001.npy'])
+		stats = Cache.stats()
+		self.assertEqual(stats['entries'], 2)
+		self.assertLessEqual(stats['size'], maxBytes)
+		self.assertEqual(stats['hits'], 1)
+		self.assertEqual(stats['evictions'], 1)
+		self.assertFalse(os.path.exists(os.path.join(Cache.cacheFolder,
+			'arange1001.npy')))
+		self.assertEqual(len(Cache.prune(0)), 2)
+		self.assertEqual(Cache.stats()['entries'], 0)
+
+	def testMemoryHitsAreIndependent(self):
+
+		"""
+		Changing a value that was taken from memoryCache does not change the
+		cached value.
+		"""
+
+		a = arange(3, cacheId='arange')
+		a[0] = 100
+		a = arange(3, cacheId='arange')
+		self.assertEqual(a.tolist(), [0, 1, 2])
+		a[0] = 100
+		self.assertEqual(arange(3, cacheId='arange').tolist(), [0, 1, 2])
+		dm = dataMatrix(2, cacheId='dataMatrix')
+		dm['a'][0] = 100
+		dm['b'][1] = 'y'
+		dm = dataMatrix(2, cacheId='dataMatrix')
+		self.assertEqual(list(dm['a']), [0, 1])
+		dm['a'][0] = 100
+		dm['b'][1] = 'y'
+		dm = dataMatrix(2, cacheId='dataMatrix')
+		self.assertEqual(list(dm['a']), [0, 1])
+		self.assertEqual(list(dm['b']), ['x0', 'x1'])
+		self.assertEqual(calls, [3, 2])
+
+	def testTruncatedEntry(self):
+
+		"""
+		A truncated entry is removed and computed again.
+		"""
+
+		arange(1000, cacheId='arange')
+		path = os.path.join(Cache.cacheFolder, 'arange.npy')
+		with open(path, 'rb') as fd:
+			data = fd.read()
+		for size in (len(data)/2, 40, 0):
+			with open(path, 'wb') as fd:
+				fd.write(data[:size])
+			Cache.memoryCache.clear()
+			a = arange(1000, cacheId='arange')
+			np.testing.assert_array_equal(a, np.arange(1000))
+			with open(path, 'rb') as fd:
+				self.assertEqual(fd.read(), data)
+		self.assertEqual(calls, [1000]*4)
+
+	def testLockTwice(self):
+
+		"""
+		Locking an entry twice in the same thread raises an Exception,
+		instead of waiting forever.
+		"""
+
+		path = os.path.join(Cache.cacheFolder, 'entry')
+		lock = Cache._lock(path)
+		try:
+			self.assertRaises(Exception, Cache._lock, path)
+		finally:
+			Cache._unlock(lock)
+		Cache._unlock(Cache._lock(path))
+
+if __name__ == '__main__':
+	unittest.main()
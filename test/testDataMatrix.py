@@ -0,0 +1,210 @@
+#-*- coding:utf-8 -*-
+
+"""
+This file is part of exparser.
+
+exparser is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+exparser is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with exparser.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from exparser.DataMatrix import DataMatrix
+
+class TestDataMatrix(unittest.TestCase):
+
+	"""
+	Tests for DataMatrix.
+	"""
+
+	def dataMatrix(self):
+
+		return DataMatrix([['a', 'b', 'c'], [1, 'x', 1.5], [2, 'y', 2.5],
+			[1, 'z', 3.5], [2, 'w', 4.5]])
+
+	def testSelectionIsIndependentOfBase(self):
+
+		"""
+		A selection does not see later changes to its base, regardless of
+		whether the selection has already accessed the changed column.
+		"""
+
+		dm = self.dataMatrix()
+		s1 = dm.select('a == 1', verbose=False)
+		s2 = dm[1:3]
+		s3 = s2[1:]
+		r = dm[0]
+		self.assertEqual(list(s2['c']), [2.5, 3.5])
+		dm['c'] = 0
+		dm['a'][:] = 5
+		dm.recode('b', ('x', 'q'))
+		self.assertEqual(list(s1['c']), [1.5, 3.5])
+		self.assertEqual(list(s1['a']), [1, 1])
+		self.assertEqual(list(s1['b']), ['x', 'z'])
+		self.assertEqual(list(s2['c']), [2.5, 3.5])
+		self.assertEqual(list(s3['c']), [3.5])
+		self.assertEqual(list(r['b']), ['x'])
+
+	def testSelectionIsIndependentOfStructuredArray(self):
+
+		"""
+		Changes to the base through its structured array are not visible in
+		a selection.
+		"""
+
+		dm = self.dataMatrix()
+		dm.m
+		s = dm.select('a == 2', verbose=False)
+		dm.m['c'][:] = 0
+		dm.sort('b')
+		dm.withinize('c', 'c', 'a', verbose=False)
+		self.assertEqual(list(s['c']), [2.5, 4.5])
+		self.assertEqual(list(s['b']), ['y', 'w'])
+
+	def testBaseIsIndependentOfSelection(self):
+
+		"""
+		Changes to a selection are not visible in its base.
+		"""
+
+		dm = self.dataMatrix()
+		s = dm.select('a == 1', verbose=False)
+		s['c'] = 0
+		self.assertEqual(list(dm['c']), [1.5, 2.5, 3.5, 4.5])
+
+	def testStringColumnsAreCoded(self):
+
+		"""
+		String columns are stored as codes, and changes to the decoded column
+		are passed on to the codes, also through slices.
+		"""
+
+		dm = self.dataMatrix()
+		codes, levels = dm._stringCodes('b')
+		self.assertEqual(codes.dtype, np.int32)
+		self.assertEqual(dm.unique('b'), ['w', 'x', 'y', 'z'])
+		dm['b'][0] = 'v'
+		dm['b'][1:3] = 'u'
+		dm['b'][dm['a'] == 2] += '!'
+		a = dm['b'][2:]
+		a[1] = 't'
+		a += '?'
+		dm['b'][-1:].fill('s')
+		self.assertEqual(list(dm['b']), ['v', 'u!', 'u?', 's'])
+		self.assertEqual(dm.unique('b'), ['s', 'u!', 'u?', 'v'])
+		self.assertEqual(list(dm.select('b == "u!"', verbose=False)['a']),
+			[2])
+		self.assertEqual(list(dm.m['b']), ['v', 'u!', 'u?', 's'])
+
+	def testStructuredArrayWritesStrings(self):
+
+		"""
+		Changes to the string fields of the structured array are passed on to
+		the string columns, but not to selections.
+		"""
+
+		dm = self.dataMatrix()
+		m = dm.m
+		s = dm.select('a == 1', verbose=False)
+		m['b'][0] = 'v'
+		m[1]['b'] = 'u'
+		self.assertEqual(list(dm['b']), ['v', 'u', 'z', 'w'])
+		self.assertEqual(list(dm.where('b == "v"')), [0])
+		self.assertEqual(list(s['b']), ['x', 'z'])
+		dm['b'][2] = 't'
+		self.assertEqual(list(dm.m['b']), ['v', 'u', 't', 'w'])
+
+	def testStringQueries(self):
+
+		"""
+		Comparisons between string columns and values give the same results
+		as comparisons between the decoded values.
+		"""
+
+		dm = self.dataMatrix()
+		b = np.array(dm['b'])
+		for query, mask in [
+			('b == "y"', b == 'y'),
+			('b != "y"', b != 'y'),
+			('b == "q"', b == 'q'),
+			('"y" == b', b == 'y'),
+			('b < "y"', b < 'y'),
+			('"x" <= b', b >= 'x'),
+			('b in ["x", "w", "q"]', np.in1d(b, ['x', 'w', 'q'])),
+			('b not in ["x"]', ~np.in1d(b, ['x'])),
+			('b == "y" or a == 1', (b == 'y') | (dm['a'] == 1))]:
+			self.assertEqual(list(dm.where(query)), list(np.where(mask)[0]),
+				query)
+
+	def testStringGroupsAndSorting(self):
+
+		"""
+		Grouping and sorting on string columns follow the order of the
+		values, also after concatenation with different levels.
+		"""
+
+		dm1 = self.dataMatrix()
+		dm2 = self.dataMatrix()
+		dm2['b'] = ['b', 'y', 'a', 'x']
+		dm = DataMatrix.concat([dm1, dm2])
+		self.assertEqual(list(dm['b']), ['x', 'y', 'z', 'w', 'b', 'y', 'a',
+			'x'])
+		self.assertEqual([g['b'][0] for g in dm.group('b')], ['a', 'b', 'w',
+			'x', 'y', 'z'])
+		dm.sort(['b', 'c'], ascending=False)
+		self.assertEqual(list(dm['b']), ['z', 'y', 'y', 'x', 'x', 'w', 'b',
+			'a'])
+		self.assertEqual(list(dm['c'])[:3], [3.5, 2.5, 2.5])
+
+	def testCollapseWithFunction(self):
+
+		"""
+		When collapsing with a function, its result is stored as the mean,
+		also if the count comes first.
+		"""
+
+		dm = self.dataMatrix()
+		cm = dm.collapse('a', lambda g: g['c'].sum(), aggregations=['count',
+			'mean', 'std'])
+		self.assertEqual(cm.columns(), ['a', 'count', 'mean', 'std'])
+		self.assertEqual(list(cm['mean']), [5., 7.])
+		self.assertEqual(list(cm['count']), [2, 2])
+		self.assertTrue(np.isnan(cm['std']).all())
+
+	def testSaveKeepsStringTypes(self):
+
+		"""
+		Saving in the `.dm` format preserves the type of the values in string
+		columns.
+		"""
+
+		dm = self.dataMatrix()
+		dm['b'][0] = u'\xe9\u4e2d'
+		dm['b'][1] = None
+		dm['b'][2] = 3
+		folder = tempfile.mkdtemp()
+		try:
+			path = os.path.join(folder, 'data.dm')
+			dm.save(path)
+			dm2 = DataMatrix(path)
+			self.assertEqual([(v, type(v)) for v in dm2['b']],
+				[(v, type(v)) for v in dm['b']])
+			self.assertEqual(list(dm2.where('b == "w"')), [3])
+		finally:
+			shutil.rmtree(folder)
+
+if __name__ == '__main__':
+	unittest.main()
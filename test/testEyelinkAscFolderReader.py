@@ -0,0 +1,242 @@
+#-*- coding:utf-8 -*-
+
+"""
+This file is part of exparser.
+
+exparser is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+exparser is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with exparser.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+import numpy as np
+from exparser.EyelinkAscFolderReader import EyelinkAscFolderReader
+from exparser import TraceStore
+
+dataFolder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data',
+	'asc')
+
+class LineCounter(EyelinkAscFolderReader):
+
+	"""
+	A parser that overrides parseLine(), so that sample lines are passed to
+	all line handlers.
+	"""
+
+	def initTrial(self, trialDict):
+
+		trialDict['nSample'] = 0
+
+	def parseLine(self, trialDict, l):
+
+		if isinstance(l[0], int):
+			trialDict['nSample'] += 1
+
+class BlinkCounter(EyelinkAscFolderReader):
+
+	"""
+	A parser that overrides endBlink(), but not parseLine().
+	"""
+
+	def initTrial(self, trialDict):
+
+		trialDict['nSample'] = 0
+		self.trialDict = trialDict
+
+	def endBlink(self, l):
+
+		if isinstance(l[0], int):
+			self.trialDict['nSample'] += 1
+		return EyelinkAscFolderReader.endBlink(self, l)
+
+class ColumnChanger(EyelinkAscFolderReader):
+
+	"""
+	A parser that adds a column only for the second file.
+	"""
+
+	def initTrial(self, trialDict):
+
+		if trialDict['file'] == 'subject1.asc':
+			trialDict['extra'] = 1
+
+class ParseCounter(EyelinkAscFolderReader):
+
+	"""
+	A parser that keeps track of the files that it has parsed.
+	"""
+
+	parsed = []
+
+	def parseFile(self, path):
+
+		ParseCounter.parsed.append(os.path.basename(path))
+		return EyelinkAscFolderReader.parseFile(self, path)
+
+class TestEyelinkAscFolderReader(unittest.TestCase):
+
+	"""
+	Tests for EyelinkAscFolderReader. All ways of parsing the test data should
+	give the same DataMatrix and the same traces.
+	"""
+
+	def setUp(self):
+
+		self.folder = tempfile.mkdtemp()
+
+	def tearDown(self):
+
+		shutil.rmtree(self.folder)
+
+	def parse(self, cls=EyelinkAscFolderReader, path=dataFolder,
+		traceFolder='traces', **kwargs):
+
+		return cls(path=path, traceFolder=os.path.join(self.folder,
+			traceFolder), **kwargs).dataMatrix()
+
+	def assertSameData(self, dm1, dm2):
+
+		"""
+		Checks that two DataMatrices have the same columns, values, and
+		traces. Columns that only exist in one of them are ignored.
+		"""
+
+		names = [name for name in dm1.columns() if name in dm2.columns()]
+		self.assertTrue('__trace_target__' in names)
+		self.assertEqual(len(dm1), len(dm2))
+		for name in names:
+			if not name.startswith('__trace_'):
+				self.assertEqual(list(dm1[name]), list(dm2[name]), name)
+				continue
+			for ref1, ref2 in zip(dm1[name], dm2[name]):
+				np.testing.assert_array_equal(TraceStore.loadTrace(ref1),
+					TraceStore.loadTrace(ref2))
+
+	def testParseLineOverride(self):
+
+		"""
+		Overriding parseLine() does not change the result, and sample lines
+		are passed to parseLine().
+		"""
+
+		dm = self.parse()
+		dmLine = self.parse(LineCounter, traceFolder='line')
+		self.assertSameData(dm, dmLine)
+		# Each trial has 80 samples. Samples between trials are not counted.
+		self.assertEqual(list(dmLine['nSample']), [80] * 6)
+
+	def testSampleHandlers(self):
+
+		"""
+		Sample lines are passed to all line handlers when one of them has
+		been overridden.
+		"""
+
+		dm = self.parse()
+		dmBlink = self.parse(BlinkCounter, traceFolder='blink')
+		self.assertSameData(dm, dmBlink)
+		self.assertEqual(list(dmBlink['nSample']), [80] * 6)
+
+	def testTraces(self):
+
+		"""
+		Traces hold the x, y, and pupil size of all samples of a phase, with
+		nan for missing values and a pupil size of 0.
+		"""
+
+		# The baseline of the first trial
+		a = []
+		phase = None
+		for line in open(os.path.join(dataFolder, 'subject0.asc')):
+			l = line.split()
+			if l[:1] == ['MSG'] and l[2] == 'phase':
+				if phase == 'baseline':
+					break
+				phase = l[3]
+			elif phase == 'baseline' and l[0].isdigit():
+				a.append([np.nan if v in ('.', '0.0') else float(v) \
+					for v in l[1:4]])
+		dm = self.parse()
+		trace = TraceStore.loadTrace(dm['__trace_baseline__'][0])
+		self.assertEqual(trace.shape, (40, 3))
+		np.testing.assert_array_equal(trace, np.array(a))
+
+	def testWorkers(self):
+
+		"""
+		Parsing in parallel gives the same result as parsing one file at a
+		time, and files are read in sorted order.
+		"""
+
+		dm = self.parse(workers=1)
+		dmParallel = self.parse(workers=2, traceFolder='parallel')
+		self.assertSameData(dm, dmParallel)
+		self.assertEqual(list(dm['file']), ['subject0.asc'] * 3 + \
+			['subject1.asc'] * 3)
+
+	def testWorkersStopOnError(self):
+
+		"""
+		Worker processes are stopped when reading fails.
+		"""
+
+		self.assertRaises(Exception, self.parse, ColumnChanger, workers=2,
+			acceptNonMatchingColumns=False)
+		self.assertEqual(multiprocessing.active_children(), [])
+
+	def testIncremental(self):
+
+		"""
+		In incremental mode, unchanged files are loaded from the cache, and
+		give the same result as parsing them.
+		"""
+
+		dm = self.parse()
+		ParseCounter.parsed = []
+		dmFirst = self.parse(ParseCounter, incremental=True,
+			traceFolder='incremental')
+		self.assertEqual(ParseCounter.parsed, ['subject0.asc',
+			'subject1.asc'])
+		dmSecond = self.parse(ParseCounter, incremental=True,
+			traceFolder='incremental')
+		self.assertEqual(len(ParseCounter.parsed), 2)
+		self.assertSameData(dm, dmFirst)
+		self.assertSameData(dm, dmSecond)
+
+	def testIncrementalFoldersWithSameFileNames(self):
+
+		"""
+		Files with the same name in different folders do not share their
+		cache.
+		"""
+
+		folders = []
+		for i, rt in enumerate(['806', '999']):
+			folder = os.path.join(self.folder, 'data%d' % i)
+			os.mkdir(folder)
+			with open(os.path.join(dataFolder, 'subject0.asc')) as fd:
+				data = fd.read()
+			with open(os.path.join(folder, 'subject0.asc'), 'w') as fd:
+				fd.write(data.replace('var rt 806', 'var rt %s' % rt))
+			folders.append(folder)
+		for run in range(2):
+			dm0 = self.parse(path=folders[0], incremental=True)
+			dm1 = self.parse(path=folders[1], incremental=True)
+			self.assertEqual(dm0['rt'][0], 806)
+			self.assertEqual(dm1['rt'][0], 999)
+
+if __name__ == '__main__':
+	unittest.main()
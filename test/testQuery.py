@@ -0,0 +1,111 @@
+#-*- coding:utf-8 -*-
+
+"""
+This file is part of exparser.
+
+exparser is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+exparser is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with exparser.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+import numpy as np
+from exparser.DataMatrix import DataMatrix
+from exparser.Query import compileQuery
+
+class TestQuery(unittest.TestCase):
+
+	"""
+	Tests for compiled queries.
+	"""
+
+	def dataMatrix(self):
+
+		return DataMatrix([['rt', 'cond', 'rt-2'], [1, 'a', 4], [2, 'b', 3],
+			[3, 'a', 2], [4, 'c', 1]])
+
+	def assertRows(self, dm, query, rows):
+
+		self.assertEqual(list(dm.where(query)), rows, query)
+
+	def testChainedCompares(self):
+
+		"""
+		Chained comparisons combine all comparisons.
+		"""
+
+		dm = self.dataMatrix()
+		self.assertRows(dm, '1 < rt <= 3', [1, 2])
+		self.assertRows(dm, '1 <= rt < 4 != rt', [0, 1, 2])
+		self.assertRows(dm, '"a" <= cond < "c"', [0, 1, 2])
+
+	def testIn(self):
+
+		"""
+		`in` and `not in` work on string and numeric columns.
+		"""
+
+		dm = self.dataMatrix()
+		self.assertRows(dm, 'cond in ["a", "c", "q"]', [0, 2, 3])
+		self.assertRows(dm, 'cond not in ["a", "q"]', [1, 3])
+		self.assertRows(dm, 'rt in [2, 4, 5]', [1, 3])
+		self.assertRows(dm, 'rt not in (2, 4)', [0, 2])
+
+	def testSwappedOperands(self):
+
+		"""
+		A value may come before the column.
+		"""
+
+		dm = self.dataMatrix()
+		self.assertRows(dm, '3 < rt', [3])
+		self.assertRows(dm, '3 >= rt', [0, 1, 2])
+		self.assertRows(dm, '"b" == cond', [1])
+		self.assertRows(dm, '"b" < cond', [3])
+
+	def testValueThatIsNotALevel(self):
+
+		"""
+		Comparing a string column to a value that does not occur in it
+		matches no rows, or all rows for `!=`.
+		"""
+
+		dm = self.dataMatrix()
+		self.assertRows(dm, 'cond == "q"', [])
+		self.assertRows(dm, 'cond != "q"', [0, 1, 2, 3])
+		self.assertRows(dm, 'cond == 1', [])
+		self.assertEqual(dm.unique('cond'), ['a', 'b', 'c'])
+
+	def testLegacyQueries(self):
+
+		"""
+		Queries on columns that are not Python names, and queries that refer
+		to the DataMatrix as `self`, are evaluated as in the original
+		DataMatrix.select().
+		"""
+
+		dm = self.dataMatrix()
+		self.assertRows(dm, 'rt-2 > 2', [0, 1])
+		self.assertRows(dm, 'rt-2 == np.max(self["rt"])', [0])
+		self.assertRows(dm, 'rt > nanmean(self["rt-2"])', [2, 3])
+		self.assertEqual(len(dm.select('rt-2 < 3', verbose=False)), 2)
+
+	def testQueriesAreCached(self):
+
+		"""
+		Compiled queries are reused.
+		"""
+
+		self.assertTrue(compileQuery('rt > 1') is compileQuery('rt > 1'))
+
+if __name__ == '__main__':
+	unittest.main()